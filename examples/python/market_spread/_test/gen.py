@@ -16,7 +16,6 @@
 from collections import namedtuple
 from datetime import datetime
 from random import choice, randrange, randint, random
-from string import lowercase
 from struct import pack
 
 from market_spread import (FIXTYPE_MARKET_DATA,
@@ -48,9 +47,9 @@ no_reject_symbols_txt = """
     MEG
     HUN
 """
-SYMBOLS_REJECT = [s.rstrip().lstrip().rjust(4) for s in
+SYMBOLS_REJECT = [s.rstrip().lstrip().rjust(4).encode() for s in
            reject_symbols_txt.splitlines() if s]
-SYMBOLS_NO_REJECT = [s.rstrip().lstrip().rjust(4) for s in
+SYMBOLS_NO_REJECT = [s.rstrip().lstrip().rjust(4).encode() for s in
              no_reject_symbols_txt.splitlines() if s]
 
 
@@ -65,16 +64,16 @@ def create_order(reject):
     fix_type = FIXTYPE_ORDER
     side = choice([SIDETYPE_BUY, SIDETYPE_SELL])  # isn't used
     account = randint(1,10)  # isn't used
-    order_id = "{:06d}".format(ORDERS_COUNTER)  # isn't used
+    order_id = "{:06d}".format(ORDERS_COUNTER).encode()  # isn't used
     ORDERS_COUNTER += 1  # isn't used
     qty = 1000.0  # isn't used
     price= 10  # isn't used
-    transact_time = str(datetime.now())[:-5]  # isn't used
+    transact_time = str(datetime.now())[:-5].encode()  # isn't used
     if not reject:
-        symbol = choice(NOT_REJECTED.keys())
+        symbol = choice(list(NOT_REJECTED))
         r = None
     else:
-        symbol = choice(REJECTED.keys())
+        symbol = choice(list(REJECTED))
         rej = REJECTED[symbol]
         # note that we 0 for timestamp, as we can't compare it
         # with the one generated by the application
@@ -92,7 +91,7 @@ def create_market_data(reject):
     global REJECTED
     global NOT_REJECTED
     fix_type = FIXTYPE_MARKET_DATA
-    transact_time = str(datetime.now())[:-5]
+    transact_time = str(datetime.now())[:-5].encode()
     bid = 1000
     if reject:
         symbol = choice(SYMBOLS_REJECT)
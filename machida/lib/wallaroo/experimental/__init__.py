@@ -17,16 +17,25 @@ import asynchat
 import asyncore
 from collections import namedtuple
 from datetime import datetime
+import errno
 import inspect
+import io
 import logging
 import os
 from select import select
 import socket
+import stat
 import struct
 import sys
 import threading
 import time
 import traceback
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 # A note on import dependencies:
 # This only works if `machida/lib/` is in your PYTHONNPATH. This is fine here
@@ -74,6 +83,45 @@ def octet_message_encoder(func):
     return C()
 
 
+# Hosts of the form `unix:<path>` name a Unix domain socket. Connectors
+# that run on the same machine as the worker can use one to skip the TCP
+# stack; the port is then ignored.
+UNIX_PREFIX = 'unix:'
+
+
+def _is_unix_address(host):
+    return host is not None and host.startswith(UNIX_PREFIX)
+
+
+def _connect_socket(host, port):
+    if _is_unix_address(host):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(host[len(UNIX_PREFIX):])
+    else:
+        conn = socket.socket()
+        conn.connect((host, int(port)))
+    return conn
+
+
+def _listen_socket(host, port, backlog=0):
+    if _is_unix_address(host):
+        path = host[len(UNIX_PREFIX):]
+        # remove a socket left behind by an earlier run, but nothing else
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError:
+            pass
+        acceptor = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        acceptor.bind(path)
+    else:
+        acceptor = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        acceptor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        acceptor.bind((host, int(port)))
+    acceptor.listen(backlog)
+    return acceptor
+
+
 class SourceConnectorConfig(object):
     def __init__(self, name, encoder, decoder, port, cookie,
                  max_credits, refill_credits, host='127.0.0.1'):
@@ -140,8 +188,7 @@ class SourceConnector(BaseConnector):
         while True:
             try:
                 logging.debug("SourceConnector.connect: top")
-                conn = socket.socket()
-                conn.connect( (host or self._host, int(port or self._port)) )
+                conn = _connect_socket(host or self._host, port or self._port)
                 logging.debug("SourceConnector: Now connected on socket {}".format(conn.fileno()))
                 self._conn = conn
                 return
@@ -161,12 +208,19 @@ class SourceConnector(BaseConnector):
 Stream = namedtuple('Stream', ['id', 'name', 'point_of_ref', 'is_open'])
 
 
-def _asyncore_loop(sentinel, timeout, socket_map):
+def _asyncore_loop(sentinel, timeout, socket_map, idle_timeout=None):
+    """
+    `idle_timeout`, if provided, is called before every poll and returns
+    how long the poll may block waiting for socket activity. This lets
+    a paced connector sleep in select() until its next send is due instead
+    of spinning at `timeout`.
+    """
     poll_fun = asyncore.poll
 
     try:
         while not sentinel.is_set():
-            poll_fun(timeout=timeout, map=socket_map)
+            poll_fun(timeout=(idle_timeout() if idle_timeout else timeout),
+                     map=socket_map)
             time.sleep(timeout)
     except:
         logging.exception("_asyyncore_loop exited!")
@@ -185,13 +239,24 @@ def _asyncore_loop(sentinel, timeout, socket_map):
 
 
 class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
+    """
+    If the worker accepts one of the `compression` codecs during the
+    handshake, consecutive messages are sent compressed together as a
+    MessageBlock. A block is cut once it holds `compress_block_bytes` of
+    frames, or whenever the connector flushes its output. Runs of messages
+    smaller than `compress_min_bytes`, or that do not shrink, are sent
+    uncompressed. No block is larger than the worker's limit,
+    `MAX_MESSAGE_BLOCK_SIZE`. Pass `compression=()` to disable compression.
+    """
     def __init__(self, version, cookie, program_name, instance_name,
-                 host, port, delay=0):
+                 host, port, delay=0, compression=('zlib',),
+                 compress_min_bytes=4096, compress_block_bytes=64 * 1024):
 
         self.data = None
         # connection details are given from the base
         self._host = host
-        self._port = int(port)  # convert port to int
+        # convert port to int, unless connecting to a Unix domain socket
+        self._port = port if _is_unix_address(host) else int(port)
         self.credits = 0
         self.version = version
         self.cookie = cookie
@@ -202,6 +267,18 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
 
         self._write_lock = threading.Lock()
 
+        # Compression: the codecs offered in Hello and the one the worker
+        # picked in Ok, if any
+        self.compression_codecs = [c for c in compression
+                                   if c in cwm.COMPRESSION_CODECS]
+        self.compress_min_bytes = compress_min_bytes
+        self.compress_block_bytes = compress_block_bytes
+        self._compression = None
+        # Message frames waiting to be sent as one MessageBlock
+        self._block = []
+        self._block_bytes = 0
+        self._block_lock = threading.Lock()
+
         # Stream details
         # live streams for this connection
         self._streams = {}  # {stream_id: {'stream': Stream, 'por': por}}
@@ -233,6 +310,26 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
         self.stopped = threading.Event()
         print("version {} cookie {} program_name {} instance_name {} host {} port {} delay {}".format(version, cookie, program_name, instance_name, host, port, delay))
 
+    @classmethod
+    def from_args(cls, args=None, required_params=[], optional_params=[],
+                  version="0.0.1", program_name=None, instance_name=None,
+                  **kwargs):
+        """
+        Create a connector for the source connector named by `--connector`
+        in the application given by `--application-module`, taking the
+        host, port and cookie from the application's SourceConnectorConfig.
+        The connector's own parameters are available as `connector.params`.
+        Extra keyword arguments are passed to the constructor.
+        """
+        config = BaseConnector(args, required_params, optional_params)
+        params = config.params
+        connector = cls(version, config._cookie,
+                        program_name or params.application,
+                        instance_name or params.connector_name,
+                        config._host, config._port, **kwargs)
+        connector.params = params
+        return connector
+
     def join(self, timeout=None):
         """
         Block until all sources have been exhausted or the timeout elapses
@@ -264,10 +361,19 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
         self._loop = threading.Thread(target = _asyncore_loop,
                                       args = (self._loop_sentinel,
                                               self._asyncore_loop_timeout,
-                                              self._socket_map))
+                                              self._socket_map,
+                                              self._idle_timeout))
         self._loop.daemon = True
         self._loop.start()
 
+    def _idle_timeout(self):
+        """
+        How long the asyncore loop may block in select() before polling
+        again. Subclasses that know their next send is not due yet (e.g.
+        because every source is paced) may return a longer timeout.
+        """
+        return self._asyncore_loop_timeout
+
     ###########################
     # Incoming communications #
     ###########################
@@ -337,6 +443,11 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
         else:
             # deposit the credits
             self.credits += msg.initial_credits
+            # a worker that predates compression never picks a codec
+            if msg.compression in self.compression_codecs:
+                self._compression = msg.compression
+            else:
+                self._compression = None
             # set handshake_complete
             self.handshake_complete = True
             # set terminator to 4 to expect the next message's header
@@ -390,8 +501,7 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
         while True:
             try:
                 logging.debug("AtLeastOnceSourceConnector.connect: top")
-                conn = socket.socket()
-                conn.connect( (self._host, self._port) )
+                conn = _connect_socket(self._host, self._port)
             except Exception as err:
                 logging.error("Failed to connect to {}:{}".format(self._host,
                     self._port))
@@ -412,7 +522,7 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
 
         self.in_handshake = True
         hello = cwm.Hello(self.version, self.cookie, self.program_name,
-                          self.instance_name)
+                          self.instance_name, self.compression_codecs)
         data = cwm.Frame.encode(hello)
         self._conn.sendall(data)
         if self.data is not None:
@@ -470,6 +580,14 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
                 except StopIteration:
                     self.initiate_send()
                     self.shutdown()
+                except Exception as err:
+                    # A failing source stops the connector, rather than
+                    # leaving it connected and silent
+                    logging.exception("AtLeastOnceSourceConnector: source "
+                                      "failed")
+                    self.shutdown(error=cwm.Error(
+                        "Source failed: {!r}".format(err)))
+                    self.error = err
             else:
                 self.initiate_send()
 
@@ -486,6 +604,7 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
             # If this is a clean shutdown, try to synchronously send any
             # remaining data that was queued
             try:
+                self._flush_block()
                 while self.producer_fifo:
                     self._conn.sendall(self.producer_fifo.popleft())
             except:
@@ -515,7 +634,7 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
                 if self._streams[msg.stream_id].is_open:
                     ##logging.debug("write: encode: {}".format(msg))
                     data = cwm.Frame.encode(msg)
-                    self._write(data)
+                    self._write_message(data)
                     # use up 1 credit
                     self.credits -= 1
                 else:
@@ -528,12 +647,14 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
         elif isinstance(msg, cwm.Notify):
             # write the message
             data = cwm.Frame.encode(msg)
+            self._flush_block()
             self._write(data)
             # use up 1 credit
             self.credits -= 1
         elif isinstance(msg, (cwm.EosMessage, cwm.Error)):
             # write the message
             data = cwm.Frame.encode(msg)
+            self._flush_block()
             self._write(data)
         else:
             raise ProtocolError("Can only send message types {{Notify, "
@@ -547,7 +668,39 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
         self._sent += 1
         self.producer_fifo.append(data)
 
+    def _write_message(self, data):
+        """
+        Queue an encoded Message frame, via the current MessageBlock if
+        compression was negotiated.
+        """
+        if self._compression is None:
+            self._write(data)
+            return
+        with self._block_lock:
+            if self._block_bytes + len(data) > cwm.MAX_MESSAGE_BLOCK_SIZE:
+                self._flush_block_locked()
+            self._block.append(data)
+            self._block_bytes += len(data)
+            if self._block_bytes >= self.compress_block_bytes:
+                self._flush_block_locked()
+
+    def _flush_block(self):
+        with self._block_lock:
+            self._flush_block_locked()
+
+    def _flush_block_locked(self):
+        frames, size = self._block, self._block_bytes
+        self._block, self._block_bytes = [], 0
+        if len(frames) > 1 and size >= self.compress_min_bytes:
+            block = cwm.MessageBlock.compress(frames, self._compression)
+            if len(block.data) < size:
+                self._write(cwm.Frame.encode(block))
+                return
+        for data in frames:
+            self._write(data)
+
     def initiate_send(self):
+        self._flush_block()
         if self.connected:
             # collect data up to 65kb in size, send, repeat, until empty
             obs = self.ac_out_buffer_size
@@ -708,6 +861,8 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
                 self._streams[sid] = new
                 self.stream_closed(new)
 
+        with self._block_lock:
+            self._block, self._block_bytes = [], 0
         logging.debug("Popping the producer_fifo")
         c = 0
         while self.producer_fifo:
@@ -823,18 +978,64 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
         raise NotImplementedError
 
 
+class _ReceiveBuffer(object):
+    """
+    A growable receive buffer with a read cursor.
+
+    Data is received directly into the free tail of a bytearray with
+    `recv_into`, and frames are consumed by advancing `start`, so neither
+    receiving nor reading a frame copies the rest of the buffer. Unread
+    bytes are moved to the front only when the tail runs out of room.
+    """
+    def __init__(self, size):
+        self.data = bytearray(size)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def recv_from(self, sock, recv_size):
+        if len(self.data) - self.end < recv_size:
+            self._make_room(recv_size)
+        view = memoryview(self.data)[self.end:self.end + recv_size]
+        n = sock.recv_into(view, recv_size)
+        self.end += n
+        return n
+
+    def _make_room(self, recv_size):
+        unread = self.end - self.start
+        if unread + recv_size > len(self.data):
+            self.data.extend(bytearray(max(len(self.data),
+                                           unread + recv_size - len(self.data))))
+        if self.start > 0:
+            self.data[:unread] = self.data[self.start:self.end]
+            self.start = 0
+            self.end = unread
+
+    def peek(self, n):
+        return bytes(self.data[self.start:self.start + n])
+
+    def take(self, n):
+        bs = bytes(self.data[self.start:self.start + n])
+        self.skip(n)
+        return bs
+
+    def skip(self, n):
+        self.start += n
+        if self.start == self.end:
+            self.start = self.end = 0
+
+
 class SinkConnector(object):
+    # Bytes requested per recv_into call, and the initial size of each
+    # connection's receive buffer.
+    recv_size = 256 * 1024
+    buffer_size = 1024 * 1024
+
     def __init__(self, args=None, required_params=[], optional_params=[]):
-        params = parse_connector_args(args or sys.argv, required_params, optional_params)
-        wallaroo_mod = __import__(params.application)
-        application = wallaroo_mod.application_setup(args or sys.argv)
-        sink = None
-        for stage in application[2]:
-            for step in stage:
-                if step[0] == 'to_sink' and step[1][0] == 'sink_connector' and step[1][1] == params.connector_name:
-                    sink = step[1]
-        if sink is None:
-            raise RuntimeError("Unable to find a sink connector with the name " + params.connector_name)
+        params, sink = _find_sink_connector(args, required_params,
+                                            optional_params)
         (_, _name, host, port, _encoder, decoder, cookie) = sink
         self.params = params
         self._decoder = decoder
@@ -845,22 +1046,55 @@ class SinkConnector(object):
         self._connections = []
         self._buffers = {}
         self._pending = []
+        self.bytes_received = 0
 
     def listen(self, host=None, port=None, backlog=0):
-        acceptor = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        acceptor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        acceptor.bind((host or self._host, int(port or self._port)))
-        acceptor.listen(backlog)
+        acceptor = _listen_socket(host or self._host, port or self._port,
+                                  backlog)
         self._acceptor = acceptor
         self._connections.append(acceptor)
 
     def read(self, timeout=None):
         while True:
-            for socket in self._pending:
+            for socket in list(self._pending):
                 ok, message = self._read_one(socket)
                 if ok: return message
             self._select_any(timeout)
 
+    def read_batch(self, max_items=None, timeout=None):
+        """
+        Return a list of every complete message that is available, up to
+        `max_items` if given.
+
+        If no message is available, wait up to `timeout` seconds for one
+        (forever if `timeout` is None). An empty list is returned if the
+        timeout elapses first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            batch = self._read_available(max_items)
+            if batch:
+                return batch
+            if deadline is None:
+                self._select_any(None)
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return batch
+                self._select_any(remaining)
+            # pick up whatever else has arrived on other connections
+            self._select_any(0)
+
+    def _read_available(self, max_items=None):
+        batch = []
+        for socket in list(self._pending):
+            while max_items is None or len(batch) < max_items:
+                ok, message = self._read_one(socket)
+                if not ok:
+                    break
+                batch.append(message)
+        return batch
+
     def _select_any(self, timeout=None):
         readable, _, exceptional = select(self._connections, [], self._connections, timeout)
         for socket in exceptional:
@@ -873,39 +1107,993 @@ class SinkConnector(object):
             if socket is self._acceptor:
                 conn, _addr = socket.accept()
                 self._setup_connection(conn)
-            else:
-                buffered = self._buffers[socket] + socket.recv(4096)
-                self._buffers[socket] = buffered
-                self._pending.append(socket)
+            elif socket in self._buffers:
+                try:
+                    received = self._buffers[socket].recv_from(socket,
+                                                               self.recv_size)
+                except EnvironmentError as err:
+                    if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                     errno.EINTR):
+                        continue
+                    raise
+                if socket not in self._pending:
+                    self._pending.append(socket)
+                if received == 0:
+                    # Peer closed: frames already buffered are still read
+                    self._teardown_connection(socket)
 
     def _read_one(self, socket):
         buffered = self._buffers[socket]
         header_len = self._decoder.header_length()
-        if len(buffered) < header_len:
-            self._buffers[socket] = buffered
-            return (False, None)
-        expected = self._decoder.payload_length(buffered[:header_len])
-        if len(buffered) < header_len + expected:
-            self._buffers[socket] = buffered
-            return (False, None)
-        data = buffered[header_len:header_len+expected]
-        buffered = buffered[header_len + expected:]
-        self._buffers[socket] = buffered
-        if len(buffered) < header_len:
-            self._pending.remove(socket)
-        return (True, self._decoder.decode(data))
+        if len(buffered) >= header_len:
+            expected = self._decoder.payload_length(buffered.peek(header_len))
+            if len(buffered) >= header_len + expected:
+                buffered.skip(header_len)
+                self.bytes_received += header_len + expected
+                return (True, self._decoder.decode(buffered.take(expected)))
+        self._pending.remove(socket)
+        if socket not in self._connections:
+            del self._buffers[socket]
+        return (False, None)
 
     def _setup_connection(self, conn):
         conn.setblocking(0)
         self._connections.append(conn)
-        self._buffers[conn] = b""
+        self._buffers[conn] = _ReceiveBuffer(self.buffer_size)
 
     def _teardown_connection(self, conn):
         self._connections.remove(conn)
-        del self._buffers[conn]
+        if conn not in self._pending:
+            del self._buffers[conn]
         conn.close()
 
 
+class BatchingSinkConnector(SinkConnector):
+    """
+    A SinkConnector that collects decoded messages into batches and hands
+    each batch to a `flush(batch)` function on a background thread.
+
+    A batch is flushed as soon as it holds `max_batch_items` messages or
+    `max_batch_bytes` bytes of encoded data, or `max_batch_latency` seconds
+    after its first message arrived, whichever comes first. A byte or
+    latency limit of None is not applied. At most `max_pending_batches`
+    batches wait for the flush thread; beyond that reading stops, which
+    pushes back on the Wallaroo worker through TCP.
+
+    The limits may also be given on the command line as the optional
+    connector params `batch_max_items`, `batch_max_bytes` and
+    `batch_max_latency`, which take precedence over the arguments.
+
+    Usage:
+    ```
+    connector = BatchingSinkConnector(required_params=['topic'])
+    connector.listen()
+
+    def flush(batch):
+        for key, value in batch:
+            producer.send(topic, key=key, value=value)
+        producer.flush()
+
+    connector.run(flush)
+    ```
+    Alternatively, subclass and override `flush(self, batch)`.
+    If `flush` raises, the connector stops and `run()` raises a
+    ConnectorError carrying the original error.
+    """
+    BATCH_PARAMS = ['batch_max_items', 'batch_max_bytes', 'batch_max_latency']
+
+    def __init__(self, args=None, required_params=[], optional_params=[],
+                 max_batch_items=1000, max_batch_bytes=None,
+                 max_batch_latency=0.1, max_pending_batches=2):
+        super(BatchingSinkConnector, self).__init__(
+            args, required_params,
+            list(optional_params) + [p for p in self.BATCH_PARAMS
+                                     if p not in optional_params])
+        params = self.params
+        self.max_batch_items = int(params.batch_max_items or max_batch_items)
+        self.max_batch_bytes = (int(params.batch_max_bytes)
+                                if params.batch_max_bytes else max_batch_bytes)
+        self.max_batch_latency = (float(params.batch_max_latency)
+                                  if params.batch_max_latency
+                                  else max_batch_latency)
+        self._batches = queue.Queue(maxsize=max_pending_batches)
+        self._flusher = None
+        self._stopped = threading.Event()
+        self.error = None
+        self.stats = BatchStats()
+
+    def flush(self, batch):
+        """
+        Write `batch`, a list of decoded messages, to the outside system.
+        Called on the flush thread, one batch at a time.
+        """
+        raise NotImplementedError
+
+    def run(self, flush=None):
+        """
+        Read, batch and flush messages until `stop()` is called or a flush
+        fails. `flush`, if given, is used instead of `self.flush`.
+        """
+        if flush is not None:
+            self.flush = flush
+        self._flusher = threading.Thread(target=self._flush_loop)
+        self._flusher.daemon = True
+        self._flusher.start()
+        batch = []
+        batch_bytes = 0
+        deadline = None
+        while not self._stopped.is_set():
+            if deadline is None:
+                # wake up periodically to notice stop()
+                timeout = 0.5
+            else:
+                timeout = max(0, deadline - time.time())
+            before = self.bytes_received
+            messages = self.read_batch(self.max_batch_items - len(batch),
+                                       timeout)
+            if messages:
+                if not batch and self.max_batch_latency is not None:
+                    deadline = time.time() + self.max_batch_latency
+                batch.extend(messages)
+                batch_bytes += self.bytes_received - before
+            if batch and (len(batch) >= self.max_batch_items or
+                          (self.max_batch_bytes is not None and
+                           batch_bytes >= self.max_batch_bytes) or
+                          (deadline is not None and
+                           time.time() >= deadline)):
+                if not self._submit(batch, batch_bytes):
+                    # stopped while the queue was full: queued below
+                    break
+                batch = []
+                batch_bytes = 0
+                deadline = None
+        if batch and self.error is None:
+            self._batches.put((batch, batch_bytes))
+        self._batches.put(None)
+        self._flusher.join()
+        if self.error is not None:
+            raise ConnectorError("flush failed: {!r}".format(self.error))
+
+    def stop(self):
+        """
+        Stop reading; batches collected so far are still flushed.
+        """
+        self._stopped.set()
+
+    def _submit(self, batch, batch_bytes):
+        """
+        Queue `batch` for the flush thread, and return True, unless the
+        connector is stopped first.
+        """
+        while not self._stopped.is_set():
+            try:
+                self._batches.put((batch, batch_bytes), timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _flush_loop(self):
+        while True:
+            item = self._batches.get()
+            if item is None:
+                return
+            batch, batch_bytes = item
+            if self.error is not None:
+                continue
+            start = time.time()
+            try:
+                self.flush(batch)
+            except Exception as err:
+                logging.exception("BatchingSinkConnector: flush of {} "
+                                  "messages failed".format(len(batch)))
+                self.error = err
+                self._stopped.set()
+                continue
+            self.stats.record(len(batch), batch_bytes, time.time() - start)
+
+
+class BatchStats(object):
+    """
+    Running batch-size and flush-latency statistics for a
+    BatchingSinkConnector. Percentiles are computed over the most recent
+    `window` flushes.
+    """
+    def __init__(self, window=1024):
+        self._lock = threading.Lock()
+        self._window = window
+        self._recent = []  # [(items, latency)]
+        self.batches = 0
+        self.messages = 0
+        self.bytes = 0
+        self.max_batch_items = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    def record(self, items, nbytes, latency):
+        with self._lock:
+            self.batches += 1
+            self.messages += items
+            self.bytes += nbytes
+            self.max_batch_items = max(self.max_batch_items, items)
+            self.flush_seconds += latency
+            self.max_flush_seconds = max(self.max_flush_seconds, latency)
+            self._recent.append((items, latency))
+            if len(self._recent) > self._window:
+                del self._recent[:len(self._recent) - self._window]
+
+    def snapshot(self):
+        """
+        Return the statistics as a dict, e.g. for logging or JSON export.
+        """
+        with self._lock:
+            recent = list(self._recent)
+            snap = {'batches': self.batches,
+                    'messages': self.messages,
+                    'bytes': self.bytes,
+                    'max_batch_items': self.max_batch_items,
+                    'mean_batch_items': (float(self.messages) / self.batches
+                                         if self.batches else 0.0),
+                    'mean_flush_seconds': (self.flush_seconds / self.batches
+                                           if self.batches else 0.0),
+                    'max_flush_seconds': self.max_flush_seconds}
+        latencies = sorted(l for _, l in recent)
+        for name, q in (('p50', 0.50), ('p99', 0.99)):
+            snap['{}_flush_seconds'.format(name)] = (
+                latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+                if latencies else 0.0)
+        return snap
+
+    def __str__(self):
+        return "BatchStats({})".format(", ".join(
+            "{}={}".format(k, v) for k, v in sorted(self.snapshot().items())))
+
+
+class _TwoPCWorkerState(object):
+    """
+    What the txn log says about one Wallaroo worker's output.
+    """
+    def __init__(self):
+        # end offset of the last committed transaction
+        self.committed = 0
+        # transactions through phase 1 but not phase 2:
+        # {txn_id: (vote, where_list)}
+        self.pending = {}
+        # False once something has happened that must abort the next
+        # transaction, e.g. a gap in the output
+        self.commit_next = True
+
+    def apply(self, op, txn_id, arg):
+        if op in ('1-ok', '1-rollback'):
+            self.pending[txn_id] = (op == '1-ok',
+                                    [tuple(w) for w in arg])
+            self.commit_next = True
+        elif op == '2-ok':
+            self.pending.pop(txn_id, None)
+            self.committed = arg
+        elif op == '2-rollback':
+            self.pending.pop(txn_id, None)
+        elif op == 'next-txn-force-abort':
+            self.commit_next = False
+
+    def resume_offset(self):
+        """
+        The offset the worker's output continues from after a reconnect.
+        A transaction that voted to commit in phase 1 may still be
+        committed, so its output is kept.
+        """
+        if len(self.pending) > 1:
+            raise ConnectorError("more than one transaction in doubt: {}"
+                                 .format(sorted(self.pending)))
+        for vote, where_list in self.pending.values():
+            if vote:
+                return max(end for _, _, end in where_list)
+        return self.committed
+
+
+class TwoPCTxnLog(object):
+    """
+    The transaction log of a TwoPCSinkConnector, and the state of every
+    worker that it describes, in `workers`.
+
+    The log is a binary file: an 8 byte magic followed by records of
+    `length: U32, crc32: U32, type: U8, payload`, where the checksum
+    covers the type and payload. A record is either one entry, such as
+    a phase 1 vote, or a checkpoint of the state of every worker. Once
+    `checkpoint_bytes` of entries follow the last checkpoint, the log is
+    replaced by a new one that holds only a fresh checkpoint. Recovery
+    therefore reads at most one checkpoint and `checkpoint_bytes` of
+    entries, however long the sink has run. A torn or corrupt record at
+    the end of the log, left by a crash, is cut off.
+
+    Records are written and fsynced by a background thread. Everything
+    appended while an fsync is in progress is written out together and
+    made durable by the next single fsync, so connections that append
+    at the same time share the cost of one fsync (group commit).
+    `append` returns a sequence number that can be passed to
+    `wait_durable`.
+    """
+    MAGIC = b'WTXNLOG1'
+    ENTRY = 1
+    CHECKPOINT = 2
+    _OPS = ['1-ok', '1-rollback', '2-ok', '2-rollback',
+            'next-txn-force-abort', 'left']
+    _OP_CODES = dict((op, code) for code, op in enumerate(_OPS))
+    _HEADER = struct.Struct('>IIB')
+
+    def __init__(self, path, checkpoint_bytes=4 * 1024 * 1024):
+        self.path = path
+        self.checkpoint_bytes = checkpoint_bytes
+        self.workers = {}  # {worker: _TwoPCWorkerState}
+        self.fsyncs = 0
+        self.checkpoints = 0
+        self._cond = threading.Condition()
+        self._pending = []
+        self._appended = 0
+        self._durable = 0
+        self._tail_bytes = 0
+        self._error = None
+        self._closed = False
+        self._file = None
+        self._thread = None
+
+    def load(self):
+        """
+        Open the log and restore `workers` from it.
+        """
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                valid = self._replay(f)
+            self._file = open(self.path, 'ab')
+            if self._file.tell() != valid:
+                logging.warning("TwoPCTxnLog: discarding a torn record at "
+                                "offset {} of {}".format(valid, self.path))
+                self._file.truncate(valid)
+        else:
+            self._rewrite()
+        self._thread = threading.Thread(target=self._sync_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def worker(self, worker):
+        """
+        Return the state of `worker`, creating it if it is new.
+        """
+        with self._cond:
+            state = self.workers.get(worker)
+            if state is None:
+                state = self.workers[worker] = _TwoPCWorkerState()
+            return state
+
+    def append(self, worker, op, txn_id=None, arg=None):
+        """
+        Apply an entry to the worker's state and queue it for writing.
+        """
+        record = self._record(self.ENTRY,
+                              self._encode_entry(worker, op, txn_id, arg))
+        with self._cond:
+            if self._error is not None:
+                raise ConnectorError("txn log write failed: {!r}"
+                                     .format(self._error))
+            if op == 'left':
+                self.workers.pop(worker, None)
+            else:
+                self.workers.setdefault(
+                    worker, _TwoPCWorkerState()).apply(op, txn_id, arg)
+            self._pending.append(record)
+            self._appended += 1
+            self._cond.notify_all()
+            return self._appended
+
+    def wait_durable(self, seq):
+        """
+        Wait until the entry numbered `seq`, and every entry before it,
+        has been fsynced.
+        """
+        with self._cond:
+            while self._durable < seq and self._error is None:
+                self._cond.wait()
+            if self._durable < seq:
+                raise ConnectorError("txn log write failed: {!r}"
+                                     .format(self._error))
+
+    def close(self):
+        """
+        Write out the remaining entries and close the log.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._file.close()
+
+    def _sync_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                seq = self._appended
+                if self._tail_bytes >= self.checkpoint_bytes:
+                    # the checkpoint covers the pending entries as well
+                    batch = None
+                    checkpoint = self._encode_checkpoint()
+                else:
+                    batch = b''.join(self._pending)
+                self._pending = []
+            try:
+                if batch is None:
+                    self._rewrite(checkpoint)
+                else:
+                    self._file.write(batch)
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    self._tail_bytes += len(batch)
+            except EnvironmentError as err:
+                logging.exception("TwoPCTxnLog: write to {} failed"
+                                  .format(self.path))
+                with self._cond:
+                    self._error = err
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._durable = seq
+                self.fsyncs += 1
+                self._cond.notify_all()
+
+    def _rewrite(self, checkpoint=None):
+        """
+        Atomically replace the log with one that holds only `checkpoint`.
+        """
+        if checkpoint is None:
+            checkpoint = self._encode_checkpoint()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.MAGIC + self._record(self.CHECKPOINT, checkpoint))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, 'ab')
+        self._tail_bytes = 0
+        self.checkpoints += 1
+
+    def _replay(self, f):
+        """
+        Restore `workers` from the open log `f` in a single pass, and
+        return the length of its valid prefix.
+        """
+        if f.read(len(self.MAGIC)) != self.MAGIC:
+            raise ConnectorError("{} is not a txn log".format(self.path))
+        valid = len(self.MAGIC)
+        header_size = self._HEADER.size
+        while True:
+            header = f.read(header_size)
+            if len(header) < header_size:
+                break
+            length, crc, kind = self._HEADER.unpack(header)
+            payload = f.read(length)
+            if (len(payload) < length or
+                    zlib.crc32(header[8:] + payload) & 0xffffffff != crc):
+                break
+            if kind == self.CHECKPOINT:
+                self.workers = self._decode_checkpoint(payload)
+                self._tail_bytes = 0
+            else:
+                worker, op, txn_id, arg = self._decode_entry(payload)
+                if op == 'left':
+                    self.workers.pop(worker, None)
+                else:
+                    self.workers.setdefault(
+                        worker, _TwoPCWorkerState()).apply(op, txn_id, arg)
+                self._tail_bytes += header_size + length
+            valid += header_size + length
+        return valid
+
+    ############
+    # Encoding #
+    ############
+
+    @classmethod
+    def _record(cls, kind, payload):
+        crc = zlib.crc32(struct.pack('>B', kind) + payload) & 0xffffffff
+        return cls._HEADER.pack(len(payload), crc, kind) + payload
+
+    @staticmethod
+    def _encode_string(s):
+        bs = s.encode('utf-8')
+        return struct.pack('>H', len(bs)) + bs
+
+    @staticmethod
+    def _encode_where_list(where_list):
+        return (struct.pack('>I', len(where_list)) +
+                b''.join(struct.pack('>QQQ', *w) for w in where_list))
+
+    def _encode_entry(self, worker, op, txn_id, arg):
+        out = [self._encode_string(worker),
+               struct.pack('>B', self._OP_CODES[op]),
+               self._encode_string(txn_id or '')]
+        if op in ('1-ok', '1-rollback'):
+            out.append(self._encode_where_list(arg))
+        elif op in ('2-ok', '2-rollback'):
+            out.append(struct.pack('>Q', arg))
+        return b''.join(out)
+
+    def _encode_checkpoint(self):
+        out = [struct.pack('>I', len(self.workers))]
+        for worker, state in self.workers.items():
+            out.append(self._encode_string(worker))
+            out.append(struct.pack('>QBI', state.committed,
+                                   state.commit_next, len(state.pending)))
+            for txn_id, (vote, where_list) in state.pending.items():
+                out.append(self._encode_string(txn_id))
+                out.append(struct.pack('>B', vote))
+                out.append(self._encode_where_list(where_list))
+        return b''.join(out)
+
+    @staticmethod
+    def _decode_string(reader):
+        length = struct.unpack('>H', reader.read(2))[0]
+        return reader.read(length).decode('utf-8')
+
+    @staticmethod
+    def _decode_where_list(reader):
+        length = struct.unpack('>I', reader.read(4))[0]
+        return [struct.unpack('>QQQ', reader.read(24))
+                for _ in range(length)]
+
+    def _decode_entry(self, payload):
+        reader = io.BytesIO(payload)
+        worker = self._decode_string(reader)
+        op = self._OPS[struct.unpack('>B', reader.read(1))[0]]
+        txn_id = self._decode_string(reader) or None
+        arg = None
+        if op in ('1-ok', '1-rollback'):
+            arg = self._decode_where_list(reader)
+        elif op in ('2-ok', '2-rollback'):
+            arg = struct.unpack('>Q', reader.read(8))[0]
+        return worker, op, txn_id, arg
+
+    def _decode_checkpoint(self, payload):
+        reader = io.BytesIO(payload)
+        workers = {}
+        for _ in range(struct.unpack('>I', reader.read(4))[0]):
+            state = _TwoPCWorkerState()
+            worker = self._decode_string(reader)
+            (state.committed, commit_next,
+             pending) = struct.unpack('>QBI', reader.read(13))
+            state.commit_next = bool(commit_next)
+            for _ in range(pending):
+                txn_id = self._decode_string(reader)
+                vote = bool(struct.unpack('>B', reader.read(1))[0])
+                state.pending[txn_id] = (vote,
+                                         self._decode_where_list(reader))
+            workers[worker] = state
+        return workers
+
+
+class TwoPCSinkConnector(object):
+    """
+    A base for exactly-once sink connectors, which take part in Wallaroo's
+    two-phase commit of every checkpoint.
+
+    Each Wallaroo worker connects once and sends its output as a stream of
+    bytes, numbered by offset. Subclasses write that output to the outside
+    system with the following hooks:
+
+    - `write(worker, offset, data)`: append `data`, which starts at byte
+      `offset` of `worker`'s output.
+    - `prepare(worker, txn_id, where_list)`: make the output up to the end
+      of the transaction durable, without publishing it, and return True
+      to vote commit or False to vote abort. `where_list` is a list of
+      `(stream_id, start_offset, end_offset)`.
+    - `commit(worker, txn_id, where_list)`: publish the transaction's
+      output. After a restart it may be called again for a transaction
+      that was already committed.
+    - `abort(worker, txn_id, where_list)`: discard output from the start of
+      the transaction onwards.
+    - `resume(worker, offset)`: the worker has (re)connected; discard any
+      output after `offset`, where writing continues. [optional]
+    - `worker_closed(worker)` and `workers_left(workers)` [optional]
+
+    The hooks for one worker are called in order on that worker's output
+    thread, never concurrently, but hooks for different workers run in
+    parallel. The protocol thread of a connection only reads and decodes
+    frames, so Wallaroo is not held up by slow output.
+
+    The votes and outcomes of transactions are recorded in a TwoPCTxnLog at
+    `txn_log_path`. A phase 1 vote is only sent to Wallaroo once it is on
+    disk, and votes from all connections are fsynced together.
+    """
+    def __init__(self, cookie, host, port, txn_log_path, credits=500,
+                 max_pending_writes=1024):
+        self._cookie = cookie
+        self._host = host
+        self._port = port
+        self.credits = credits
+        self.max_pending_writes = max_pending_writes
+        self.txn_log = TwoPCTxnLog(txn_log_path)
+        self.params = None
+        self._lock = threading.Lock()
+        self._active = {}  # {worker: _TwoPCConnection}
+        self._acceptor = None
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_args(cls, args=None, required_params=[], optional_params=[],
+                  txn_log_path=None, **kwargs):
+        """
+        Create a connector for the sink connector named by `--connector`
+        in the application given by `--application-module`, taking the
+        host, port and cookie from the application's SinkConnectorConfig.
+        The txn log path may also be given as the `txn_log` param.
+        """
+        optional_params = list(optional_params)
+        if 'txn_log' not in optional_params:
+            optional_params.append('txn_log')
+        params, sink = _find_sink_connector(args, required_params,
+                                            optional_params)
+        (_, _name, host, port, _encoder, _decoder, cookie) = sink
+        txn_log_path = params.txn_log or txn_log_path
+        if txn_log_path is None:
+            txn_log_path = "{}.txnlog".format(params.connector_name)
+        connector = cls(cookie, host, port, txn_log_path, **kwargs)
+        connector.params = params
+        return connector
+
+    def listen(self, host=None, port=None, backlog=5):
+        self.txn_log.load()
+        self._acceptor = _listen_socket(host or self._host,
+                                        port or self._port, backlog)
+
+    def run(self):
+        """
+        Accept connections from Wallaroo workers until `stop()` is called.
+        """
+        if self._acceptor is None:
+            self.listen()
+        while not self._stopped.is_set():
+            readable, _, _ = select([self._acceptor], [], [], 0.5)
+            if readable:
+                conn, _addr = self._acceptor.accept()
+                _TwoPCConnection(self, conn).start()
+        self._acceptor.close()
+        with self._lock:
+            active = list(self._active.values())
+        for connection in active:
+            connection.shutdown()
+            connection.join()
+        self.txn_log.close()
+
+    def stop(self):
+        self._stopped.set()
+
+    ##############
+    # User hooks #
+    ##############
+
+    def resume(self, worker, offset):
+        """
+        Discard any output of `worker` after `offset` [optional]
+        """
+        pass
+
+    def write(self, worker, offset, data):
+        """
+        Append `data` at `offset` of `worker`'s output [required]
+        """
+        raise NotImplementedError
+
+    def prepare(self, worker, txn_id, where_list):
+        """
+        Make the transaction's output durable and vote on it [required]
+        """
+        raise NotImplementedError
+
+    def commit(self, worker, txn_id, where_list):
+        """
+        Publish the transaction's output [required]
+        """
+        raise NotImplementedError
+
+    def abort(self, worker, txn_id, where_list):
+        """
+        Discard the transaction's output [required]
+        """
+        raise NotImplementedError
+
+    def worker_closed(self, worker):
+        """
+        The worker's connection has closed [optional]
+        """
+        pass
+
+    def workers_left(self, workers):
+        """
+        The workers have left the cluster for good [optional]
+        """
+        pass
+
+    ############
+    # Internal #
+    ############
+
+    def _activate(self, worker, connection):
+        with self._lock:
+            if worker in self._active:
+                return None
+            self._active[worker] = connection
+            return self.txn_log.worker(worker)
+
+    def _deactivate(self, worker, connection):
+        with self._lock:
+            if self._active.get(worker) is connection:
+                del self._active[worker]
+
+    def _workers_left(self, workers):
+        with self._lock:
+            gone = [w for w in workers if w in self.txn_log.workers]
+            for worker in gone:
+                self.txn_log.append(worker, 'left')
+            # A connection that is still open for a worker that left holds
+            # state that is no longer in the txn log: close it.
+            closing = [self._active.pop(w) for w in gone if w in self._active]
+        for connection in closing:
+            connection.left = True
+            connection.shutdown()
+        if gone:
+            self.workers_left(gone)
+
+    def _append(self, connection, op, txn_id=None, arg=None):
+        with self._lock:
+            if self._active.get(connection.worker) is not connection:
+                raise ConnectorError("worker {} has left"
+                                     .format(connection.worker))
+            return self.txn_log.append(connection.worker, op, txn_id, arg)
+
+
+class _TwoPCConnection(threading.Thread):
+    """
+    One Wallaroo worker's connection to a TwoPCSinkConnector. This thread
+    reads and decodes frames; a second thread runs `_output_loop`, which
+    calls the connector's hooks in the order the frames arrived.
+    """
+    def __init__(self, connector, sock):
+        super(_TwoPCConnection, self).__init__()
+        self.daemon = True
+        self.connector = connector
+        self.sock = sock
+        self.worker = None
+        self.state = None
+        self.offset = 0
+        # set once the worker has left the cluster
+        self.left = False
+        self._ops = queue.Queue(maxsize=connector.max_pending_writes)
+        self._send_lock = threading.Lock()
+        self._output = None
+
+    def run(self):
+        try:
+            if self._handshake():
+                self._output = threading.Thread(target=self._output_loop)
+                self._output.daemon = True
+                self._output.start()
+                self._read_loop()
+        except Exception:
+            logging.exception("TwoPCSinkConnector: connection from {} failed"
+                              .format(self.worker))
+        finally:
+            self.shutdown()
+            if self._output is not None:
+                self._ops.put(None)
+                self._output.join()
+            if self.state is not None:
+                self.connector._deactivate(self.worker, self)
+                self.connector.worker_closed(self.worker)
+            self.sock.close()
+
+    def shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def _handshake(self):
+        msg = self._read_frame()
+        if not isinstance(msg, cwm.Hello):
+            raise ProtocolError("expected Hello, got {}".format(msg))
+        if msg.cookie != self.connector._cookie:
+            self._send(cwm.Error("bad cookie"))
+            return False
+        self.worker = msg.instance_name
+        self.state = self.connector._activate(self.worker, self)
+        if self.state is None:
+            self._send(cwm.Error("worker {} is already connected"
+                                 .format(self.worker)))
+            return False
+        self.offset = self.state.resume_offset()
+        logging.info("TwoPCSinkConnector: worker {} resumes at offset {}"
+                     .format(self.worker, self.offset))
+        self.connector.resume(self.worker, self.offset)
+        self._send(cwm.Ok(self.connector.credits))
+        return True
+
+    def _read_loop(self):
+        while True:
+            msg = self._read_frame()
+            if msg is None:
+                return
+            if isinstance(msg, cwm.Message):
+                if msg.stream_id == 0:
+                    self._ops.put(('twopc', cwm.TwoPCFrame.decode(msg.message)))
+                else:
+                    self._ops.put(('write', msg.message_id,
+                                   msg.message or b''))
+            elif isinstance(msg, (cwm.Notify, cwm.EosMessage)):
+                self._ops.put(('stream', msg))
+            elif isinstance(msg, cwm.Error):
+                logging.error("TwoPCSinkConnector: worker {} sent an error: "
+                              "{}".format(self.worker, msg.message))
+                return
+            else:
+                self._send(cwm.Error("unexpected message: {}".format(msg)))
+                raise ProtocolError("{} should never be received at the "
+                                    "sink".format(msg))
+
+    def _read_frame(self):
+        header = self._recv_exactly(4)
+        if header is None:
+            return None
+        frame = self._recv_exactly(cwm.Frame.read_header(header))
+        if frame is None:
+            return None
+        return cwm.Frame.decode(frame)
+
+    def _recv_exactly(self, n):
+        chunks = []
+        while n > 0:
+            chunk = self.sock.recv(min(n, 1024 * 1024))
+            if not chunk:
+                return None
+            chunks.append(chunk)
+            n -= len(chunk)
+        return b''.join(chunks)
+
+    def _send(self, msg):
+        with self._send_lock:
+            self.sock.sendall(cwm.Frame.encode(msg))
+
+    def _send_twopc(self, msg):
+        self._send(cwm.Message(0, 0, 0, None, cwm.TwoPCFrame.encode(msg)))
+
+    #################
+    # Output thread #
+    #################
+
+    def _output_loop(self):
+        try:
+            while True:
+                op = self._ops.get()
+                if op is None:
+                    return
+                if self.left:
+                    continue  # drop output queued before the worker left
+                if op[0] == 'write':
+                    self._write(op[1], op[2])
+                elif op[0] == 'stream':
+                    self._stream(op[1])
+                else:
+                    self._twopc(op[1])
+        except Exception as err:
+            logging.exception("TwoPCSinkConnector: output for worker {} "
+                              "failed".format(self.worker))
+            try:
+                self._send(cwm.Error("sink failed: {!r}".format(err)))
+            except socket.error:
+                pass
+            self.shutdown()
+            # let the protocol thread finish
+            while self._ops.get() is not None:
+                pass
+
+    def _write(self, offset, data):
+        if offset > self.offset:
+            # Output is missing, e.g. after a reconnect: the transaction
+            # cannot commit, and Wallaroo will roll back and resend it.
+            if self.state.commit_next:
+                logging.warning("TwoPCSinkConnector: worker {} skipped from "
+                                "offset {} to {}".format(self.worker,
+                                                         self.offset, offset))
+                self.connector._append(self, 'next-txn-force-abort')
+            return
+        if offset + len(data) <= self.offset:
+            return  # already written
+        if offset < self.offset:
+            data = data[self.offset - offset:]
+            offset = self.offset
+        self.connector.write(self.worker, offset, data)
+        self.offset += len(data)
+
+    def _stream(self, msg):
+        if isinstance(msg, cwm.Notify):
+            self._send(cwm.NotifyAck(True, msg.stream_id, self.offset))
+        else:
+            self._send(cwm.Ack(1, [(msg.stream_id, self.offset)]))
+
+    def _twopc(self, msg):
+        connector = self.connector
+        if isinstance(msg, cwm.ListUncommitted):
+            self._send_twopc(cwm.ReplyUncommitted(
+                msg.rtag, sorted(self.state.pending)))
+        elif isinstance(msg, cwm.TwoPCPhase1):
+            vote = self._prepare(msg.txn_id, msg.where_list)
+            seq = connector._append(self, '1-ok' if vote else '1-rollback',
+                                    msg.txn_id, msg.where_list)
+            connector.txn_log.wait_durable(seq)
+            self._send_twopc(cwm.TwoPCReply(msg.txn_id, vote))
+        elif isinstance(msg, cwm.TwoPCPhase2):
+            self._finish(msg.txn_id, msg.commit)
+        elif isinstance(msg, cwm.WorkersLeft):
+            connector._workers_left(msg.leaving_workers)
+        else:
+            raise ProtocolError("{} should never be received at the sink"
+                                .format(msg))
+
+    def _prepare(self, txn_id, where_list):
+        if not self.state.commit_next:
+            return False
+        if len(where_list) != 1:
+            logging.error("TwoPCSinkConnector: {}: unsupported where_list {}"
+                          .format(txn_id, where_list))
+            return False
+        (_stream_id, start, end) = where_list[0]
+        if start != self.state.committed or start > end or end > self.offset:
+            # e.g. the first transaction after a restart, which
+            # Wallaroo will abort anyway
+            logging.warning("TwoPCSinkConnector: {}: offsets {}-{} do not "
+                            "follow committed offset {} and output offset {}"
+                            .format(txn_id, start, end, self.state.committed,
+                                    self.offset))
+            return False
+        try:
+            return bool(self.connector.prepare(self.worker, txn_id,
+                                               where_list))
+        except Exception:
+            logging.exception("TwoPCSinkConnector: prepare of {} failed"
+                              .format(txn_id))
+            return False
+
+    def _finish(self, txn_id, commit):
+        if txn_id not in self.state.pending:
+            logging.warning("TwoPCSinkConnector: phase 2 for unknown "
+                            "transaction {}".format(txn_id))
+            return
+        vote, where_list = self.state.pending[txn_id]
+        connector = self.connector
+        if commit:
+            if not vote:
+                raise ProtocolError("phase 2 commits {}, which voted to "
+                                    "abort".format(txn_id))
+            connector.commit(self.worker, txn_id, where_list)
+            connector._append(self, '2-ok', txn_id,
+                              max(end for _, _, end in where_list))
+        else:
+            connector.abort(self.worker, txn_id, where_list)
+            start = min(start for _, start, _ in where_list)
+            self.offset = min(self.offset, start)
+            connector._append(self, '2-rollback', txn_id, start)
+        # Phase 2 needs no reply: if the record is lost in a crash the
+        # transaction is reported uncommitted and Wallaroo repeats it.
+
+
 class UnexpectedSocketError(Exception):
     pass
 
@@ -923,6 +2111,20 @@ def parse_connector_args(args, required_params=[], optional_params=[]):
     return params
 
 
+def _find_sink_connector(args, required_params, optional_params):
+    params = parse_connector_args(args or sys.argv, required_params, optional_params)
+    wallaroo_mod = __import__(params.application)
+    application = wallaroo_mod.application_setup(args or sys.argv)
+    sink = None
+    for stage in application[2]:
+        for step in stage:
+            if step[0] == 'to_sink' and step[1][0] == 'sink_connector' and step[1][1] == params.connector_name:
+                sink = step[1]
+    if sink is None:
+        raise RuntimeError("Unable to find a sink connector with the name " + params.connector_name)
+    return params, sink
+
+
 def _parse_connector_prefix(args):
     parser = argparse.ArgumentParser()
     parser.add_argument('--connector', dest='connector_name')
@@ -2,6 +2,7 @@ from __future__ import unicode_literals
 import struct
 import itertools
 import logging
+import zlib
 
 try:
     from StringIO import StringIO
@@ -9,28 +10,43 @@ except ImportError:
     from io import BytesIO as StringIO
 
 
+# Codecs that may be negotiated for MessageBlock: name -> (compress,
+# decompress). The worker only accepts zlib.
+COMPRESSION_CODECS = {'zlib': (zlib.compress, zlib.decompress)}
+
+# The largest uncompressed MessageBlock a worker accepts
+MAX_MESSAGE_BLOCK_SIZE = 16 * 1024 * 1024
+
+
 class Hello(object):
     """
     Hello(version: String, cookie: String, program_name: String,
-          instance_name: String)
+          instance_name: String, compression: [String])
+
+    `compression` lists the codecs the connector can use for MessageBlock
+    frames, in order of preference. It is only encoded when it is not
+    empty, so workers that predate it still accept the Hello.
     """
-    def __init__(self, version, cookie, program_name, instance_name):
+    def __init__(self, version, cookie, program_name, instance_name,
+                 compression=()):
         self.version = version
         self.cookie = cookie
         self.program_name = program_name
         self.instance_name = instance_name
+        self.compression = list(compression)
 
     def __str__(self):
         return ("Hello(version={!r}, cookie={!r}, program_name={!r}, "
-                "instance_name={!r})"
+                "instance_name={!r}, compression={!r})"
                 .format(self.version, self.cookie, self.program_name,
-                        self.instance_name))
+                        self.instance_name, self.compression))
 
     def __eq__(self, other):
         return (self.version == other.version and
                 self.cookie == other.cookie and
                 self.program_name == other.program_name and
-                self.instance_name == other.instance_name)
+                self.instance_name == other.instance_name and
+                self.compression == other.compression)
 
     def encode(self):
         v, c, p, i = map(lambda x: x.encode(),
@@ -38,12 +54,17 @@ class Hello(object):
                           self.cookie,
                           self.program_name,
                           self.instance_name))
-        return struct.pack(">H{}sH{}sH{}sH{}s"
-                           .format(*map(len, (v, c, p, i))),
-                           len(v), v,
-                           len(c), c,
-                           len(p), p,
-                           len(i), i)
+        encoded = struct.pack(">H{}sH{}sH{}sH{}s"
+                              .format(*map(len, (v, c, p, i))),
+                              len(v), v,
+                              len(c), c,
+                              len(p), p,
+                              len(i), i)
+        if self.compression:
+            codecs = [codec.encode() for codec in self.compression]
+            encoded += struct.pack(">H", len(codecs)) + b''.join(
+                struct.pack(">H", len(codec)) + codec for codec in codecs)
+        return encoded
 
     @staticmethod
     def decode(bs):
@@ -56,7 +77,14 @@ class Hello(object):
         program_name = reader.read(program_name_length).decode()
         instance_name_length = struct.unpack(">H", reader.read(2))[0]
         instance_name = reader.read(instance_name_length).decode()
-        return Hello(version, cookie, program_name, instance_name)
+        compression = []
+        count = reader.read(2)
+        if count:
+            for _ in range(struct.unpack(">H", count)[0]):
+                codec_length = struct.unpack(">H", reader.read(2))[0]
+                compression.append(reader.read(codec_length).decode())
+        return Hello(version, cookie, program_name, instance_name,
+                     compression)
 
 
 def test_hello():
@@ -75,31 +103,51 @@ def test_hello():
     assert(decoded.instance_name == instance)
     assert(hello == decoded)
     assert(str(hello) == str(decoded))
+    hello = Hello(version, cookie, program, instance, ["lz4", "zlib"])
+    encoded = hello.encode()
+    assert(len(encoded) == 12 + 2 + 5 + 6)
+    decoded = Hello.decode(encoded)
+    assert(decoded.compression == ["lz4", "zlib"])
+    assert(hello == decoded)
 
 
 class Ok(object):
     """
-    Ok(initial_credits: U32)
+    Ok(initial_credits: U32, compression: (String | None))
 
+    `compression` is the codec the worker picked from Hello.compression, or
+    None if MessageBlock frames must not be sent.
    """
-    def __init__(self, initial_credits):
+    def __init__(self, initial_credits, compression=None):
         self.initial_credits = initial_credits
+        self.compression = compression
 
     def __str__(self):
-        return ("Ok(initial_credits={!r})"
-                .format(self.initial_credits))
+        return ("Ok(initial_credits={!r}, compression={!r})"
+                .format(self.initial_credits, self.compression))
 
     def __eq__(self, other):
-        return (self.initial_credits == other.initial_credits)
+        return (self.initial_credits == other.initial_credits and
+                self.compression == other.compression)
 
     def encode(self):
-        return (struct.pack('>I', self.initial_credits))
+        encoded = struct.pack('>I', self.initial_credits)
+        if self.compression:
+            codec = self.compression.encode()
+            encoded += struct.pack('>H{}s'.format(len(codec)),
+                                   len(codec), codec)
+        return encoded
 
     @staticmethod
     def decode(bs):
         reader = StringIO(bs)
         initial_credit = struct.unpack(">I", reader.read(4))[0]
-        return Ok(initial_credit)
+        compression = None
+        codec_length = reader.read(2)
+        if codec_length:
+            compression = reader.read(
+                struct.unpack(">H", codec_length)[0]).decode() or None
+        return Ok(initial_credit, compression)
 
 
 def test_ok():
@@ -113,6 +161,10 @@ def test_ok():
     assert(decoded.initial_credits == ic)
     assert(decoded == ok)
     assert(str(decoded) == str(ok))
+    ok = Ok(ic, "zlib")
+    decoded = Ok.decode(ok.encode())
+    assert(decoded.compression == "zlib")
+    assert(decoded == ok)
 
 
 class Error(object):
@@ -435,6 +487,71 @@ def test_eos_message():
     assert(isinstance(decoded, EosMessage))
     assert(decoded.stream_id == msg.stream_id)
 
+class MessageBlock(object):
+    """
+    MessageBlock(size: U32, data: bytes)
+
+    Consecutive Message frames, each with its length header, compressed
+    together with the codec negotiated in Hello/Ok. `size` is their
+    uncompressed length. Each Message in the block costs one credit; the
+    block itself costs none.
+    """
+    def __init__(self, size, data):
+        self.size = size
+        self.data = data
+
+    def __str__(self):
+        return ("MessageBlock(size={!r}, compressed_size={!r})"
+                .format(self.size, len(self.data)))
+
+    def __eq__(self, other):
+        return (self.size == other.size and
+                self.data == other.data)
+
+    @classmethod
+    def compress(cls, frames, codec='zlib'):
+        """
+        Build a block from Message frames as returned by Frame.encode.
+        """
+        raw = b''.join(frames)
+        return cls(len(raw), COMPRESSION_CODECS[codec][0](raw))
+
+    def messages(self, codec='zlib'):
+        raw = COMPRESSION_CODECS[codec][1](self.data)
+        if len(raw) != self.size:
+            raise ValueError("MessageBlock decompressed to {} bytes, "
+                             "expected {}".format(len(raw), self.size))
+        messages = []
+        offset = 0
+        while offset < len(raw):
+            length = Frame.read_header(raw[offset:offset + 4])
+            messages.append(Frame.decode(raw[offset + 4:offset + 4 + length]))
+            offset += 4 + length
+        return messages
+
+    def encode(self):
+        return struct.pack('>I', self.size) + self.data
+
+    @classmethod
+    def decode(cls, bs):
+        size = struct.unpack('>I', bs[:4])[0]
+        return cls(size, bs[4:])
+
+
+def test_message_block():
+    msgs = [Message(1, i, 0, None, b"the same message, over and over again")
+            for i in range(100)]
+    frames = [Frame.encode(msg) for msg in msgs]
+    block = MessageBlock.compress(frames)
+    assert(block.size == sum(map(len, frames)))
+    assert(len(block.data) < block.size)
+    encoded = Frame.encode(block)
+    decoded = Frame.decode(encoded[4:])
+    assert(isinstance(decoded, MessageBlock))
+    assert(decoded == block)
+    assert(decoded.messages() == msgs)
+
+
 class Ack(object):
     """
     Ack(credits: U32, acks: Array[(stream_id: U64, point_of_ref: U64)]
@@ -537,7 +654,8 @@ class Frame(object):
                           (5, Message),
                           (6, Ack),
                           (7, Restart),
-                          (8, EosMessage)]
+                          (8, EosMessage),
+                          (10, MessageBlock)]
     _FRAME_TYPE_MAP = dict([(v, t) for v, t in _FRAME_TYPE_TUPLES] +
                            [(t, v) for v, t in _FRAME_TYPE_TUPLES])
 
@@ -628,16 +746,16 @@ class ReplyUncommitted(object):
     @staticmethod
     def decode(bs):
         reader = StringIO(bs)
-        credits = struct.unpack(">I", reader.read(4))[0]
-        acks_length = struct.unpack(">I", reader.read(4))[0]
-        acks = []
-        for _ in range(acks_length):
-            stream_id = struct.unpack(">Q", reader.read(8))[0]
-            point_of_ref = struct.unpack(">Q", reader.read(8))[0]
-            acks.append((stream_id, point_of_ref))
-        return Ack(credits, acks)
+        rtag, length = struct.unpack(">QI", reader.read(12))
+        txn_ids = []
+        for _ in range(length):
+            txn_id_length = struct.unpack(">H", reader.read(2))[0]
+            txn_ids.append(reader.read(txn_id_length).decode())
+        return ReplyUncommitted(rtag, txn_ids)
 
 def encode_phase2r(txn_id, commit):
+    if not isinstance(txn_id, bytes):
+        txn_id = txn_id.encode("utf-8")
     if commit:
         commit_c = b'\01'
     else:
@@ -675,10 +793,11 @@ class TwoPCPhase1(object):
                 self.where_list == other.where_list)
 
     def encode(self):
+        txn_id = self.txn_id.encode("utf-8")
         return (struct.pack(">H{}sI".format(len(txn_id)),
                             len(txn_id),
                             txn_id,
-                            len(where_list)) +
+                            len(self.where_list)) +
                     b''.join((
                         struct.pack('>QQQ',
                             stream_id, start_por, end_por)
@@ -810,18 +929,18 @@ class TwoPCFrame(object):
 
 def _test_twopcframe_encode_decode(msg):
     framed = TwoPCFrame.encode(msg)
-    decoded = TwoPCFrame.decode(framed[4:])
+    decoded = TwoPCFrame.decode(framed)
     assert(decoded == msg)
 
-def test_frame():
-    assert(Frame.read_header(struct.pack('>I', 50)) == 50)
+def test_twopc_frame():
     msgs = []
-    #msgs.append(ListUncommitted(77))
-    #msgs.append(ReplyUncommitted(...))
-    #msgs.append(TwoPCPhase1(...))
-    #msgs.append(TwoPCReply(...))
-    #msgs.append(TwoPCPhase2(...))
-    #msgs.append(TwoPCPhase1(...))
+    msgs.append(ListUncommitted(77))
+    msgs.append(ReplyUncommitted(77, []))
+    msgs.append(ReplyUncommitted(78, ["txn-1", "txn-2"]))
+    msgs.append(TwoPCPhase1("txn-1", [(1, 0, 4000)]))
+    msgs.append(TwoPCReply("txn-1", True))
+    msgs.append(TwoPCPhase2("txn-1", False))
+    msgs.append(WorkersLeft(79, ["worker1", "worker2"]))
 
     for msg in msgs:
-        _test_frame_encode_decode(msg)
+        _test_twopcframe_encode_decode(msg)
@@ -1,9 +1,15 @@
 import hashlib
 import logging
 import math
+import os
+from select import select
+import socket
+import struct
 from struct import unpack
 import sys
+import threading
 import time
+import zlib
 
 
 from . import (connector_wire_messages as cwm,
@@ -171,13 +177,306 @@ class FramedFileReader(BaseIter, BaseSource):
         except:
             pass
 
+class TokenBucket(object):
+    """
+    A token bucket that refills at `rate` tokens/sec and holds at most
+    `burst` tokens (default: one second's worth).
+
+    A request for more tokens than `burst` is granted once the bucket is
+    full and leaves it in debt, so oversized records are never starved and
+    the long-run rate stays exact.
+
+    TokenBucket is not thread-safe on its own; see `Pacer`.
+    """
+    def __init__(self, rate, burst=None, clock=time.time):
+        self._clock = clock
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.tokens = self.burst
+        self._last = clock()
+
+    def __str__(self):
+        return ("TokenBucket(rate: {}, burst: {}, tokens: {})"
+                .format(self.rate, self.burst, self.tokens))
+
+    def _refill(self, now):
+        elapsed = now - self._last
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self._last = now
+
+    def wait_time(self, n, now=None):
+        """
+        Return the number of seconds until `n` tokens can be taken.
+        """
+        self._refill(self._clock() if now is None else now)
+        need = min(n, self.burst)
+        if self.tokens >= need:
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (need - self.tokens) / self.rate
+
+    def take(self, n):
+        """
+        Take `n` tokens unconditionally. Call `wait_time(n)` first.
+        """
+        self.tokens -= n
+
+    def adjust(self, rate=None, burst=None):
+        self._refill(self._clock())
+        if rate is not None:
+            self.rate = float(rate)
+        if burst is not None:
+            self.burst = float(burst)
+        self.tokens = min(self.tokens, self.burst)
+
+
+class Pacer(object):
+    """
+    A thread-safe rate limiter combining an optional bytes/sec and an
+    optional records/sec token bucket.
+
+    Usage: `Pacer(bytes_per_sec=1000000, records_per_sec=5000)`.
+    A limit of `None` means unlimited. Burst sizes default to one second's
+    worth of the corresponding rate. Limits may be changed at any time with
+    `adjust(...)`, e.g. from a `PacerControl` socket.
+    A single Pacer may be shared by several `PacedSource`s to limit their
+    aggregate rate.
+    """
+    SETTINGS = ('bytes_per_sec', 'records_per_sec',
+                'burst_bytes', 'burst_records')
+
+    def __init__(self, bytes_per_sec=None, records_per_sec=None,
+                 burst_bytes=None, burst_records=None, clock=time.time):
+        self._lock = threading.Lock()
+        self._clock = clock
+        self._bytes = None
+        self._records = None
+        self.adjust(bytes_per_sec=bytes_per_sec,
+                    records_per_sec=records_per_sec,
+                    burst_bytes=burst_bytes,
+                    burst_records=burst_records)
+
+    def __str__(self):
+        return " ".join("{}={}".format(k, v)
+                        for k, v in sorted(self.settings().items()))
+
+    def now(self):
+        """
+        The current time on the pacer's clock.
+        """
+        return self._clock()
+
+    def settings(self):
+        with self._lock:
+            b, r = self._bytes, self._records
+            return {'bytes_per_sec': b.rate if b else None,
+                    'records_per_sec': r.rate if r else None,
+                    'burst_bytes': b.burst if b else None,
+                    'burst_records': r.burst if r else None}
+
+    def adjust(self, **settings):
+        """
+        Update one or more of `bytes_per_sec`, `records_per_sec`,
+        `burst_bytes` and `burst_records`. Setting a rate to `None` removes
+        that limit.
+        """
+        unknown = set(settings) - set(self.SETTINGS)
+        if unknown:
+            raise ValueError("Unknown pacer settings: {}"
+                             .format(", ".join(sorted(unknown))))
+        with self._lock:
+            self._bytes = self._adjust_bucket(
+                self._bytes, settings, 'bytes_per_sec', 'burst_bytes')
+            self._records = self._adjust_bucket(
+                self._records, settings, 'records_per_sec', 'burst_records')
+
+    def _adjust_bucket(self, bucket, settings, rate_key, burst_key):
+        if rate_key in settings and settings[rate_key] is None:
+            return None
+        rate = settings.get(rate_key)
+        burst = settings.get(burst_key)
+        if bucket is None:
+            if rate is None:
+                return None
+            return TokenBucket(rate, burst, clock=self._clock)
+        bucket.adjust(rate, burst)
+        return bucket
+
+    def try_consume(self, nbytes, nrecords=1):
+        """
+        Consume `nbytes` and `nrecords` if both limits allow it and return
+        0.0, otherwise consume nothing and return the number of seconds to
+        wait before trying again.
+        """
+        with self._lock:
+            now = self._clock()
+            wait = 0.0
+            if self._bytes is not None:
+                wait = max(wait, self._bytes.wait_time(nbytes, now))
+            if self._records is not None:
+                wait = max(wait, self._records.wait_time(nrecords, now))
+            if wait > 0:
+                return wait
+            if self._bytes is not None:
+                self._bytes.take(nbytes)
+            if self._records is not None:
+                self._records.take(nrecords)
+            return 0.0
+
+
+class PacedSource(BaseIter, BaseSource):
+    """
+    Wrap any BaseSource so that it emits records no faster than `pacer`
+    allows.
+
+    Usage: `PacedSource(FramedFileReader(filename), Pacer(records_per_sec=100))`
+
+    When the pacer has no tokens to spare, the record that was read is held
+    back and `(None, None)` is returned, which MultiSourceConnector treats
+    as "nothing to send yet". `ready_at()` reports when the held record may
+    be sent, so the connector can sleep until then instead of polling.
+    """
+    def __init__(self, source, pacer):
+        self.source = source
+        self.pacer = pacer
+        self.name = source.name
+        self.key = source.key
+        self._pending = None
+        self._ready_at = 0
+
+    def __str__(self):
+        return "PacedSource(source: {}, pacer: {})".format(self.source,
+                                                          self.pacer)
+
+    def point_of_ref(self):
+        return self.source.point_of_ref()
+
+    def reset(self, pos=0):
+        self._pending = None
+        self._ready_at = 0
+        self.source.reset(pos)
+
+    def ready_at(self):
+        """
+        The time at which the held-back record may be sent, or 0 if the
+        source is not currently throttled.
+        """
+        return self._ready_at if self._pending is not None else 0
+
+    def __next__(self):
+        if self._pending is None:
+            self._pending = next(self.source)
+        value, point_of_ref = self._pending
+        if value is not None:
+            wait = self.pacer.try_consume(len(value))
+            if wait > 0:
+                self._ready_at = self.pacer.now() + wait
+                return (None, None)
+        self._pending = None
+        return (value, point_of_ref)
+
+    def wallaroo_acked(self, point_of_ref):
+        self.source.wallaroo_acked(point_of_ref)
+
+    def close(self):
+        self.source.close()
+
+
+class PacerControl(threading.Thread):
+    """
+    A line-oriented TCP control socket for adjusting a Pacer while the
+    connector is running.
+
+    Commands:
+        `get`                   reply with the current settings
+        `set key=value ...`     update settings; `none` removes a limit
+
+    Every command is answered with a single line starting with `ok` or
+    `error`. For example:
+    ```
+    $ echo "set records_per_sec=500 burst_records=50" | nc 127.0.0.1 7200
+    ok burst_bytes=None burst_records=50.0 bytes_per_sec=None records_per_sec=500.0
+    ```
+    """
+    def __init__(self, pacer, host='127.0.0.1', port=0):
+        super(PacerControl, self).__init__()
+        self.daemon = True
+        self.pacer = pacer
+        self._acceptor = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._acceptor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._acceptor.bind((host, int(port)))
+        self._acceptor.listen(5)
+        self.address = self._acceptor.getsockname()
+        self._buffers = {}
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                conns = [self._acceptor] + list(self._buffers)
+                readable, _, _ = select(conns, [], [], 0.1)
+                for conn in readable:
+                    if conn is self._acceptor:
+                        c, _addr = conn.accept()
+                        self._buffers[c] = b''
+                    else:
+                        self._read(conn)
+        finally:
+            for conn in list(self._buffers):
+                conn.close()
+            self._acceptor.close()
+
+    def _read(self, conn):
+        try:
+            data = conn.recv(4096)
+        except socket.error:
+            data = b''
+        if not data:
+            del self._buffers[conn]
+            conn.close()
+            return
+        buffered = self._buffers[conn] + data
+        lines = buffered.split(b'\n')
+        self._buffers[conn] = lines.pop()
+        for line in lines:
+            reply = self.handle_command(line.decode().strip())
+            conn.sendall((reply + '\n').encode())
+
+    def handle_command(self, line):
+        parts = line.split()
+        if not parts:
+            return "error empty command"
+        try:
+            if parts[0] == 'get':
+                pass
+            elif parts[0] == 'set':
+                settings = {}
+                for kv in parts[1:]:
+                    k, v = kv.split('=', 1)
+                    settings[k] = (None if v.lower() == 'none'
+                                   else float(v))
+                self.pacer.adjust(**settings)
+            else:
+                return "error unknown command {!r}".format(parts[0])
+        except ValueError as err:
+            return "error {}".format(err)
+        logging.info("PacerControl: {}".format(line))
+        return "ok {}".format(self.pacer)
+
+
 class ThrottledFileReader(BaseIter, BaseSource):
     """
     An throttled ile reader iterator with a resettable position, capable
     of reading files with records delimited by:
       * length-framed data
       * ASCII data separated by newlines
-    The throttle's units for `limit_rate` units are bytes/sec.
+    The throttle's units for `limit_rate` units are bytes/sec, with bursts
+    of up to one second's worth of data.
     Exactly one of `is_framed` and `is_text_lines` must be true.
     """
     def __init__(self, filename,
@@ -190,9 +489,8 @@ class ThrottledFileReader(BaseIter, BaseSource):
         self.is_text_lines = is_text_lines
         self.last_acked = None
         self.count = 0
-        self.time_1st_iter = None
-        self.bytes_read = 0
-        self.buf = ""
+        self.bucket = TokenBucket(limit_rate)
+        self._ready_at = 0
 
     def __str__(self):
         return ("FramedFileReader(filename: {}, closed: {}, point_of_ref: {})"
@@ -214,18 +512,20 @@ class ThrottledFileReader(BaseIter, BaseSource):
                     .format(self.__str__(), self.point_of_ref(), pos))
         self.file.seek(pos)
 
+    def ready_at(self):
+        return self._ready_at
+
     def __next__(self):
         self.count = self.count + 1
-        now = time.time()
-
-        if self.count == 1:
-            self.time_1st_iter = now
 
-        read_rate = self.bytes_read / max(0.000001, now - self.time_1st_iter)
-        if read_rate > self.limit_rate:
+        # The size of the next record isn't known until it is read, so wait
+        # for a positive balance and let the record overdraw the bucket.
+        wait = self.bucket.wait_time(1)
+        if wait > 0:
             # We need to "yield" by returning None occasionaly in order to
             # permit MultiSourceConnector to perform it's sleep & re-try
             # goop for this iterator.
+            self._ready_at = time.time() + wait
             return (None, self.file.tell())
 
         read_offset = self.file.tell()
@@ -241,17 +541,7 @@ class ThrottledFileReader(BaseIter, BaseSource):
         if not b:
             raise StopIteration
 
-        ## Roughly every minute, reset our basis for calculating the
-        ## sending rate. Otherwise the amount of elapsed time can
-        ## get big enough to make an issue out of floating point
-        ## rounding error?  In the event that single framed messages
-        ## or ASCII lines are bigger than this factor, then our
-        ## throttle's effectiveness will be hurt.
-        if self.bytes_read > (self.limit_rate * 60):
-            self.bytes_read = 0
-            self.time_1st_iter = now - 0.001
-
-        self.bytes_read += len(b)
+        self.bucket.take(len(b))
         ##logging.debug("__next__ b = {}".format(b))
         return (b, read_offset)
 
@@ -267,6 +557,146 @@ class ThrottledFileReader(BaseIter, BaseSource):
         except:
             pass
 
+class PointOfRefStore(object):
+    """
+    A local, append-only record of the streams of a MultiSourceConnector:
+    for every stream id, its name, the last point of reference Wallaroo
+    acked and whether the stream has been closed.
+
+    Updates are buffered and written by a background thread, with one
+    fsync every `sync_interval` seconds at most. An update lost in a crash
+    only means that a source starts a little further back, or that a
+    finished source is sent again, and Wallaroo discards what it has
+    already seen. Each record carries a CRC32, and a torn record at the end
+    of the file is cut off on load. The file is rewritten with one record
+    per stream once it holds `compact_ratio` times as many records as
+    there are streams.
+    """
+    _RECORD = struct.Struct('>QQBH')
+
+    def __init__(self, path, sync_interval=0.1, compact_ratio=4):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.compact_ratio = compact_ratio
+        self.streams = {}  # {stream_id: (name, point_of_ref, closed)}
+        self._records = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._load()
+        self._file = open(self.path, 'ab')
+        self._thread = threading.Thread(target=self._sync_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __str__(self):
+        return ("PointOfRefStore(path: {}, streams: {}, records: {})"
+                .format(self.path, len(self.streams), self._records))
+
+    def get(self, stream_id):
+        """
+        Return `(name, point_of_ref, closed)` for `stream_id`, or None.
+        """
+        with self._lock:
+            return self.streams.get(stream_id)
+
+    def update(self, stream_id, name, point_of_ref, closed=False):
+        with self._lock:
+            entry = (name, point_of_ref, closed)
+            if self.streams.get(stream_id) != entry:
+                self.streams[stream_id] = entry
+                self._pending[stream_id] = entry
+                self._wakeup.set()
+
+    def close(self):
+        """
+        Write out pending updates and close the store.
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._file.close()
+
+    def _sync_loop(self):
+        while True:
+            self._wakeup.wait()
+            stopped = self._stopped.is_set()
+            if not stopped:
+                # let updates accumulate into one write and fsync
+                time.sleep(self.sync_interval)
+            with self._lock:
+                self._wakeup.clear()
+                pending, self._pending = self._pending, {}
+                compact = (self._records + len(pending) >
+                           self.compact_ratio * max(len(self.streams), 16))
+                if compact:
+                    pending = dict(self.streams)
+            try:
+                if compact:
+                    self._rewrite(pending)
+                elif pending:
+                    self._file.write(self._encode(pending))
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    self._records += len(pending)
+            except EnvironmentError:
+                logging.exception("PointOfRefStore: write to {} failed"
+                                  .format(self.path))
+            if stopped:
+                return
+            if self._stopped.is_set():
+                # close() raced with this pass: make one final pass
+                self._wakeup.set()
+
+    def _rewrite(self, streams):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self._encode(streams))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self._file.close()
+        self._file = open(self.path, 'ab')
+        self._records = len(streams)
+
+    def _encode(self, streams):
+        out = []
+        for stream_id, (name, point_of_ref, closed) in streams.items():
+            body = self._RECORD.pack(stream_id, point_of_ref, closed,
+                                     len(name)) + name
+            out.append(struct.pack('>I', zlib.crc32(body) & 0xffffffff))
+            out.append(body)
+        return b''.join(out)
+
+    def _load(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return
+        with f:
+            data = f.read()
+        pos = 0
+        size = self._RECORD.size
+        while pos + 4 + size <= len(data):
+            crc = struct.unpack('>I', data[pos:pos + 4])[0]
+            stream_id, point_of_ref, closed, name_length = self._RECORD.unpack(
+                data[pos + 4:pos + 4 + size])
+            end = pos + 4 + size + name_length
+            body = data[pos + 4:end]
+            if end > len(data) or zlib.crc32(body) & 0xffffffff != crc:
+                break
+            self.streams[stream_id] = (body[size:], point_of_ref,
+                                       bool(closed))
+            self._records += 1
+            pos = end
+        if pos != len(data):
+            logging.warning("PointOfRefStore: discarding a torn record at "
+                            "offset {} of {}".format(pos, self.path))
+            with open(self.path, 'r+b') as f:
+                f.truncate(pos)
+
+
 class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
     """
     MultiSourceConnector
@@ -298,9 +728,24 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
     client.join()
     print("Reached the end of all files. Shutting down.")
     ```
+
+    Sources that expose a `ready_at()` method (e.g. `PacedSource`) tell the
+    connector when they will next have data. While every open source is
+    waiting on its pacer, the connector blocks in select() until the
+    earliest of those times instead of polling.
+
+    If `por_store` is given, the acked point of reference of every stream,
+    and whether it has finished, is kept in a PointOfRefStore at that path.
+    After a restart, `add_source` positions each source at its stored point
+    of reference before notifying Wallaroo, and skips sources whose stream
+    had already finished.
     """
+    # Upper bound on how long to block while all sources are paced, so that
+    # newly added sources and pacer adjustments are noticed promptly.
+    max_paced_wait = 0.05
+
     def __init__(self, version, cookie, program_name, instance_name, host,
-                 port, delay=0):
+                 port, delay=0, por_store=None, **kwargs):
         AtLeastOnceSourceConnector.__init__(self,
                                             version,
                                             cookie,
@@ -308,7 +753,8 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
                                             instance_name,
                                             host,
                                             port,
-                                            delay=delay)
+                                            delay=delay,
+                                            **kwargs)
         self.sources = {} # stream_id: [source instance, acked point of ref]
         self.closed_sources = {} # stream_id: acked point of ref
         self.keys = []
@@ -318,6 +764,9 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
         self.pending_eos_ack = {}  # {stream_id: point_of_ref}
         self.closed = set()
         self._added_source = False
+        self._paced_until = {}  # {stream_id: time the source is ready}
+        self.por_store = (PointOfRefStore(por_store)
+                          if por_store is not None else None)
 
     def add_source(self, source):
         self._added_source = True
@@ -327,6 +776,18 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
         if _id in self.sources:
             raise ConnectorError("Cannot add Source {}. A source exists"
                 " with that ID: {}".format(source, self.sources[_id]))
+        stored = (self.por_store.get(_id)
+                  if self.por_store is not None else None)
+        if stored is not None:
+            _name, point_of_ref, closed = stored
+            if closed:
+                logging.info("Skipping {}: its stream finished at {}"
+                             .format(source, point_of_ref))
+                source.close()
+                self.closed.add(_id)
+                self.closed_sources[_id] = point_of_ref
+                return
+            source.reset(point_of_ref)
         self.sources[_id] = [source, source.point_of_ref()]
         self.keys.append(_id)
         # add to joining set so we can control the starting sequence
@@ -354,7 +815,7 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
         key = self.get_id(source.name)
         if key in self.sources:
             try:
-                del self.pending_eos_ack[key]
+                eos_point_of_ref = self.pending_eos_ack.pop(key)
             except KeyError:
                 raise ConnectorError("Cannot close source {}. It has not been"
                                      "properly removed yet. Please use "
@@ -362,6 +823,7 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
                                      .format(source))
             # close and remove the source
             _, acked = self.sources.pop(key, (None, None))
+            self._paced_until.pop(key, None)
             try:
                 idx = self.keys.index(key) # value error
                 self.keys.pop(idx) # index error
@@ -377,6 +839,14 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
             # add it to closed so we keep track of it
             self.closed.add(key)
             self.closed_sources[key] = acked
+            if self.por_store is not None:
+                self.por_store.update(key, source.name, eos_point_of_ref,
+                                      closed=True)
+
+    def shutdown(self, error=None):
+        AtLeastOnceSourceConnector.shutdown(self, error)
+        if self.por_store is not None:
+            self.por_store.close()
 
     @staticmethod
     def get_id(bs):
@@ -404,7 +874,11 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
                 # get value from source
                 value, point_of_ref = next(source)
                 if value is None:
+                    ready_at = getattr(source, 'ready_at', None)
+                    if ready_at is not None:
+                        self._paced_until[key] = ready_at()
                     return None
+                self._paced_until.pop(key, None)
                 # send it as a message
                 msg = cwm.Message(
                     stream_id = key,
@@ -438,6 +912,35 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
             logging.debug("keys: {}, joining: {}, open: {}, pending_eos_ack: {}, closed: {}, _added_source: {}".format(self.keys, self.joining, self.open, self.pending_eos_ack, self.closed, self._added_source))
             raise StopIteration
 
+    def _paced_wait(self, now=None):
+        """
+        Return how long until the earliest open source is ready to send, or
+        0 if any open source may be ready now.
+        """
+        if not self.open:
+            return 0
+        if now is None:
+            now = time.time()
+        earliest = None
+        for key in self.open:
+            ready_at = self._paced_until.get(key, 0)
+            if ready_at <= now:
+                return 0
+            if earliest is None or ready_at < earliest:
+                earliest = ready_at
+        return earliest - now
+
+    def writable(self):
+        # Still flush queued frames while all sources are paced
+        return (AtLeastOnceSourceConnector.writable(self) and
+                (self.pending_sends() or self._paced_wait() == 0))
+
+    def _idle_timeout(self):
+        wait = self._paced_wait()
+        if wait > 0:
+            return min(wait, self.max_paced_wait)
+        return AtLeastOnceSourceConnector._idle_timeout(self)
+
     def stream_added(self, stream):
         logging.debug("MultiSourceConnector added {}".format(stream))
         source, acked = self.sources.get(stream.id, (None, None))
@@ -524,6 +1027,9 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
 
             # update acked point of ref for the source
             self.sources[stream.id][1] = stream.point_of_ref
+            if self.por_store is not None:
+                self.por_store.update(stream.id, source.name,
+                                      stream.point_of_ref)
 
         elif stream.id in self.closed:
             pass
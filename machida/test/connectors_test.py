@@ -0,0 +1,419 @@
+import collections
+import os
+import struct
+import time
+
+from wallaroo.experimental import Stream
+from wallaroo.experimental import connector_wire_messages as cwm
+from wallaroo.experimental.connectors import (MultiSourceConnector,
+                                              PacedSource,
+                                              Pacer,
+                                              PointOfRefStore,
+                                              TokenBucket)
+
+
+def approx(a, b):
+    return abs(a - b) < 1e-9
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class ListSource(object):
+    """
+    A source of the given records, whose point of reference is the index of
+    the next record.
+    """
+    def __init__(self, name, records):
+        self.name = name
+        self.key = None
+        self.records = records
+        self.pos = 0
+        self.acked = []
+
+    def point_of_ref(self):
+        return self.pos
+
+    def reset(self, pos=0):
+        self.pos = pos
+
+    def __next__(self):
+        if self.pos >= len(self.records):
+            raise StopIteration
+        self.pos += 1
+        return (self.records[self.pos - 1], self.pos)
+
+    next = __next__
+
+    def wallaroo_acked(self, point_of_ref):
+        self.acked.append(point_of_ref)
+
+    def close(self):
+        pass
+
+
+#
+# Test TokenBucket
+#
+
+def test_token_bucket_starts_full():
+    clock = FakeClock()
+    bucket = TokenBucket(10, burst=5, clock=clock)
+    assert(bucket.wait_time(5) == 0)
+    bucket.take(5)
+    assert(approx(bucket.wait_time(1), 0.1))
+
+
+def test_token_bucket_refill():
+    clock = FakeClock()
+    bucket = TokenBucket(10, burst=5, clock=clock)
+    bucket.take(5)
+    clock.advance(0.2)
+    assert(bucket.wait_time(2) == 0)
+    assert(approx(bucket.wait_time(3), 0.1))
+    clock.advance(0.1)
+    assert(bucket.wait_time(3) == 0)
+
+
+def test_token_bucket_burst_limit():
+    clock = FakeClock()
+    bucket = TokenBucket(10, burst=5, clock=clock)
+    bucket.take(5)
+    # A long idle period refills no more than the burst size
+    clock.advance(60)
+    assert(bucket.wait_time(5) == 0)
+    bucket.take(5)
+    assert(approx(bucket.wait_time(1), 0.1))
+
+
+def test_token_bucket_default_burst():
+    bucket = TokenBucket(100, clock=FakeClock())
+    assert(bucket.burst == 100)
+    assert(TokenBucket(0.5, clock=FakeClock()).burst == 1)
+
+
+def test_token_bucket_oversized_request():
+    clock = FakeClock()
+    bucket = TokenBucket(10, burst=5, clock=clock)
+    # A request larger than the burst is granted on a full bucket...
+    assert(bucket.wait_time(20) == 0)
+    bucket.take(20)
+    # ...and the debt is paid off at the configured rate
+    assert(approx(bucket.wait_time(1), 1.6))
+    clock.advance(1.5)
+    assert(approx(bucket.wait_time(1), 0.1))
+
+
+def test_token_bucket_zero_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(0, burst=1, clock=clock)
+    bucket.take(1)
+    assert(bucket.wait_time(1) == float('inf'))
+
+
+def test_token_bucket_adjust():
+    clock = FakeClock()
+    bucket = TokenBucket(10, burst=10, clock=clock)
+    bucket.adjust(burst=2)
+    assert(bucket.tokens == 2)
+    bucket.take(2)
+    bucket.adjust(rate=100)
+    assert(approx(bucket.wait_time(1), 0.01))
+
+
+#
+# Test Pacer
+#
+
+def test_pacer_unlimited():
+    pacer = Pacer(clock=FakeClock())
+    for _ in range(1000):
+        assert(pacer.try_consume(1000000) == 0)
+
+
+def test_pacer_records_per_sec():
+    clock = FakeClock()
+    pacer = Pacer(records_per_sec=2, burst_records=2, clock=clock)
+    assert(pacer.try_consume(100) == 0)
+    assert(pacer.try_consume(100) == 0)
+    assert(approx(pacer.try_consume(100), 0.5))
+    clock.advance(0.5)
+    assert(pacer.try_consume(100) == 0)
+
+
+def test_pacer_uses_the_tightest_limit():
+    clock = FakeClock()
+    pacer = Pacer(bytes_per_sec=100, records_per_sec=1000, clock=clock)
+    assert(pacer.try_consume(100) == 0)
+    assert(approx(pacer.try_consume(10), 0.1))
+    # A refused request consumes nothing from either bucket
+    clock.advance(0.1)
+    assert(pacer.try_consume(10) == 0)
+    assert(pacer.settings()['records_per_sec'] == 1000)
+
+
+def test_pacer_adjust():
+    clock = FakeClock()
+    pacer = Pacer(records_per_sec=1, clock=clock)
+    assert(pacer.try_consume(1) == 0)
+    assert(pacer.try_consume(1) == 1)
+    pacer.adjust(records_per_sec=None)
+    assert(pacer.try_consume(1) == 0)
+    assert(pacer.settings() == {'bytes_per_sec': None,
+                                'records_per_sec': None,
+                                'burst_bytes': None,
+                                'burst_records': None})
+    pacer.adjust(bytes_per_sec=10, burst_bytes=20)
+    assert(pacer.settings()['burst_bytes'] == 20)
+    try:
+        pacer.adjust(records_per_second=1)
+    except ValueError:
+        pass
+    else:
+        assert(False)
+
+
+#
+# Test PacedSource
+#
+
+def test_paced_source_holds_back_records():
+    clock = FakeClock()
+    pacer = Pacer(records_per_sec=1, burst_records=1, clock=clock)
+    source = PacedSource(ListSource(b'src', [b'a', b'b', b'c']), pacer)
+    assert(source.ready_at() == 0)
+    assert(next(source) == (b'a', 1))
+    assert(next(source) == (None, None))
+    assert(source.ready_at() == clock.now + 1)
+    # The held record is not read again from the source
+    assert(source.point_of_ref() == 2)
+    assert(next(source) == (None, None))
+    clock.advance(1)
+    assert(next(source) == (b'b', 2))
+    assert(source.ready_at() == 0)
+
+
+def test_paced_source_reset_drops_held_record():
+    clock = FakeClock()
+    pacer = Pacer(records_per_sec=1, burst_records=1, clock=clock)
+    source = PacedSource(ListSource(b'src', [b'a', b'b', b'c']), pacer)
+    next(source)
+    assert(next(source) == (None, None))
+    source.reset(0)
+    assert(source.ready_at() == 0)
+    clock.advance(1)
+    assert(next(source) == (b'a', 1))
+
+
+def test_paced_source_shared_pacer():
+    clock = FakeClock()
+    pacer = Pacer(records_per_sec=2, burst_records=2, clock=clock)
+    a = PacedSource(ListSource(b'a', [b'a1', b'a2']), pacer)
+    b = PacedSource(ListSource(b'b', [b'b1', b'b2']), pacer)
+    assert(next(a) == (b'a1', 1))
+    assert(next(b) == (b'b1', 1))
+    assert(next(a) == (None, None))
+    assert(next(b) == (None, None))
+
+
+#
+# Test MultiSourceConnector pacing
+#
+
+def make_connector(por_store=None):
+    connector = MultiSourceConnector("0.0.1", "cookie", "program",
+                                     "instance", "127.0.0.1", 7100,
+                                     por_store=por_store)
+    # not connected: frames are only queued
+    connector._conn = None
+    connector.producer_fifo = collections.deque()
+    return connector
+
+
+def test_paced_wait():
+    connector = make_connector()
+    assert(connector._paced_wait(now=100) == 0)
+    connector.open.update([1, 2])
+    connector._paced_until = {1: 105, 2: 103}
+    assert(connector._paced_wait(now=100) == 3)
+    assert(connector._paced_wait(now=104) == 0)
+    # A source that is not paced may be ready at any time
+    del connector._paced_until[2]
+    assert(connector._paced_wait(now=100) == 0)
+
+
+def test_writable_while_paced():
+    connector = make_connector()
+    connector.credits = 10
+    connector.open.add(1)
+    connector._paced_until = {1: float('inf')}
+    assert(not connector.writable())
+    assert(0 < connector._idle_timeout() <= connector.max_paced_wait)
+    # Queued frames are still flushed while every source is paced
+    connector.producer_fifo.append(b'frame')
+    assert(connector.writable())
+    connector.producer_fifo.clear()
+    connector._paced_until = {1: 0}
+    assert(connector.writable())
+    connector.credits = -1
+    assert(not connector.writable())
+
+
+def test_next_records_ready_at():
+    clock = FakeClock()
+    pacer = Pacer(records_per_sec=1, burst_records=1, clock=clock)
+    connector = make_connector()
+    source = PacedSource(ListSource(b'src', [b'a', b'b']), pacer)
+    key = connector.get_id(source.name)
+    connector.sources[key] = [source, 0]
+    connector.keys.append(key)
+    connector.open.add(key)
+    msg = next(connector)
+    assert(msg.message == b'a')
+    assert(next(connector) is None)
+    assert(connector._paced_wait(now=clock.now) == 1)
+    clock.advance(1)
+    assert(next(connector).message == b'b')
+    assert(key not in connector._paced_until)
+
+
+def test_failing_source_stops_the_connector():
+    class FailingSource(ListSource):
+        def __next__(self):
+            raise RuntimeError("broker gone")
+
+        next = __next__
+
+    connector = make_connector()
+    # the asynchat buffers that shutdown discards
+    connector.incoming = []
+    connector.credits = 10
+    source = FailingSource(b'src', [])
+    key = connector.get_id(source.name)
+    connector.sources[key] = [source, 0]
+    connector.keys.append(key)
+    connector.open.add(key)
+    connector.handle_write()
+    assert(connector.stopped.is_set())
+    assert(isinstance(connector.join(), RuntimeError))
+
+
+#
+# Test MessageBlock size limits
+#
+
+def test_message_blocks_stay_under_the_worker_limit():
+    connector = make_connector()
+    connector._compression = 'zlib'
+    connector.compress_min_bytes = 0
+    connector.compress_block_bytes = 4 * cwm.MAX_MESSAGE_BLOCK_SIZE
+    limit = cwm.MAX_MESSAGE_BLOCK_SIZE
+    frame = cwm.Frame.encode(cwm.Message(1, 1, 0, None, b'x' * (limit // 3)))
+    for _ in range(4):
+        connector._write_message(frame)
+    connector._flush_block()
+    blocks = [cwm.Frame.decode(data[4:]) for data in connector.producer_fifo]
+    assert(len(blocks) == 2)
+    for block in blocks:
+        assert(isinstance(block, cwm.MessageBlock))
+        assert(block.size <= limit)
+        assert(len(block.messages()) == 2)
+
+
+#
+# Test PointOfRefStore
+#
+
+def test_por_store_reload(tmpdir):
+    path = str(tmpdir.join("por"))
+    store = PointOfRefStore(path, sync_interval=0)
+    assert(store.get(1) is None)
+    store.update(1, b'one', 10)
+    store.update(2, b'two', 20)
+    store.update(1, b'one', 15)
+    store.update(2, b'two', 25, closed=True)
+    assert(store.get(1) == (b'one', 15, False))
+    store.close()
+    store = PointOfRefStore(path)
+    assert(store.streams == {1: (b'one', 15, False),
+                             2: (b'two', 25, True)})
+    store.close()
+
+
+def test_por_store_compacts(tmpdir):
+    path = str(tmpdir.join("por"))
+    store = PointOfRefStore(path, sync_interval=0, compact_ratio=2)
+    for por in range(1, 200):
+        store.update(1, b'one', por)
+        # Let the sync thread write each update on its own
+        while store._pending:
+            time.sleep(0.001)
+    store.close()
+    # The file was replaced by renaming a compacted one over it
+    assert(not os.path.exists(path + '.tmp'))
+    record_size = len(store._encode({1: (b'one', 199, False)}))
+    assert(os.path.getsize(path) <= 2 * 16 * record_size)
+    store = PointOfRefStore(path)
+    assert(store.streams == {1: (b'one', 199, False)})
+    store.close()
+
+
+def test_por_store_torn_record(tmpdir):
+    path = str(tmpdir.join("por"))
+    store = PointOfRefStore(path, sync_interval=0)
+    store.update(1, b'one', 10)
+    store.close()
+    valid = os.path.getsize(path)
+    record = store._encode({2: (b'two', 20, False)})
+    for torn in [record[:3], record[:-1],
+                 struct.pack('>I', 0) + record[4:]]:
+        with open(path, 'ab') as f:
+            f.write(torn)
+        store = PointOfRefStore(path, sync_interval=0)
+        # The torn record is cut off, and the rest is kept
+        assert(store.streams == {1: (b'one', 10, False)})
+        assert(os.path.getsize(path) == valid)
+        store.close()
+    # and updates written after the truncation are read back
+    store = PointOfRefStore(path, sync_interval=0)
+    store.update(2, b'two', 20)
+    store.close()
+    store = PointOfRefStore(path)
+    assert(store.streams == {1: (b'one', 10, False),
+                             2: (b'two', 20, False)})
+    store.close()
+
+
+def test_stored_por_resets_added_sources(tmpdir):
+    path = str(tmpdir.join("por"))
+    connector = make_connector(por_store=path)
+    one = ListSource(b'one', [b'a', b'b', b'c'])
+    two = ListSource(b'two', [b'd', b'e'])
+    connector.add_source(one)
+    connector.add_source(two)
+    key_one, key_two = connector.get_id(b'one'), connector.get_id(b'two')
+    connector.stream_opened(Stream(key_one, b'one', 0, True))
+    connector.stream_acked(Stream(key_one, b'one', 2, True))
+    connector.pending_eos_ack[key_two] = 2
+    connector.stream_acked(Stream(key_two, b'two', 2, True))
+    connector.por_store.close()
+
+    # After a restart, sources continue from their acked points of
+    # reference, and finished ones are not sent again
+    connector = make_connector(por_store=path)
+    one = ListSource(b'one', [b'a', b'b', b'c'])
+    two = ListSource(b'two', [b'd', b'e'])
+    connector.add_source(one)
+    connector.add_source(two)
+    assert(one.point_of_ref() == 2)
+    assert(connector.keys == [key_one])
+    assert(connector.closed_sources == {key_two: 2})
+    connector.por_store.close()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import os
+import struct
+import sys
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+CONNECTOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', '..', 'connectors', 'postgres_copy_sink')
+
+if sys.version_info.major == 2:
+    import imp
+    postgres_copy_sink = imp.load_source('postgres_copy_sink', CONNECTOR)
+else:
+    from importlib.machinery import SourceFileLoader
+    postgres_copy_sink = SourceFileLoader('postgres_copy_sink',
+                                          CONNECTOR).load_module()
+
+PostgresCopyWriter = postgres_copy_sink.PostgresCopyWriter
+
+
+def make_writer(columns=('key', 'value'), key_columns=('key',),
+                types=None):
+    writer = PostgresCopyWriter('dbname=test', 'counts', list(columns),
+                                list(key_columns), binary=types is not None)
+    if types is not None:
+        writer.encoders = [postgres_copy_sink._BINARY_ENCODERS[t]
+                           for t in types]
+    return writer
+
+
+def read_binary(data, count):
+    """
+    Parse PGCOPY binary data into rows of raw field bytes, None for NULL.
+    """
+    assert(data.startswith(b'PGCOPY\n\xff\r\n\x00'))
+    pos = 19
+    rows = []
+    while True:
+        fields = struct.unpack_from('>h', data, pos)[0]
+        pos += 2
+        if fields == -1:
+            break
+        assert(fields == count)
+        row = []
+        for _ in range(fields):
+            size = struct.unpack_from('>i', data, pos)[0]
+            pos += 4
+            if size == -1:
+                row.append(None)
+            else:
+                row.append(data[pos:pos + size])
+                pos += size
+        rows.append(row)
+    assert(pos == len(data))
+    return rows
+
+
+#
+# Test coalescing
+#
+
+def test_rows_last_write_wins_per_key():
+    writer = make_writer()
+    rows = writer.rows([('a', 1), ('b', 2), ('a', 3), ('c', 4), ('b', 5)])
+    assert(sorted(rows) == [('a', 3), ('b', 5), ('c', 4)])
+
+
+def test_rows_from_dicts_and_composite_keys():
+    writer = make_writer(columns=('region', 'key', 'value'),
+                         key_columns=('region', 'key'))
+    rows = writer.rows([{'region': 'eu', 'key': 'a', 'value': 1},
+                        ['us', 'a', 2],
+                        {'key': 'a', 'region': 'eu', 'value': 3},
+                        {'region': 'us', 'key': 'b'}])
+    assert(sorted(rows, key=repr) == sorted([('eu', 'a', 3), ('us', 'a', 2),
+                                             ('us', 'b', None)], key=repr))
+
+
+#
+# Test the CSV encoder
+#
+
+def test_csv_null_is_distinct_from_text():
+    data = make_writer().encode_csv([('a', None), ('b', ''), ('c', '\\N'),
+                                     (None, 'N')]).getvalue()
+    assert(data == b'"a",\n"b",""\n"c","\\N"\n,"N"\n')
+
+
+def test_csv_quoting_and_values():
+    data = make_writer().encode_csv([
+        ('say "hi", twice', 'two\nlines'),
+        (1, 0.1 + 0.2),
+        (True, 12345678901234567890)]).getvalue()
+    rows = list(csv.reader(io.StringIO(data.decode('utf-8'), newline='')
+                           if sys.version_info.major > 2 else
+                           io.BytesIO(data)))
+    assert(rows == [['say "hi", twice', 'two\nlines'],
+                    ['1', repr(0.1 + 0.2)],
+                    ['True', '12345678901234567890']])
+    assert(float(rows[1][1]) == 0.1 + 0.2)
+
+
+def test_csv_unicode():
+    data = make_writer().encode_csv([(u'clé', u'naïve ☃'),
+                                     (u'k', b'bytes')]).getvalue()
+    assert(data == u'"clé","naïve ☃"\n"k","bytes"\n'.encode('utf-8'))
+
+
+#
+# Test the binary encoder
+#
+
+def test_binary_encoding():
+    writer = make_writer(columns=('key', 'count', 'ratio', 'ok', 'doc'),
+                         types=('text', 'int8', 'float8', 'bool', 'jsonb'))
+    data = writer.encode_binary([(u'clé', 3, 0.5, True, '{"a": 1}'),
+                                 (u'k', None, -1.25, False, None)]
+                                ).getvalue()
+    assert(data[:19] == b'PGCOPY\n\xff\r\n\x00' + b'\x00' * 8)
+    assert(data.endswith(b'\xff\xff'))
+    rows = read_binary(data, 5)
+    assert(rows == [[u'clé'.encode('utf-8'), struct.pack('>q', 3),
+                     struct.pack('>d', 0.5), b'\x01', b'\x01{"a": 1}'],
+                    [b'k', None, struct.pack('>d', -1.25), b'\x00', None]])
+
+
+def test_binary_int_widths():
+    writer = make_writer(columns=('a', 'b', 'c'),
+                         types=('int2', 'int4', 'float4'))
+    rows = read_binary(writer.encode_binary([(-2, 70000, 1.5)]).getvalue(),
+                       3)
+    assert(rows == [[struct.pack('>h', -2), struct.pack('>i', 70000),
+                     struct.pack('>f', 1.5)]])
+    with pytest.raises(struct.error):
+        writer.encode_binary([(1 << 16, 0, 0.0)])
@@ -0,0 +1,199 @@
+import socket
+import struct
+import threading
+import time
+
+import wallaroo
+import wallaroo.experimental
+from wallaroo.experimental import (BatchingSinkConnector,
+                                   SinkConnector,
+                                   _ReceiveBuffer)
+
+
+#
+# An application for SinkConnector to find its sink in
+#
+
+def application_setup(args):
+    source_config = wallaroo.TCPSourceConfig("in", "127.0.0.1", 7000,
+                                             decode)
+    sink_config = wallaroo.experimental.SinkConnectorConfig(
+        "out", encoder=encode, decoder=decode_frame, port=7200,
+        cookie="cookie")
+    pipeline = (wallaroo.source("test", source_config)
+                .to_sink(sink_config))
+    return wallaroo.build_application("sink connector test", pipeline)
+
+
+@wallaroo.decoder(header_length=4, length_fmt=">I")
+def decode(bs):
+    return bs
+
+
+@wallaroo.experimental.stream_message_encoder
+def encode(data):
+    return data
+
+
+@wallaroo.experimental.stream_message_decoder
+def decode_frame(bs):
+    return bs
+
+
+def frame(payload):
+    return struct.pack(">I", len(payload)) + payload
+
+
+def make_connector(recv_size=None, cls=SinkConnector, **kwargs):
+    connector = cls(args=['--application-module', 'sink_connector_test',
+                          '--connector', 'out'], **kwargs)
+    if recv_size is not None:
+        connector.recv_size = recv_size
+    ours, theirs = socket.socketpair()
+    connector._setup_connection(ours)
+    return connector, theirs
+
+
+class FakeSocket(object):
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, view, size):
+        chunk = self.chunks.pop(0)[:size]
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+
+#
+# Test _ReceiveBuffer
+#
+
+def test_receive_buffer_cursor():
+    buf = _ReceiveBuffer(16)
+    assert(buf.recv_from(FakeSocket([b'abcdef']), 8) == 6)
+    assert(len(buf) == 6)
+    assert(buf.peek(2) == b'ab')
+    assert(buf.take(2) == b'ab')
+    buf.skip(1)
+    assert(buf.take(3) == b'def')
+    # Reading everything rewinds the cursor
+    assert((buf.start, buf.end) == (0, 0))
+
+
+def test_receive_buffer_compacts_and_grows():
+    buf = _ReceiveBuffer(8)
+    buf.recv_from(FakeSocket([b'abcdefgh']), 8)
+    buf.skip(6)
+    # Room is made by moving the unread bytes to the front
+    buf.recv_from(FakeSocket([b'ijkl']), 4)
+    assert(len(buf.data) == 8)
+    assert(buf.take(6) == b'ghijkl')
+    buf.recv_from(FakeSocket([b'0123456789']), 10)
+    # and by growing when that is not enough
+    assert(len(buf.data) >= 10)
+    assert(buf.take(10) == b'0123456789')
+
+
+#
+# Test SinkConnector.read_batch
+#
+
+def test_read_batch_several_frames_in_one_read():
+    connector, peer = make_connector()
+    peer.sendall(b''.join(frame(p) for p in [b'one', b'two', b'three']))
+    assert(connector.read_batch(timeout=1) == [b'one', b'two', b'three'])
+    assert(connector.bytes_received == 3 * 4 + 11)
+
+
+def test_read_batch_max_items():
+    connector, peer = make_connector()
+    peer.sendall(b''.join(frame(p) for p in [b'one', b'two', b'three']))
+    assert(connector.read_batch(max_items=2, timeout=1) == [b'one', b'two'])
+    assert(connector.read_batch(max_items=2, timeout=1) == [b'three'])
+
+
+def test_read_batch_frame_split_across_reads():
+    connector, peer = make_connector()
+    data = frame(b'split payload')
+    peer.sendall(data[:2])
+    assert(connector.read_batch(timeout=0.05) == [])
+    peer.sendall(data[2:9])
+    assert(connector.read_batch(timeout=0.05) == [])
+    peer.sendall(data[9:])
+    assert(connector.read_batch(timeout=1) == [b'split payload'])
+
+
+def test_read_batch_small_recv_size():
+    # Every frame takes several recv_into calls
+    connector, peer = make_connector(recv_size=3)
+    payloads = [b'x' * n for n in range(1, 20)]
+    peer.sendall(b''.join(frame(p) for p in payloads))
+    received = []
+    while len(received) < len(payloads):
+        batch = connector.read_batch(timeout=1)
+        assert(batch)
+        received.extend(batch)
+    assert(received == payloads)
+
+
+def test_read_and_read_batch_share_the_buffer():
+    connector, peer = make_connector()
+    peer.sendall(frame(b'a') + frame(b'b'))
+    assert(connector.read(timeout=1) == b'a')
+    assert(connector.read_batch(timeout=1) == [b'b'])
+
+
+def test_read_batch_eof_mid_frame():
+    connector, peer = make_connector()
+    peer.sendall(frame(b'whole') + frame(b'partial')[:6])
+    peer.close()
+    # Frames received before the peer closed are still delivered
+    assert(connector.read_batch(timeout=1) == [b'whole'])
+    # The truncated frame is dropped along with the connection
+    assert(connector.read_batch(timeout=0.05) == [])
+    assert(connector._connections == [])
+    assert(connector._buffers == {})
+    assert(connector._pending == [])
+
+
+def test_read_batch_timeout():
+    connector, _peer = make_connector()
+    assert(connector.read_batch(timeout=0.01) == [])
+
+
+#
+# Test BatchingSinkConnector
+#
+
+def test_batching_stop_with_a_full_queue():
+    connector, peer = make_connector(cls=BatchingSinkConnector,
+                                     max_batch_items=1,
+                                     max_pending_batches=1)
+    flushed = []
+    flushing = threading.Event()
+    release = threading.Event()
+
+    def flush(batch):
+        flushing.set()
+        release.wait(5)
+        flushed.extend(batch)
+
+    messages = [b'one', b'two', b'three']
+    peer.sendall(b''.join(frame(m) for m in messages))
+    runner = threading.Thread(target=connector.run, args=(flush,))
+    runner.start()
+    # The first batch is being flushed, the second fills the queue and
+    # run() waits to submit the third
+    assert(flushing.wait(5))
+    deadline = time.time() + 5
+    while not connector._batches.full() and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    connector.stop()
+    # Let run() give up waiting for room in the queue
+    time.sleep(1)
+    release.set()
+    runner.join(5)
+    assert(not runner.is_alive())
+    assert(flushed == messages)
+    assert(connector.stats.batches == 3)
@@ -0,0 +1,382 @@
+import os
+import socket
+import struct
+
+from wallaroo.experimental import (_TwoPCConnection,
+                                   ConnectorError,
+                                   TwoPCSinkConnector,
+                                   TwoPCTxnLog)
+from wallaroo.experimental import connector_wire_messages as cwm
+
+
+class RecordingSinkConnector(TwoPCSinkConnector):
+    """
+    A TwoPCSinkConnector that records the hooks it is called with and
+    votes `self.vote` in phase 1.
+    """
+    def __init__(self, txn_log_path):
+        super(RecordingSinkConnector, self).__init__(
+            "cookie", "127.0.0.1", 0, txn_log_path)
+        self.vote = True
+        self.calls = []
+
+    def resume(self, worker, offset):
+        self.calls.append(('resume', worker, offset))
+
+    def write(self, worker, offset, data):
+        self.calls.append(('write', worker, offset, data))
+
+    def prepare(self, worker, txn_id, where_list):
+        self.calls.append(('prepare', worker, txn_id))
+        return self.vote
+
+    def commit(self, worker, txn_id, where_list):
+        self.calls.append(('commit', worker, txn_id))
+
+    def abort(self, worker, txn_id, where_list):
+        self.calls.append(('abort', worker, txn_id))
+
+    def workers_left(self, workers):
+        self.calls.append(('workers_left', workers))
+
+
+class FakeSocket(object):
+    """
+    A socket that reads the given frames and keeps the frames sent to it.
+    """
+    def __init__(self, msgs=()):
+        self.inbound = b''.join(cwm.Frame.encode(m) for m in msgs)
+        self.sent = []
+        self.closed = False
+
+    def recv(self, n):
+        data, self.inbound = self.inbound[:n], self.inbound[n:]
+        return data
+
+    def sendall(self, data):
+        self.sent.append(cwm.Frame.decode(data[4:]))
+
+    def shutdown(self, how):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+    def replies(self):
+        """
+        The 2PC messages sent, after the handshake.
+        """
+        return [cwm.TwoPCFrame.decode(m.message) for m in self.sent
+                if isinstance(m, cwm.Message) and m.stream_id == 0]
+
+
+def hello(worker, cookie="cookie"):
+    return cwm.Hello("v0.0.1", cookie, "program", worker)
+
+
+def twopc(msg):
+    return cwm.Message(0, 0, 0, None, cwm.TwoPCFrame.encode(msg))
+
+
+def make_connector(tmpdir):
+    connector = RecordingSinkConnector(str(tmpdir.join("txnlog")))
+    connector.txn_log.load()
+    return connector
+
+
+def connect(connector, worker="w1"):
+    """
+    Return a connection for `worker` that is through the handshake. Its
+    frames are handled by calling its methods directly, on this thread.
+    """
+    sock = FakeSocket([hello(worker)])
+    connection = _TwoPCConnection(connector, sock)
+    assert(connection._handshake())
+    return connection
+
+
+#
+# Test _TwoPCConnection
+#
+
+def test_handshake(tmpdir):
+    connector = make_connector(tmpdir)
+    connection = connect(connector)
+    assert(connection.sock.sent == [cwm.Ok(connector.credits)])
+    assert(connector.calls == [('resume', 'w1', 0)])
+    # A second connection for the same worker is refused
+    sock = FakeSocket([hello("w1")])
+    assert(not _TwoPCConnection(connector, sock)._handshake())
+    assert(isinstance(sock.sent[0], cwm.Error))
+
+
+def test_bad_cookie(tmpdir):
+    connector = make_connector(tmpdir)
+    sock = FakeSocket([hello("w1", cookie="wrong")])
+    connection = _TwoPCConnection(connector, sock)
+    assert(not connection._handshake())
+    assert(connection.state is None)
+    assert(sock.sent == [cwm.Error("bad cookie")])
+
+
+def test_phase1_and_phase2_commit(tmpdir):
+    connector = make_connector(tmpdir)
+    connection = connect(connector)
+    connection._write(0, b'hello')
+    connection._twopc(cwm.TwoPCPhase1("txn-1", [(1, 0, 5)]))
+    assert(connection.sock.replies() == [cwm.TwoPCReply("txn-1", True)])
+    assert(list(connection.state.pending) == ["txn-1"])
+    connection._twopc(cwm.TwoPCPhase2("txn-1", True))
+    assert(connection.state.pending == {})
+    assert(connection.state.committed == 5)
+    assert(connector.calls[1:] == [('write', 'w1', 0, b'hello'),
+                                   ('prepare', 'w1', 'txn-1'),
+                                   ('commit', 'w1', 'txn-1')])
+
+
+def test_phase1_vote_rollback_and_phase2_abort(tmpdir):
+    connector = make_connector(tmpdir)
+    connector.vote = False
+    connection = connect(connector)
+    connection._write(0, b'hello')
+    connection._twopc(cwm.TwoPCPhase1("txn-1", [(1, 0, 5)]))
+    assert(connection.sock.replies() == [cwm.TwoPCReply("txn-1", False)])
+    connection._twopc(cwm.TwoPCPhase2("txn-1", False))
+    assert(connector.calls[-1] == ('abort', 'w1', 'txn-1'))
+    # Output continues from the start of the aborted transaction
+    assert(connection.offset == 0)
+    assert(connection.state.committed == 0)
+
+
+def test_phase1_votes_rollback_on_bad_offsets(tmpdir):
+    connector = make_connector(tmpdir)
+    connection = connect(connector)
+    connection._write(0, b'hello')
+    # The transaction ends after the output received so far
+    connection._twopc(cwm.TwoPCPhase1("txn-1", [(1, 0, 10)]))
+    assert(connection.sock.replies() == [cwm.TwoPCReply("txn-1", False)])
+    assert(('prepare', 'w1', 'txn-1') not in connector.calls)
+
+
+def test_gap_in_output_forces_abort(tmpdir):
+    connector = make_connector(tmpdir)
+    connection = connect(connector)
+    connection._write(5, b'later')
+    assert(connection.offset == 0)
+    assert(not connection.state.commit_next)
+    connection._write(0, b'hello')
+    connection._twopc(cwm.TwoPCPhase1("txn-1", [(1, 0, 5)]))
+    assert(connection.sock.replies() == [cwm.TwoPCReply("txn-1", False)])
+
+
+def test_duplicate_output_is_skipped(tmpdir):
+    connector = make_connector(tmpdir)
+    connection = connect(connector)
+    connection._write(0, b'hello')
+    connection._write(0, b'hello')
+    connection._write(3, b'lo world')
+    assert([c for c in connector.calls if c[0] == 'write'] ==
+           [('write', 'w1', 0, b'hello'), ('write', 'w1', 5, b' world')])
+
+
+def test_list_uncommitted(tmpdir):
+    connector = make_connector(tmpdir)
+    connection = connect(connector)
+    connection._write(0, b'hello')
+    connection._twopc(cwm.TwoPCPhase1("txn-1", [(1, 0, 5)]))
+    connection._twopc(cwm.ListUncommitted(7))
+    assert(connection.sock.replies()[-1] ==
+           cwm.ReplyUncommitted(7, ["txn-1"]))
+    connection._twopc(cwm.TwoPCPhase2("txn-1", True))
+    connection._twopc(cwm.ListUncommitted(8))
+    assert(connection.sock.replies()[-1] == cwm.ReplyUncommitted(8, []))
+
+
+def test_reconnect_resumes_after_a_commit_vote(tmpdir):
+    connector = make_connector(tmpdir)
+    connection = connect(connector)
+    connection._write(0, b'hello')
+    connection._twopc(cwm.TwoPCPhase1("txn-1", [(1, 0, 5)]))
+    connector._deactivate("w1", connection)
+    # The transaction may still commit, so its output is kept
+    connection = connect(connector)
+    assert(connection.offset == 5)
+    assert(connector.calls[-1] == ('resume', 'w1', 5))
+    connection._twopc(cwm.ListUncommitted(1))
+    assert(connection.sock.replies() == [cwm.ReplyUncommitted(1, ["txn-1"])])
+
+
+def test_workers_left(tmpdir):
+    connector = make_connector(tmpdir)
+    w1 = connect(connector, "w1")
+    w2 = connect(connector, "w2")
+    w2._write(0, b'hello')
+    w1._twopc(cwm.WorkersLeft(1, ["w2", "unknown"]))
+    assert(connector.calls[-1] == ('workers_left', ['w2']))
+    assert(sorted(connector.txn_log.workers) == ["w1"])
+    # The leaving worker's connection is closed, and no longer writes to
+    # the txn log
+    assert(w2.left and w2.sock.closed)
+    assert("w2" not in connector._active)
+    w2._ops.put(('twopc', cwm.TwoPCPhase1("txn-1", [(1, 0, 5)])))
+    w2._ops.put(None)
+    w2._output_loop()
+    assert(('prepare', 'w2', 'txn-1') not in connector.calls)
+    try:
+        w2._twopc(cwm.TwoPCPhase1("txn-1", [(1, 0, 5)]))
+    except ConnectorError:
+        pass
+    else:
+        assert(False)
+    assert(sorted(connector.txn_log.workers) == ["w1"])
+    # The worker starts afresh if it connects again
+    w2 = connect(connector, "w2")
+    assert(w2.offset == 0)
+
+
+def test_connection_thread(tmpdir):
+    connector = make_connector(tmpdir)
+    ours, theirs = socket.socketpair()
+    connection = _TwoPCConnection(connector, ours)
+    connection.start()
+    for msg in [hello("w1"),
+                cwm.Message(1, 0, 0, None, b'hello'),
+                twopc(cwm.TwoPCPhase1("txn-1", [(1, 0, 5)])),
+                twopc(cwm.TwoPCPhase2("txn-1", True))]:
+        theirs.sendall(cwm.Frame.encode(msg))
+    received = []
+    while len(received) < 2:
+        header = recv_exactly(theirs, 4)
+        received.append(cwm.Frame.decode(
+            recv_exactly(theirs, cwm.Frame.read_header(header))))
+    assert(received[0] == cwm.Ok(connector.credits))
+    assert(cwm.TwoPCFrame.decode(received[1].message) ==
+           cwm.TwoPCReply("txn-1", True))
+    theirs.close()
+    connection.join(5)
+    assert(not connection.is_alive())
+    assert(connector.calls[-1] == ('commit', 'w1', 'txn-1'))
+    assert(connector._active == {})
+    connector.txn_log.close()
+
+
+def recv_exactly(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        assert(chunk)
+        data += chunk
+    return data
+
+
+#
+# Test TwoPCTxnLog
+#
+
+def fill_log(log):
+    log.append("w1", '1-ok', "txn-1", [(1, 0, 5)])
+    log.append("w1", '2-ok', "txn-1", 5)
+    log.append("w1", '1-ok', "txn-2", [(1, 5, 9)])
+    log.append("w2", '1-rollback', "txn-3", [(1, 0, 3)])
+    log.wait_durable(log.append("w2", 'next-txn-force-abort'))
+
+
+def assert_filled(log):
+    assert(sorted(log.workers) == ["w1", "w2"])
+    w1, w2 = log.workers["w1"], log.workers["w2"]
+    assert(w1.committed == 5)
+    assert(w1.pending == {"txn-2": (True, [(1, 5, 9)])})
+    assert(w1.resume_offset() == 9)
+    assert(w2.pending == {"txn-3": (False, [(1, 0, 3)])})
+    assert(not w2.commit_next)
+    assert(w2.resume_offset() == 0)
+
+
+def test_txn_log_replay(tmpdir):
+    path = str(tmpdir.join("txnlog"))
+    log = TwoPCTxnLog(path)
+    log.load()
+    fill_log(log)
+    log.close()
+    log = TwoPCTxnLog(path)
+    log.load()
+    assert_filled(log)
+    log.close()
+
+
+def test_txn_log_left(tmpdir):
+    path = str(tmpdir.join("txnlog"))
+    log = TwoPCTxnLog(path)
+    log.load()
+    fill_log(log)
+    log.wait_durable(log.append("w2", 'left'))
+    log.close()
+    log = TwoPCTxnLog(path)
+    log.load()
+    assert(sorted(log.workers) == ["w1"])
+    log.close()
+
+
+def test_txn_log_torn_tail(tmpdir):
+    path = str(tmpdir.join("txnlog"))
+    log = TwoPCTxnLog(path)
+    log.load()
+    fill_log(log)
+    log.close()
+    valid = os.path.getsize(path)
+    # A crash part way through writing a record
+    record = TwoPCTxnLog._record(
+        TwoPCTxnLog.ENTRY, log._encode_entry("w1", '2-ok', "txn-2", 9))
+    for torn in [record[:5], record[:-1],
+                 record[:4] + struct.pack('>I', 0) + record[8:]]:
+        with open(path, 'ab') as f:
+            f.write(torn)
+        log = TwoPCTxnLog(path)
+        log.load()
+        # The torn record is cut off, and the rest is replayed
+        assert_filled(log)
+        assert(os.path.getsize(path) == valid)
+        log.close()
+    # and entries written after the truncation are read back
+    log = TwoPCTxnLog(path)
+    log.load()
+    log.wait_durable(log.append("w1", '2-ok', "txn-2", 9))
+    log.close()
+    log = TwoPCTxnLog(path)
+    log.load()
+    assert(log.workers["w1"].committed == 9)
+    assert(log.workers["w1"].pending == {})
+    log.close()
+
+
+def test_txn_log_checkpoint(tmpdir):
+    path = str(tmpdir.join("txnlog"))
+    log = TwoPCTxnLog(path, checkpoint_bytes=64)
+    log.load()
+    assert(log.checkpoints == 1)
+    for i in range(20):
+        txn_id = "txn-{}".format(i)
+        log.append("w1", '1-ok', txn_id, [(1, i, i + 1)])
+        log.wait_durable(log.append("w1", '2-ok', txn_id, i + 1))
+    log.close()
+    assert(log.checkpoints > 1)
+    # The log was replaced by renaming a new one over it
+    assert(not os.path.exists(path + '.tmp'))
+    assert(os.path.getsize(path) < 20 * 64)
+    log = TwoPCTxnLog(path, checkpoint_bytes=64)
+    log.load()
+    assert(log.workers["w1"].committed == 20)
+    assert(log.workers["w1"].pending == {})
+    log.close()
+
+
+def test_txn_log_not_a_log(tmpdir):
+    path = tmpdir.join("txnlog")
+    path.write(b'not a txn log', mode='wb')
+    log = TwoPCTxnLog(str(path))
+    try:
+        log.load()
+    except Exception as err:
+        assert("not a txn log" in str(err))
+    else:
+        assert(False)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import ast
 import sys
 
 def get_2pc_commits(path):
@@ -7,7 +8,7 @@ def get_2pc_commits(path):
     try:
         with open(path, 'rb') as f:
             for l in f:
-                a = eval(l)
+                a = ast.literal_eval(l.decode('utf-8'))
                 if (a[1] == '2-ok') and (a[3] > 0):
                     logfile = get_logfile_path(path)
                     x = (a[0], a[3], logfile, a[2])
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 from abc import ABC, abstractmethod
+import ast
 import asyncore
 import asynchat
 import logging
@@ -974,7 +975,7 @@ class TwoPC_TxnlogHelper:
             raise Exception
 
     def deserialize_txnlog_item(bs):
-        return eval(bs)
+        return ast.literal_eval(bs.decode('utf-8'))
 
     def is_phase1(log):
         return (is_1ok(log) or is_1bad(log))
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+# Copyright 2017 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+
+"""
+Run single-host Wallaroo benchmarks and compare their results.
+
+`run` starts each selected example application with
+`integration.cluster.Cluster`, pins every worker to its own CPU, drives it
+with the application's prepared dataset for a warmup period and a measured
+period, and writes a JSON result file with:
+
+- throughput and latency percentiles end to end, per pipeline, per step
+  and per worker, from `integration.metrics_report`
+- RSS and CPU use of every worker process, sampled from /proc
+
+`compare` checks a result file against a baseline result file and exits
+with a non-zero status when a benchmark regressed by more than the given
+tolerance.
+
+Run it with `integration` and the machida `wallaroo` package on the
+PYTHONPATH, e.g.:
+
+    PYTHONPATH=testing/tools:machida/lib python3 testing/performance/benchmark.py \\
+        run --output results.json
+    python3 testing/performance/benchmark.py compare baseline.json results.json
+"""
+
+import argparse
+from collections import namedtuple
+import datetime
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+
+Input = namedtuple('Input', ['path', 'source', 'mode'])
+Benchmark = namedtuple('Benchmark', ['app_dir', 'module', 'prepare',
+                                     'inputs', 'sink_mode'])
+
+
+BENCHMARKS = {
+    'market_spread': Benchmark(
+        app_dir='examples/python/market_spread',
+        module='market_spread',
+        prepare=[sys.executable, '_test/gen.py'],
+        inputs=[Input('_market.txt', 'Market Data', 'framed'),
+                Input('_orders.txt', 'Orders', 'framed')],
+        sink_mode='framed'),
+    'word_count': Benchmark(
+        app_dir='examples/python/word_count',
+        module='word_count',
+        prepare=None,
+        inputs=[Input('count_this.txt', 'Split and Count', 'newlines')],
+        sink_mode='newlines'),
+    'alerts_stateless': Benchmark(
+        app_dir='examples/python/alerts_stateless',
+        module='alerts',
+        prepare=None,
+        inputs=[],
+        sink_mode='newlines'),
+    'alerts_stateful': Benchmark(
+        app_dir='examples/python/alerts_stateful',
+        module='alerts',
+        prepare=None,
+        inputs=[],
+        sink_mode='newlines'),
+}
+
+
+#####################
+# Resource sampling #
+#####################
+
+class ProcSampler(threading.Thread):
+    """
+    Sample RSS and CPU time of a set of processes from /proc every
+    `interval` seconds until stopped.
+    """
+    def __init__(self, pids, interval=1.0):
+        super(ProcSampler, self).__init__()
+        self.daemon = True
+        self.pids = pids
+        self.interval = interval
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.samples = {name: [] for name in pids}
+        self.stopped = threading.Event()
+
+    def sample(self, pid):
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # the command name may contain spaces, so split after it
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / float(self.clock_ticks)
+        rss = int(fields[21]) * self.page_size
+        return (time.time(), cpu, rss)
+
+    def run(self):
+        while True:
+            for name, pid in self.pids.items():
+                try:
+                    self.samples[name].append(self.sample(pid))
+                except (IOError, OSError, IndexError, ValueError):
+                    pass
+            if self.stopped.wait(self.interval):
+                break
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def summary(self):
+        out = {}
+        for name, samples in self.samples.items():
+            if len(samples) < 2:
+                continue
+            (t0, cpu0, _), (t1, cpu1, rss1) = samples[0], samples[-1]
+            rss = [s[2] for s in samples]
+            out[name] = {
+                'cpu_percent': 100.0 * (cpu1 - cpu0) / (t1 - t0),
+                'rss_max_bytes': max(rss),
+                'rss_mean_bytes': sum(rss) // len(rss),
+                'rss_last_bytes': rss1}
+        return out
+
+
+def pin_process(pid, cpus):
+    """
+    Pin every thread of `pid` to `cpus`.
+    """
+    for tid in os.listdir('/proc/{}/task'.format(pid)):
+        try:
+            os.sched_setaffinity(int(tid), cpus)
+        except OSError:
+            # the thread exited
+            pass
+
+
+def parse_cpus(value):
+    cpus = set()
+    for part in value.split(','):
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus.update(range(int(lo), int(hi) + 1))
+        elif part:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+#######
+# Run #
+#######
+
+def summarize_metrics(chunks, window):
+    """
+    Report on the metrics captured during the measured `window` seconds:
+    the end-to-end summary at the top level, plus per pipeline, per step
+    and per worker summaries.
+    """
+    from integration.metrics_parser import MetricsData
+    from integration.metrics_report import MetricsReport
+    md = MetricsData()
+    md.load_string_list(chunks)
+    report = MetricsReport(md.store, window=window)
+    result = report.end_to_end()
+    result['pipelines'] = report.pipelines()
+    result['steps'] = report.steps()
+    result['worker_metrics'] = report.workers()
+    return result
+
+
+def encode_input(inp):
+    """
+    Pre-encode an input file to a length framed file for FileSender.
+    """
+    from integration.end_points import encode_to_file, files_generator
+    path = '_bench_{}.bin'.format(os.path.splitext(inp.path)[0].lstrip('_'))
+    return encode_to_file(files_generator(inp.path, mode=inp.mode), path)
+
+
+def run_benchmark(name, bench, args):
+    from integration.cluster import Cluster
+    from integration.end_points import FileSender
+
+    app_dir = os.path.join(ROOT_DIR, bench.app_dir)
+    cwd = os.getcwd()
+    os.chdir(app_dir)
+    os.environ['PYTHONPATH'] = os.pathsep.join(
+        [app_dir] + os.environ.get('PYTHONPATH', '').split(os.pathsep))
+    try:
+        if bench.prepare:
+            logging.info("{}: preparing dataset".format(name))
+            subprocess.check_call(bench.prepare)
+        paths = {inp.path: encode_input(inp) for inp in bench.inputs}
+        command = '{} --application-module {}'.format(args.machida,
+                                                      bench.module)
+        with Cluster(command=command, host=args.host,
+                     sources=[i.source for i in bench.inputs],
+                     workers=args.workers, sink_mode=bench.sink_mode,
+                     persistent_data={}) as cluster:
+            pids = {r.name: r.pid for r in cluster.workers}
+            for idx, (worker, pid) in enumerate(sorted(pids.items())):
+                cpu = args.worker_cpus[idx % len(args.worker_cpus)]
+                logging.info("{}: pinning {} to CPU {}".format(name, worker,
+                                                                cpu))
+                pin_process(pid, [cpu])
+            for inp in bench.inputs:
+                # repeat the dataset for longer than the run can last
+                sender = FileSender(cluster.source_addrs[0][inp.source],
+                                    paths[inp.path],
+                                    connections=args.connections,
+                                    repeat=10 ** 9)
+                cluster.add_sender(sender, start=True)
+
+            logging.info("{}: warming up for {}s".format(name, args.warmup))
+            time.sleep(args.warmup)
+            sampler = ProcSampler(pids, args.sample_interval)
+            sampler.start()
+            start = time.time()
+            first = len(cluster.metrics.data.get('*', []))
+            logging.info("{}: measuring for {}s".format(name, args.duration))
+            time.sleep(args.duration)
+            last = len(cluster.metrics.data.get('*', []))
+            window = time.time() - start
+            sampler.stop()
+            chunks = cluster.metrics.data.get('*', [])[first:last]
+            cluster.stop_cluster()
+    finally:
+        os.chdir(cwd)
+
+    result = summarize_metrics(chunks, window)
+    result['duration'] = window
+    result['workers'] = sampler.summary()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR,
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    os.sched_setaffinity(0, args.driver_cpus)
+    results = {
+        'meta': {
+            'date': datetime.datetime.utcnow().isoformat(),
+            'commit': git_commit(),
+            'host': socket.gethostname(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'machida': args.machida,
+            'workers': args.workers,
+            'worker_cpus': args.worker_cpus,
+            'driver_cpus': args.driver_cpus,
+            'warmup': args.warmup,
+            'duration': args.duration},
+        'benchmarks': {}}
+    for name in args.benchmarks:
+        logging.info("Running benchmark {}".format(name))
+        results['benchmarks'][name] = run_benchmark(name, BENCHMARKS[name],
+                                                    args)
+        logging.info("{}: {:.0f} msgs/s, p99 {} ns".format(
+            name, results['benchmarks'][name]['throughput'],
+            results['benchmarks'][name]['latency_ns'].get('99')))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    logging.info("Results saved to {}".format(args.output))
+
+
+###########
+# Compare #
+###########
+
+def compare_results(baseline, current, tolerance):
+    """
+    Return a list of (benchmark, measure, baseline value, current value)
+    for every measure that is worse than the baseline by more than
+    `tolerance` (a fraction).
+    """
+    regressions = []
+    for name, base in sorted(baseline['benchmarks'].items()):
+        cur = current['benchmarks'].get(name)
+        if cur is None:
+            continue
+        checks = [('throughput', base['throughput'], cur['throughput'],
+                   False)]
+        for p, value in sorted(base['latency_ns'].items()):
+            if p in cur['latency_ns']:
+                checks.append(('latency p{}'.format(p), value,
+                               cur['latency_ns'][p], True))
+        for pipeline, steps in sorted(base.get('steps', {}).items()):
+            for step, summary in sorted(steps.items()):
+                cur_step = cur.get('steps', {}).get(pipeline, {}).get(step)
+                if cur_step and '99' in summary['latency_ns'] and \
+                        '99' in cur_step['latency_ns']:
+                    checks.append(('{}: {} latency p99'.format(pipeline, step),
+                                   summary['latency_ns']['99'],
+                                   cur_step['latency_ns']['99'], True))
+        for worker, usage in sorted(base['workers'].items()):
+            if worker in cur['workers']:
+                checks.append(('{} rss'.format(worker),
+                               usage['rss_max_bytes'],
+                               cur['workers'][worker]['rss_max_bytes'],
+                               True))
+        for measure, b, c, higher_is_worse in checks:
+            if higher_is_worse:
+                worse = c > b * (1 + tolerance)
+            else:
+                worse = c < b * (1 - tolerance)
+            if worse:
+                regressions.append((name, measure, b, c))
+    return regressions
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    regressions = compare_results(baseline, current, args.tolerance)
+    for name, measure, b, c in regressions:
+        print("REGRESSION {}: {} {} -> {}".format(name, measure, b, c))
+    if regressions:
+        sys.exit(1)
+    print("No regressions beyond {:.0%}".format(args.tolerance))
+
+
+def CLI():
+    parser = argparse.ArgumentParser(prog='benchmark')
+    sub = parser.add_subparsers(dest='cmd')
+    sub.required = True
+
+    run_parser = sub.add_parser('run', help="Run benchmarks")
+    run_parser.add_argument('benchmarks', nargs='*',
+                            default=sorted(BENCHMARKS),
+                            help="Benchmarks to run (default: all of {})"
+                                 .format(', '.join(sorted(BENCHMARKS))))
+    run_parser.add_argument('--output', default='benchmark.json')
+    run_parser.add_argument('--machida', default='machida3',
+                            help="The machida binary to run")
+    run_parser.add_argument('--host', default='127.0.0.1')
+    run_parser.add_argument('--workers', type=int, default=1)
+    run_parser.add_argument('--worker-cpus', type=parse_cpus, default='1',
+                            help=("CPUs to pin workers to, one each, e.g. "
+                                  "1-4. Reused if there are more workers."))
+    run_parser.add_argument('--driver-cpus', type=parse_cpus, default='0',
+                            help=("CPUs for this script's senders and "
+                                  "sinks."))
+    run_parser.add_argument('--warmup', type=float, default=15)
+    run_parser.add_argument('--duration', type=float, default=60)
+    run_parser.add_argument('--connections', type=int, default=1,
+                            help=("Sender processes and connections per "
+                                  "source"))
+    run_parser.add_argument('--sample-interval', type=float, default=1.0,
+                            help="Seconds between RSS/CPU samples")
+    run_parser.add_argument('--log-level', default='info',
+                            choices=['debug', 'info', 'warn', 'error'])
+
+    cmp_parser = sub.add_parser('compare', help=("Compare a result file "
+                                                 "against a baseline"))
+    cmp_parser.add_argument('baseline')
+    cmp_parser.add_argument('current')
+    cmp_parser.add_argument('--tolerance', type=float, default=0.1,
+                            help=("Allowed fractional regression "
+                                  "(default: 0.1)"))
+
+    args = parser.parse_args()
+    if args.cmd == 'run':
+        unknown = set(args.benchmarks) - set(BENCHMARKS)
+        if unknown:
+            parser.error("unknown benchmarks: {}".format(
+                ', '.join(sorted(unknown))))
+        from integration.logger import get_log_level, set_logging
+        set_logging(name='benchmark', level=get_log_level(args.log_level))
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == '__main__':
+    CLI()
@@ -14,37 +14,73 @@
 
 
 """
-Clear out previous test run temp data
+Each test process keeps its logs in a current_test directory, which is
+leased and cleared out when it is first used.
 """
 
+import atexit
+import logging
 import os
 import shutil
 
-from .external import makedirs_if_not_exists
+from .external import lease_dir, makedirs_if_not_exists, release_leases
 from .logger import add_file_logger
 
 
-BASE_LOG_DIR = '/tmp/wallaroo_test_errors/current_test'
-print("Clearing out {}".format(BASE_LOG_DIR))
-shutil.rmtree(BASE_LOG_DIR, True)
+CURRENT_TEST_DIR = '/tmp/wallaroo_test_errors/current_test'
 
-# Create the dir again
-makedirs_if_not_exists(BASE_LOG_DIR)
+# This process's current_test directory, its lease and its file logger
+_base_log_dir = None
+_base_log_dir_leases = []
+_base_log_handler = None
 
-# Add a file logger saving to it in DEBUG level
-log_file = 'test.log'
-log_path = os.path.join(BASE_LOG_DIR, log_file)
-add_file_logger(log_path)
+
+def get_base_log_dir():
+    """
+    Return this process's current_test log directory.
+
+    On the first call, lease the first of current_test, current_test.1, ...
+    that no concurrent test process (e.g. a pytest-xdist worker) holds,
+    clear it out, and add a DEBUG file logger saving to test.log in it.
+    """
+    global _base_log_dir, _base_log_handler
+    if _base_log_dir is None:
+        path = lease_dir(CURRENT_TEST_DIR, _base_log_dir_leases)
+        shutil.rmtree(path, True)
+        makedirs_if_not_exists(path)
+        _base_log_handler = add_file_logger(os.path.join(path, 'test.log'))
+        _base_log_dir = path
+    return _base_log_dir
+
+
+@atexit.register
+def release_base_log_dir():
+    """
+    Remove the file logger and release the lease on this process's
+    current_test directory. A current_test.N directory is removed with it,
+    so that only current_test is left behind.
+    """
+    global _base_log_dir, _base_log_handler
+    if _base_log_dir is None:
+        return
+    logging.root.removeHandler(_base_log_handler)
+    _base_log_handler.close()
+    if _base_log_dir != CURRENT_TEST_DIR:
+        shutil.rmtree(_base_log_dir, True)
+    release_leases(_base_log_dir_leases)
+    _base_log_dir = None
+    _base_log_handler = None
 
 
 def _clean_base_log_dir():
         # clean the current test log dir
-        for f in os.listdir(BASE_LOG_DIR):
+        base_log_dir = get_base_log_dir()
+        for f in os.listdir(base_log_dir):
             if f == 'test.log':
-                with open(os.path.join(BASE_LOG_DIR, f), 'wb'):
+                with open(os.path.join(base_log_dir, f), 'wb'):
                     pass
                 continue
-            file_path = os.path.join(BASE_LOG_DIR, f)
+            file_path = os.path.join(base_log_dir, f)
             if os.path.isfile(file_path):
                 os.remove(file_path)
             elif os.path.isdir(file_path):
@@ -56,7 +92,7 @@ def clear_current_test(func):
         # clean base log dir
         _clean_base_log_dir()
         # execute the wrapped function
-        with open(os.path.join(BASE_LOG_DIR, func.__name__), 'wt'):
+        with open(os.path.join(get_base_log_dir(), func.__name__), 'wt'):
             pass
         res = func(*args, **kwargs)
         # clean base log dir again...
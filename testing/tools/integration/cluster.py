@@ -25,6 +25,8 @@ import threading
 import time
 
 
+from . import get_base_log_dir
+
 from .control import (CrashChecker,
                      SinkExpect,
                      SinkAwaitValue,
@@ -33,6 +35,7 @@ from .control import (CrashChecker,
                      WaitForLogRotation)
 
 from .end_points import (ALOSender,
+                         FileSender,
                          Metrics,
                          Sender,
                          Sink)
@@ -48,12 +51,15 @@ from .errors import (ClusterError,
 from .external import (clean_resilience_path,
                       get_port_values,
                       makedirs_if_not_exists,
+                      release_leases,
                       send_rotate_command,
                       send_shrink_command,
                       setup_resilience_path,
                       strftime,
                       STRFTIME_FMT)
 
+from .external_channel import channels as external_channels
+
 from .logger import INFO2
 
 from .observability import (cluster_status_query,
@@ -130,6 +136,7 @@ class Runner(threading.Thread):
         self.error = None
         self._file = tempfile.NamedTemporaryFile(mode='ab', dir=log_dir,
                 prefix='{}.'.format(name), suffix='.log', delete=False)
+        self.output_path = self._file.name
         self.p = None
         self.pid = None
         self._returncode = None
@@ -366,23 +373,26 @@ def start_runners(runners, command, source_addrs, sink_addrs, metrics_addr,
                               external=worker_addrs[x][2],
                               log_dir=log_dir))
 
-    # start the workers, 50ms apart
-    for idx, r in enumerate(runners):
-        r.start()
-        time.sleep(0.05)
-
+    # start the initializer, then all the other workers at once as soon as
+    # it is listening
+    runners[0].start()
+    if len(runners) > 1:
+        wait_for_initializer(runners[0])
+        for r in runners[1:]:
+            r.start()
 
     # check the runners haven't exited with any errors
     for idx, r in enumerate(runners):
         try:
             assert(r.is_alive())
         except RunnerHasntStartedError as err:
-            for x in range(8):
+            for x in range(40):
                 try:
-                    time.sleep(0.25)
+                    time.sleep(0.05)
                     assert(r.is_alive())
+                    break
                 except:
-                    if x == 7:
+                    if x == 39:
                         raise err
         except Exception as err:
             stdout = r.get_output()
@@ -397,6 +407,32 @@ def start_runners(runners, command, source_addrs, sink_addrs, metrics_addr,
                     "\n---\n%s" % (idx+1, len(runners), r.error))
 
 
+def wait_for_initializer(runner, timeout=30, interval=0.05):
+    """
+    Wait until the initializer answers a cluster status query on its
+    external channel, which it sets up just before its control channel.
+    """
+    started = time.time()
+    while True:
+        try:
+            cluster_status_query(runner.external)
+            return
+        except Exception as err:
+            try:
+                exited = runner.poll() is not None
+            except RunnerHasntStartedError:
+                exited = False
+            if exited:
+                raise ClusterError(
+                    "The initializer has exited with an error: "
+                    "\n---\n%s" % runner.get_output())
+            if time.time() - started > timeout:
+                raise ClusterError(
+                    "The initializer did not start listening after {} "
+                    "seconds. The last error was: {}".format(timeout, err))
+        time.sleep(interval)
+
+
 def add_runner(worker_id, runners, command, source_addrs, sink_addrs, metrics_addr,
                control_addr, res_dir, workers,
                my_control_addr, my_data_addr, my_external_addr,
@@ -494,13 +530,14 @@ SinkData = namedtuple('SinkData',
 
 
 class Cluster(object):
-    base_log_dir = '/tmp/wallaroo_test_errors/current_test'
+    # The process's current_test directory unless set
+    base_log_dir = None
 
     def __init__(self, command, host='127.0.0.1', sources=[], workers=1,
             sinks=1, sink_mode='framed', split_streams=False,
             worker_join_timeout=90,
             is_ready_timeout=60, res_dir=None, log_rotation=False,
-            persistent_data={}):
+            persistent_data={}, sink_spill_dir=None, ready_poll_period=0.1):
         # Create attributes
         self._finalized = False
         self._exited = False
@@ -519,16 +556,20 @@ class Cluster(object):
         self.senders = []
         self.worker_join_timeout = worker_join_timeout
         self.is_ready_timeout = is_ready_timeout
+        self.ready_poll_period = ready_poll_period
         self.metrics = Metrics(host, mode='framed')
         self.errors = []
         self._worker_id_counter = 0
+        # Leases on the ports given to workers and sources, held until
+        # the cluster is finalized
+        self.port_leases = []
         if res_dir is None:
             self.res_dir = tempfile.mkdtemp(dir='/tmp/', prefix='res-data.')
         else:
             self.res_dir = res_dir
         self.ops = []
         self.persistent_data = persistent_data
-        self.log_dir = self.base_log_dir
+        self.log_dir = self.base_log_dir or get_base_log_dir()
         makedirs_if_not_exists(self.log_dir)
         # Run a continuous crash in a background thread
         self._stoppables = set()
@@ -547,7 +588,8 @@ class Cluster(object):
 
             for s in range(sinks):
                 self.sinks.append(Sink(host, mode=sink_mode,
-                                       split_streams=split_streams))
+                                       split_streams=split_streams,
+                                       spill_dir=sink_spill_dir))
                 self.sinks[-1].start()
                 self._stoppables.add(self.sinks[-1])
                 if self.sinks[-1].err is not None:
@@ -562,8 +604,10 @@ class Cluster(object):
             sources = len(self.source_names)
             num_ports1 = (sources    ) * workers
             num_ports2 = (          3) * workers
-            ports1 = get_port_values(num=num_ports1, host=host, base_port=1900)
-            ports2 = get_port_values(num=num_ports2, host=host)
+            ports1 = get_port_values(num=num_ports1, host=host, base_port=1900,
+                                     leases=self.port_leases)
+            ports2 = get_port_values(num=num_ports2, host=host,
+                                     leases=self.port_leases)
             ports = ports1 + ports2
             addresses = ['{}:{}'.format(host, p) for p in ports]
             (source_addrs, worker_addrs) = (
@@ -597,7 +641,8 @@ class Cluster(object):
                 logging.log(1, "Testing cluster size via obs query")
                 self.query_observability(cluster_status_query,
                                          self.runners[0].external,
-                                         tests=[(worker_count_matches, [workers])])
+                                         tests=[(worker_count_matches, [workers])],
+                                         period=self.ready_poll_period)
         except Exception as err:
             logging.error("Encountered and error when starting up the cluster")
             logging.exception(err)
@@ -665,10 +710,12 @@ class Cluster(object):
         sources = len(self.source_names)
         new_ports1 = get_port_values(num = (          3) * by,
                                     host = self.host,
-                                    base_port=25000)
+                                    base_port=25000,
+                                    leases=self.port_leases)
         new_ports2 = get_port_values(num = (sources    ) * by,
                                     host = self.host,
-                                    base_port=19000)
+                                    base_port=19000,
+                                    leases=self.port_leases)
         new_ports = new_ports2 + new_ports1
         # format all the addresses to host:port using self.host
         addrs = ["{}:{}".format(self.host, p) for p in new_ports]
@@ -867,6 +914,8 @@ class Cluster(object):
         logging.log(1, "stop_workers()")
         for r in self.runners:
             r.stop()
+        external_channels.close([r.external for r in self.runners
+                                 if r.external])
         # move all live workers to dead_workers
         self.dead_workers.extend(self.workers)
         self.workers = []
@@ -930,7 +979,7 @@ class Cluster(object):
     def wait_for_sender(self, sender=-1, timeout=90):
         logging.log(1, "wait_for_sender(sender={}, timeout={})"
             .format(sender, timeout))
-        if isinstance(sender, (ALOSender, Sender)):
+        if isinstance(sender, (ALOSender, FileSender, Sender)):
             pass
         else:
             sender = self.senders[sender]
@@ -983,7 +1032,8 @@ class Cluster(object):
     def wait_to_resume_processing(self, timeout=90):
         logging.log(1, "wait_to_resume_processing(timeout={})"
             .format(timeout))
-        w = WaitForClusterToResumeProcessing(self.workers, timeout=timeout)
+        w = WaitForClusterToResumeProcessing(self.workers, timeout=timeout,
+                                             period=self.ready_poll_period)
         self._stoppables.add(w)
         w.start()
         w.join()
@@ -1114,6 +1164,7 @@ class Cluster(object):
             for s in self.sinks]
         self.persistent_data['ops'] = self.ops
         clean_resilience_path(self.res_dir)
+        release_leases(self.port_leases)
         ps_cmd = "ps aux"
         ps_out = subprocess.check_output(ps_cmd, stderr=subprocess.STDOUT,
             shell=True)
@@ -16,6 +16,8 @@ import logging
 from inspect import isfunction
 import time
 
+from .end_points import (CountWatcher,
+                         ValueWatcher)
 from .errors import (ClusterError,
                     ExpectationError,
                     TimeoutError)
@@ -29,13 +31,14 @@ from .validations import is_processing
 
 
 class WaitForClusterToResumeProcessing(StoppableThread):
-    def __init__(self, runners, timeout=90, interval=0.05):
+    def __init__(self, runners, timeout=90, interval=0.05, period=2):
         super(WaitForClusterToResumeProcessing, self).__init__()
         self.name = 'WaitForClusterToResumeProcessing'
         # Wait until all workers have resumed processing
         self.runners = runners
         self.timeout = timeout
         self.interval = interval
+        self.period = period
 
     def run(self):
         waiting = set()
@@ -47,7 +50,8 @@ class WaitForClusterToResumeProcessing(StoppableThread):
         for r in live:
             obs = ObservabilityNotifier(cluster_status_query,
                 r.external,
-                tests=is_processing, timeout=self.timeout)
+                tests=is_processing, timeout=self.timeout,
+                period=self.period)
             waiting.add(obs)
             obs.start()
         # Cycle through waiting until its empty or error
@@ -90,33 +94,32 @@ class SinkExpect(StoppableThread):
         self.name = self.__base_name__
         self.error = None
         self.allow_more = allow_more
+        self.watcher = CountWatcher(expected)
 
     def run(self):
-        started = time.time()
-        while not self.stopped():
-            msgs = len(self.sink)
-            if msgs > self.expected:
-                if not self.allow_more:
-                    self.error = ExpectationError('{}: has received too many '
-                                                  'messages. Expected {} but got '
-                                                  '{}.'.format(self.name,
-                                                               self.expected,
-                                                               msgs))
-                self.stop()
-                break
-            if msgs == self.expected:
-                self.stop()
-                break
-            if time.time() - started > self.timeout:
-                self.error = TimeoutError('{}: has timed out after {} seconds'
-                                          ', with {} messages. Expected {} '
-                                          'messages.'.format(self.name,
-                                                             self.timeout,
-                                                             msgs,
-                                                             self.expected))
-                self.stop()
-                break
-            time.sleep(0.1)
+        done = self.sink.wait_for(self.watcher, self.timeout)
+        msgs = self.watcher.received
+        if self.stopped():
+            return
+        if not done:
+            self.error = TimeoutError('{}: has timed out after {} seconds'
+                                      ', with {} messages. Expected {} '
+                                      'messages.'.format(self.name,
+                                                         self.timeout,
+                                                         msgs,
+                                                         self.expected))
+        elif msgs > self.expected and not self.allow_more:
+            self.error = ExpectationError('{}: has received too many '
+                                          'messages. Expected {} but got '
+                                          '{}.'.format(self.name,
+                                                       self.expected,
+                                                       msgs))
+        self.stop()
+
+    def stop(self, *args, **kwargs):
+        super(SinkExpect, self).stop(*args, **kwargs)
+        # wake up run()
+        self.watcher.done.set()
 
 
 class SinkAwaitValue(StoppableThread):
@@ -128,47 +131,40 @@ class SinkAwaitValue(StoppableThread):
     def __init__(self, sink, values, timeout=90, func=lambda x: x):
         super(SinkAwaitValue, self).__init__()
         self.sink = sink
-        if isinstance(values, (list, tuple)):
-            self.values = set(values)
-        else:
-            self.values = set((values, ))
+        if not isinstance(values, (list, tuple)):
+            values = (values, )
         self.timeout = timeout
         self.name = self.__base_name__
         self.error = None
         self.func = func
+        self.watcher = ValueWatcher(values, func)
+
+    @property
+    def values(self):
+        return self.watcher.values
 
     def run(self):
-        started = time.time()
         logging.debug("SinkAwait started for values: {}".format(self.values))
-        view = self.sink.view(blocking=False)
-        msgs = 0
-        while not self.stopped():
-            if not self.values:
-                self.stop()
-                logging.debug("SinkAwait complete with remaining values: {}"
-                        .format(self.values))
-                break
-            msg = next(view)
-            if msg is not None:
-                msgs += 1
-                processed = self.func(msg)
-                if processed in self.values:
-                    self.values.discard(processed)
-                    logging.debug("{} matched on value {!r}."
-                                   .format(self.name,
-                                           processed))
-            else:
-                time.sleep(0.001)
-            if time.time() - started > self.timeout:
-                self.error = TimeoutError('{}: has timed out after {} seconds'
-                                          ', with {} messages. before '
-                                          'receiving the awaited values '
-                                          '{!r}.'.format(self.name,
-                                                         self.timeout,
-                                                         msgs,
-                                                         self.values))
-                self.stop()
-                break
+        done = self.sink.wait_for(self.watcher, self.timeout)
+        if self.stopped():
+            return
+        if not done:
+            self.error = TimeoutError('{}: has timed out after {} seconds'
+                                      ', with {} messages. before '
+                                      'receiving the awaited values '
+                                      '{!r}.'.format(self.name,
+                                                     self.timeout,
+                                                     self.watcher.received,
+                                                     self.values))
+        else:
+            logging.debug("SinkAwait complete with remaining values: {}"
+                          .format(self.values))
+        self.stop()
+
+    def stop(self, *args, **kwargs):
+        super(SinkAwaitValue, self).stop(*args, **kwargs)
+        # wake up run()
+        self.watcher.done.set()
 
 
 class TryUntilTimeout(StoppableThread):
@@ -12,16 +12,23 @@
 #  implied. See the License for the specific language governing
 #  permissions and limitations under the License.
 
+import array
 import datetime
 import errno
 import io
 import logging
+import math
+import mmap
+import multiprocessing
+import os
+import selectors
 import threading
 import time
 import socket
 import struct
 
 from .errors import TimeoutError
+from .external import makedirs_if_not_exists
 from .logger import INFO2
 from .stoppable_thread import StoppableThread
 
@@ -36,102 +43,106 @@ except:
     basestring = (str, bytes)
 
 
-class SingleSocketReceiver(StoppableThread):
+class SpillAccumulator(object):
     """
-    Read length or newline encoded data from a socket and append it to an
-    accumulator list.
-    Multiple SingleSocketReceivers may write to the same accumulator safely,
-    so long as they perform atomic writes (e.g. each append adds a single,
-    complete entry).
+    A list-like accumulator that appends records to a file instead of
+    keeping them in memory, along with an in-memory index of their offsets.
+
+    Records can be read back by index, slice or iteration while records are
+    still being appended.
     """
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        # offsets[i] is the end offset of record i
+        self.offsets = array.array('Q')
+        self.size = 0
+        # held while reading, so that close() cannot pull the fd away
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'SpillAccumulator({!r}, records={})'.format(self.path,
+                                                           len(self))
 
-    __base_name__ = 'SingleSocketReceiver'
+    def append(self, bs):
+        self.extend((bs,))
+
+    def extend(self, records):
+        offsets = []
+        size = self.size
+        for bs in records:
+            size += len(bs)
+            offsets.append(size)
+        if not offsets:
+            return
+        data = b''.join(records)
+        written = 0
+        while written < len(data):
+            written += os.write(self.fd, data[written:])
+        self.size = size
+        # publish the records only after they are written
+        self.offsets.extend(offsets)
 
-    def __init__(self, sock, accumulator, mode='framed', header_fmt='>I',
-                 name=None):
-        super(SingleSocketReceiver, self).__init__()
-        self.sock = sock
-        self.accumulator = accumulator
-        self.mode = mode
-        self.header_fmt = header_fmt
-        self.header_length = struct.calcsize(self.header_fmt)
-        if name:
-            self.name = '{}:{}:{}'.format(self.__base_name__, name,
-                                          sock.fileno())
-        else:
-            self.name = '{}:{}'.format(self.__base_name__, sock.fileno())
+    def __len__(self):
+        return len(self.offsets)
+
+    def _start(self, idx):
+        return self.offsets[idx - 1] if idx else 0
+
+    def _read(self, start, end):
+        with self._lock:
+            if self.fd is not None:
+                return os.pread(self.fd, end - start, start)
+        # once closed, records are read back from the file
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def __getitem__(self, idx):
+        n = len(self.offsets)
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(n))]
+        if idx < 0:
+            idx += n
+        if not 0 <= idx < n:
+            raise IndexError("SpillAccumulator index out of range")
+        return self._read(self._start(idx), self.offsets[idx])
+
+    def __iter__(self, block_size=1 << 20):
+        n = len(self.offsets)
+        idx = 0
+        while idx < n:
+            # read as many whole records as fit in a block at once
+            start = self._start(idx)
+            last = idx
+            while (last + 1 < n and
+                   self.offsets[last + 1] - start <= block_size):
+                last += 1
+            block = self._read(start, self.offsets[last])
+            for i in range(idx, last + 1):
+                yield block[self._start(i) - start:self.offsets[i] - start]
+            idx = last + 1
 
-    def try_recv(self, bs, flags=0):
+    def close(self):
         """
-        Try to to run `sock.recv(bs)` and return None if error
+        Close the file for writing. The records can still be read.
         """
-        try:
-            return self.sock.recv(bs, flags)
-        except:
-            return None
+        with self._lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
 
-    def append(self, bs):
-        if self.mode == 'framed':
-            self.accumulator.append(bs)
-        else:
-            self.accumulator.append(bs + b'\n')
-
-    def run(self):
-        if self.mode == 'framed':
-            self.run_framed()
-        else:
-            self.run_newlines()
 
-    def run_newlines(self):
-        data = []
-        while not self.stopped():
-            buf = self.try_recv(1024)
-            if not buf:
-                self.stop()
-                if data:
-                    self.append(b''.join(data))
-                break
-            # We must be careful not to accidentally join two separate lines
-            # nor split a line
-            split = buf.split(b'\n')  # '\n' show as '' in list after split
-            s0 = split.pop(0)
-            if s0:
-                if data:
-                    data.append(s0)
-                    self.append(b''.join(data))
-                    data = []
-                else:
-                    self.append(s0)
-            else:
-                # s0 is '', so first line is a '\n', and overflow is a
-                # complete message if it isn't empty
-                if data:
-                    self.append(b''.join(data))
-                    data = []
-            for s in split[:-1]:
-                self.append(s)
-            if split:  # not an empty list
-                if split[-1]:  # not an empty string, i.e. it wasn't a '\n'
-                    data.append(split[-1])
-            time.sleep(0.000001)
-
-    def run_framed(self):
-        while not self.stopped():
-            header = self.try_recv(self.header_length, socket.MSG_WAITALL)
-            if not header:
-                self.stop()
-                continue
-            expect = struct.unpack(self.header_fmt, header)[0]
-            data = self.try_recv(expect, socket.MSG_WAITALL)
-            if not data:
-                self.stop()
-            else:
-                self.append(b''.join((header, data)))
-                time.sleep(0.000001)
-
-    def stop(self, *args, **kwargs):
-        super(self.__class__, self).stop(*args, **kwargs)
-        self.sock.close()
+class _Connection(object):
+    """
+    Receive state for a single client connection of a TCPReceiver.
+    """
+    def __init__(self, sock, name, accumulator, buffer_size):
+        self.sock = sock
+        self.name = name
+        self.accumulator = accumulator
+        self.buf = bytearray(buffer_size)
+        self.filled = 0
 
 
 class MultiClientStreamView(object):
@@ -162,6 +173,11 @@ class MultiClientStreamView(object):
         # sleep condition
         origin = self.key_position
         while True:
+            if not self.keys:
+                time.sleep(0.001)
+                if self.blocking:
+                    continue
+                return None
             # get current key
             cur = self.keys[self.key_position]
             # set key for next iteration
@@ -182,6 +198,102 @@ class MultiClientStreamView(object):
                     return None
             # implicit:  continue
 
+
+class _Stream(object):
+    def __init__(self, name, accumulator):
+        self.name = name
+        self.accumulator = accumulator
+
+
+class SinkWatcher(object):
+    """
+    A predicate over the records a TCPReceiver receives, evaluated
+    incrementally as they arrive.
+
+    Register it with `TCPReceiver.watch`. It is first fed every record
+    received so far, then every new batch of records, until `update`
+    returns True. `done` is then set and the watcher is unregistered.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.received = 0
+
+    def catch_up(self, receiver):
+        for acc in list(receiver.data.values()):
+            self.feed(list(acc))
+
+    def feed(self, records):
+        if self.done.is_set():
+            return
+        self.received += len(records)
+        if self.update(records):
+            self.done.set()
+
+    def update(self, records):
+        """
+        Process a batch of records and return True once complete.
+        """
+        raise NotImplementedError
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+class CountWatcher(SinkWatcher):
+    """
+    Complete once `expected` records have been received.
+    """
+    def __init__(self, expected):
+        super(CountWatcher, self).__init__()
+        self.expected = expected
+
+    def catch_up(self, receiver):
+        # only the count matters, so skip reading the records
+        self.received = len(receiver)
+        if self.received >= self.expected:
+            self.done.set()
+
+    def update(self, records):
+        return self.received >= self.expected
+
+
+class ValueWatcher(SinkWatcher):
+    """
+    Complete once `func(record)` has matched every one of `values`.
+    """
+    def __init__(self, values, func=lambda x: x):
+        super(ValueWatcher, self).__init__()
+        self.values = set(values)
+        self.func = func
+
+    def update(self, records):
+        for r in records:
+            processed = self.func(r)
+            if processed in self.values:
+                self.values.discard(processed)
+                logging.debug("ValueWatcher matched on value {!r}."
+                              .format(processed))
+        return not self.values
+
+
+class MatchWatcher(SinkWatcher):
+    """
+    Complete on the first record for which `matcher(record)` is true.
+    `matched` is that record.
+    """
+    def __init__(self, matcher):
+        super(MatchWatcher, self).__init__()
+        self.matcher = matcher
+        self.matched = None
+
+    def update(self, records):
+        for r in records:
+            if self.matcher(r):
+                self.matched = r
+                return True
+        return False
+
+
 class TCPReceiver(StoppableThread):
     """
     Listen on a (host,port) pair and write any incoming data to an accumulator.
@@ -197,43 +309,66 @@ class TCPReceiver(StoppableThread):
     use a length-encoded framing, along with the `header_fmt` value (default
     mode is `'framed'` with `header_fmt='>I'`).
 
+    All connections are served by this one thread with a selector. Each
+    connection reads into a `buffer_size` buffer with `recv_into`, and all
+    complete records in it are split off and added to the accumulator at
+    once.
+
     You can read any data saved to the accumulator (a list) at any time
     by reading the `data` attribute of the receiver, although this attribute
     is only guaranteed to stop growing after `stop()` has been called.
+
+    If `spill_dir` is set, records are appended to a file per stream in that
+    directory instead of being kept in memory, and `data` holds
+    SpillAccumulators, which can be read like lists.
+
+    `len()` and `bytes_received()` are running counts of all streams.
+
+    Use `watch` or `wait_for` with a SinkWatcher to be notified when the
+    received records meet a condition, instead of polling `data`.
     """
     __base_name__ = 'TCPReceiver'
 
     def __init__(self, host, port=0, max_connections=1000, mode='framed',
-                 split_streams=False, header_fmt='>I'):
+                 split_streams=False, header_fmt='>I', spill_dir=None,
+                 buffer_size=1 << 20):
         """
         Listen on a (host, port) pair for up to max_connections connections.
-        Each connection is handled by a separate client thread.
         """
         super(TCPReceiver, self).__init__()
         self.host = host
         self.port = port
         self.address = '{}.{}'.format(host, port)
         self.max_connections = max_connections
+        if mode not in ('framed', 'newlines'):
+            raise ValueError("`mode` must be either 'framed' or 'newlines'")
         self.mode = mode
         self.split_streams = split_streams
         self.header_fmt = header_fmt
         self.header_length = struct.calcsize(self.header_fmt)
+        self.spill_dir = spill_dir
+        self.buffer_size = buffer_size
         # use an in-memory byte buffer
         self.data = {}
         # Create a socket and start listening
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.selector = selectors.DefaultSelector()
         self.clients = []
         self.err = None
         self.event = threading.Event()
         self.start_time = None
         self.views = []
+        self._records = 0
+        self._bytes = 0
+        self.watchers = []
+        self.watch_lock = threading.Lock()
 
     def __len__(self):
-        return sum(map(len, self.data.values()))
+        return self._records
 
     def bytes_received(self):
-        return sum( sum(map(len, acc)) for acc in d.values() )
+        return self._bytes
 
     def get_connection_info(self, timeout=10):
         is_connected = self.event.wait(timeout)
@@ -242,60 +377,179 @@ class TCPReceiver(StoppableThread):
                                " seconds".format(self.__base_name__, timeout))
         return self.sock.getsockname()
 
+    def new_accumulator(self, stream):
+        """
+        Return the accumulator for a new stream. It must support `append`,
+        `extend`, `len` and indexing, like a list.
+        """
+        if self.spill_dir is not None:
+            makedirs_if_not_exists(self.spill_dir)
+            return SpillAccumulator(os.path.join(
+                self.spill_dir, '{}.{}.{}.frames'.format(
+                    self.__base_name__, self.port,
+                    'all' if stream == '*' else stream)))
+        return []
+
     def run(self):
         self.start_time = datetime.datetime.now()
         try:
             self.sock.bind((self.host, self.port))
             self.sock.listen(self.max_connections)
+            self.sock.setblocking(False)
             self.host, self.port = self.sock.getsockname()
+            self.selector.register(self.sock, selectors.EVENT_READ)
             self.event.set()
             while not self.stopped():
-                try:
-                    (clientsocket, address) = self.sock.accept()
-                except Exception as err:
-                    try:
-                        if self.stopped():
-                            break
-                        else:
-                            raise err
-                    except OSError as err:
-                        if err.errno == errno.ECONNABORTED:
-                            # [ECONNABORTED] A connection arrived, but it was
-                            # closed while waiting on the listen queue.
-                            # This happens on macOS during normal
-                            # harness shutdown.
-                            return
-                        else:
-                            logging.error("socket accept errno {}"
-                                .format(err.errno))
-                            self.err = err
-                            raise
-                if self.split_streams:
-                    # Use a counter to identify unique streams
-                    client_accumulator = self.data.setdefault(len(self.data),
-                                                              [])
-                else:
-                    # use * to identify the "everything" stream
-                    client_accumulator = self.data.setdefault('*', [])
-                cl = SingleSocketReceiver(clientsocket,
-                                          client_accumulator,
-                                          self.mode,
-                                          self.header_fmt,
-                                          name='{}-{}'.format(
-                                              self.__base_name__,
-                                              len(self.clients)))
-                logging.debug("{}:{} accepting connection from ({}, {}) on "
-                             "port {}."
-                             .format(self.__base_name__, self.name, self.host,
-                                     self.port, address[1]))
-                self.clients.append(cl)
-                if self.views:
-                    for v in self.views:
-                        v.add_stream(cl)
-                cl.start()
+                for key, _ in self.selector.select(timeout=0.05):
+                    if key.fileobj is self.sock:
+                        self.accept()
+                    else:
+                        self.receive(key.data)
         except Exception as err:
-            self.err = err
+            if not self.stopped():
+                self.err = err
+                raise
+        finally:
+            for conn in list(self.clients):
+                self.close_connection(conn)
+            self.selector.close()
+            for accumulator in self.data.values():
+                close = getattr(accumulator, 'close', None)
+                if close is not None:
+                    close()
+
+    def accept(self):
+        try:
+            (clientsocket, address) = self.sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as err:
+            if self.stopped():
+                # stop() shut the listening socket down
+                return
+            if err.errno == errno.ECONNABORTED:
+                # [ECONNABORTED] A connection arrived, but it was
+                # closed while waiting on the listen queue.
+                return
+            logging.error("socket accept errno {}".format(err.errno))
             raise
+        clientsocket.setblocking(False)
+        if self.split_streams:
+            # Use a counter to identify unique streams
+            stream = len(self.data)
+        else:
+            # use * to identify the "everything" stream
+            stream = '*'
+        new_stream = stream not in self.data
+        if new_stream:
+            self.data[stream] = self.new_accumulator(stream)
+        conn = _Connection(clientsocket,
+                           '{}-{}:{}'.format(self.__base_name__,
+                                             len(self.clients), stream),
+                           self.data[stream], self.buffer_size)
+        logging.debug("{}:{} accepting connection from ({}, {}) on "
+                      "port {}."
+                      .format(self.__base_name__, self.name, self.host,
+                              self.port, address[1]))
+        self.clients.append(conn)
+        self.selector.register(clientsocket, selectors.EVENT_READ, conn)
+        if new_stream:
+            for v in self.views:
+                v.add_stream(_Stream(stream, self.data[stream]))
+
+    def receive(self, conn):
+        if conn.filled == len(conn.buf):
+            # a record larger than the buffer
+            conn.buf.extend(bytearray(len(conn.buf)))
+        try:
+            n = conn.sock.recv_into(memoryview(conn.buf)[conn.filled:])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            n = 0
+        if not n:
+            if self.mode == 'newlines' and conn.filled:
+                # the last line may be missing its newline
+                self.add(conn, [bytes(conn.buf[:conn.filled]) + b'\n'])
+                conn.filled = 0
+            self.close_connection(conn)
+            return
+        conn.filled += n
+        if self.mode == 'framed':
+            records, end = self.split_framed(conn.buf, conn.filled)
+        else:
+            records, end = self.split_newlines(conn.buf, conn.filled)
+        if records:
+            self.add(conn, records)
+            # keep the incomplete record at the start of the buffer
+            conn.buf[:conn.filled - end] = conn.buf[end:conn.filled]
+            conn.filled -= end
+
+    def split_framed(self, buf, filled):
+        records = []
+        pos = 0
+        header_length = self.header_length
+        while filled - pos >= header_length:
+            end = (pos + header_length +
+                   struct.unpack_from(self.header_fmt, buf, pos)[0])
+            if end > filled:
+                break
+            records.append(bytes(buf[pos:end]))
+            pos = end
+        return records, pos
+
+    def split_newlines(self, buf, filled):
+        end = buf.rfind(b'\n', 0, filled) + 1
+        if not end:
+            return [], 0
+        return [l + b'\n' for l in bytes(buf[:end - 1]).split(b'\n')], end
+
+    def add(self, conn, records):
+        with self.watch_lock:
+            conn.accumulator.extend(records)
+            self._bytes += sum(map(len, records))
+            self._records += len(records)
+            if self.watchers:
+                for w in self.watchers:
+                    w.feed(records)
+                self.watchers = [w for w in self.watchers
+                                 if not w.done.is_set()]
+
+    def watch(self, watcher):
+        """
+        Feed `watcher` everything received so far, and then every new batch
+        of records until it is done.
+        """
+        with self.watch_lock:
+            watcher.catch_up(self)
+            if not watcher.done.is_set():
+                self.watchers.append(watcher)
+        return watcher
+
+    def unwatch(self, watcher):
+        with self.watch_lock:
+            if watcher in self.watchers:
+                self.watchers.remove(watcher)
+
+    def wait_for(self, watcher, timeout=None):
+        """
+        Block until `watcher` is done or `timeout` seconds have passed.
+        Returns True if the watcher is done.
+        """
+        self.watch(watcher)
+        try:
+            return watcher.wait(timeout)
+        finally:
+            self.unwatch(watcher)
+
+    def close_connection(self, conn):
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        if conn in self.clients:
+            self.clients.remove(conn)
+        conn.sock.close()
 
     def stop(self, *args, **kwargs):
         if not self.stopped():
@@ -310,11 +564,11 @@ class TCPReceiver(StoppableThread):
                 else:
                     raise
             self.sock.close()
-            for cl in self.clients:
-                cl.stop()
 
     def view(self, blocking=True):
-        view = MultiClientStreamView(self.clients, blocking=blocking)
+        view = MultiClientStreamView(
+            [_Stream(k, v) for k, v in list(self.data.items())],
+            blocking=blocking)
         self.views.append(view)
         return view
 
@@ -351,6 +605,191 @@ class Sink(TCPReceiver):
     __base_name__ = 'Sink'
 
 
+def now_ns():
+    """
+    Wall clock time in integer nanoseconds.
+    """
+    try:
+        return time.time_ns()
+    except AttributeError:
+        return int(time.time() * 1e9)
+
+
+class LatencyHistogram(object):
+    """
+    A log-linear histogram of non-negative integer values, in the style of
+    HdrHistogram.
+
+    Values are counted into buckets whose width doubles with every power of
+    two, and each power of two is split into enough sub-buckets that any
+    recorded value is reported to within `significant_digits` decimal
+    digits of precision. Counts are kept in a dict, so there is no upper
+    bound on the values that can be recorded.
+    """
+    def __init__(self, significant_digits=3):
+        if not 1 <= significant_digits <= 5:
+            raise ValueError("significant_digits must be between 1 and 5")
+        self.significant_digits = significant_digits
+        sub_bucket_count_magnitude = int(math.ceil(
+            math.log(2 * 10 ** significant_digits, 2)))
+        self._half_magnitude = sub_bucket_count_magnitude - 1
+        self._half_count = 1 << self._half_magnitude
+        self._mask = (1 << sub_bucket_count_magnitude) - 1
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        bucket = ((value | self._mask).bit_length() -
+                  (self._half_magnitude + 1))
+        sub_bucket = value >> bucket
+        return ((bucket + 1) << self._half_magnitude) + (sub_bucket -
+                                                         self._half_count)
+
+    def _range(self, index):
+        """
+        Return the (lowest, highest) values counted at `index`.
+        """
+        bucket = (index >> self._half_magnitude) - 1
+        sub_bucket = (index & (self._half_count - 1)) + self._half_count
+        if bucket < 0:
+            sub_bucket -= self._half_count
+            bucket = 0
+        lowest = sub_bucket << bucket
+        return lowest, lowest + (1 << bucket) - 1
+
+    def record(self, value, count=1):
+        value = max(0, int(value))
+        idx = self._index(value)
+        self.counts[idx] = self.counts.get(idx, 0) + count
+        self.total += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.significant_digits != self.significant_digits:
+            raise ValueError("Can't merge histograms of different precision")
+        for idx, count in other.counts.items():
+            self.counts[idx] = self.counts.get(idx, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        for v in (other.min, other.max):
+            if v is not None:
+                if self.min is None or v < self.min:
+                    self.min = v
+                if self.max is None or v > self.max:
+                    self.max = v
+
+    def mean(self):
+        return float(self.sum) / self.total if self.total else None
+
+    def value_at_percentile(self, percentile):
+        """
+        Return the highest value equivalent to the one at `percentile`
+        (0-100), or None if the histogram is empty.
+        """
+        if not self.total:
+            return None
+        rank = max(1, int(math.ceil(self.total * percentile / 100.0)))
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= rank:
+                return min(self._range(idx)[1], self.max)
+        return self.max
+
+    def percentiles(self, percentiles=(50, 90, 95, 99, 99.9, 99.99)):
+        return {str(p): self.value_at_percentile(p) for p in percentiles}
+
+    def summary(self):
+        out = {'count': self.total,
+               'min': self.min,
+               'max': self.max,
+               'mean': self.mean()}
+        out.update(self.percentiles())
+        return out
+
+
+def stamp_prefix(ts, body):
+    """
+    The default stamp for `OpenLoopSender`: the intended send time as a
+    U64 of nanoseconds, followed by the original record.
+    """
+    return struct.pack('>Q', ts) + body
+
+
+class LatencySink(TCPReceiver):
+    """
+    A Sink that records the end-to-end latency of every record it receives
+    in a LatencyHistogram.
+
+    The latency of a record is its arrival time minus the timestamp that
+    `extract(record)` returns, in nanoseconds. In framed mode the record
+    includes its length header. The default `extract` reads a U64 at the
+    start of the payload, as written by `OpenLoopSender` with
+    `stamp_prefix`, so it works with any application that passes its input
+    through unchanged at the front of its output.
+
+    Received records are kept in `data` only if `keep_data` is True.
+    """
+    __base_name__ = 'LatencySink'
+
+    def __init__(self, host, port=0, mode='framed', split_streams=False,
+                 header_fmt='>I', extract=None, significant_digits=3,
+                 keep_data=False):
+        super(LatencySink, self).__init__(host, port, mode=mode,
+                                          split_streams=split_streams,
+                                          header_fmt=header_fmt)
+        if extract is None:
+            offset = self.header_length if mode == 'framed' else 0
+            extract = lambda bs: struct.unpack_from('>Q', bs, offset)[0]
+        self.extract = extract
+        self.keep_data = keep_data
+        self.histogram = LatencyHistogram(significant_digits)
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def new_accumulator(self, stream):
+        return _LatencyAccumulator(self)
+
+    def record(self, bs):
+        now = now_ns()
+        try:
+            ts = self.extract(bs)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            return
+        with self.lock:
+            self.histogram.record(now - ts)
+
+    def summary(self):
+        with self.lock:
+            out = self.histogram.summary()
+            out['errors'] = self.errors
+            return out
+
+
+class _LatencyAccumulator(list):
+    def __init__(self, sink):
+        super(_LatencyAccumulator, self).__init__()
+        self.sink = sink
+
+    def append(self, bs):
+        self.extend((bs,))
+
+    def extend(self, records):
+        for bs in records:
+            self.sink.record(bs)
+        if self.sink.keep_data:
+            super(_LatencyAccumulator, self).extend(records)
+
+
 class Sender(StoppableThread):
     """
     Send length framed data to a destination (addr).
@@ -494,6 +933,356 @@ class Sender(StoppableThread):
                              "a MultiSequenceGenerator, or an ALOSender.")
 
 
+class OpenLoopSender(Sender):
+    """
+    Send length framed data to a destination at a fixed rate, regardless of
+    how fast the destination accepts it.
+
+    Record `n` is due `n / rate` seconds after the sender starts. Every
+    record is re-framed with `stamp(ts, body)` as its payload, where `ts` is
+    the time in nanoseconds at which it was due, not when it was actually
+    sent. When the destination applies backpressure, the records that fell
+    due in the meantime are sent as soon as it frees up, and their latency,
+    as measured by a LatencySink, includes the time they spent waiting to
+    be sent. This avoids the coordinated omission of Sender, whose clock
+    stops when the destination stalls.
+
+    `rate` is in records per second.
+    `max_batch` caps how many due records are sent in a single write.
+    `report_interval` is how often, in seconds, the backlog of due but
+        unsent records is sampled into `backlog` and logged if non-zero.
+    """
+    def __init__(self, address, reader, rate, stamp=stamp_prefix,
+                 max_batch=1000, report_interval=1.0, header_fmt='>I'):
+        super(OpenLoopSender, self).__init__(address, reader,
+                                             batch_size=max_batch,
+                                             interval=0,
+                                             header_fmt=header_fmt)
+        self.name = 'OpenLoopSender'
+        self.rate = float(rate)
+        self.stamp = stamp
+        self.max_batch = max_batch
+        self.report_interval = report_interval
+        self.sent = 0
+        # list of (time, due but unsent records)
+        self.backlog = []
+        self.max_backlog = 0
+
+    def read_record(self):
+        header = self.reader.read(self.header_length)
+        if not header:
+            return None
+        expect = struct.unpack(self.header_fmt, header)[0]
+        body = self.reader.read(expect)
+        if not body:
+            return None
+        return body
+
+    def run(self):
+        self.start_time = datetime.datetime.now()
+        start = now_ns()
+        period = 1e9 / self.rate
+        next_report = time.time() + self.report_interval
+        try:
+            logging.info("OpenLoopSender connecting to ({}, {})."
+                         .format(self.host, self.port))
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.connect((self.host, self.port))
+            while not self.stopped():
+                if self.paused():
+                    # Time keeps running while paused: the records that
+                    # fall due are sent on resume.
+                    time.sleep(0.001)
+                    continue
+                now = now_ns()
+                due = int((now - start) / period) + 1
+                backlog = due - self.sent
+                if time.time() >= next_report:
+                    next_report += self.report_interval
+                    self.backlog.append((time.time(), max(backlog - 1, 0)))
+                    if backlog > 1:
+                        logging.info("OpenLoopSender is {} records ({:.3f}s) "
+                                     "behind schedule".format(
+                                         backlog - 1,
+                                         (backlog - 1) * period / 1e9))
+                self.max_backlog = max(self.max_backlog, backlog - 1)
+                if backlog <= 0:
+                    # sleep until the next record is due
+                    time.sleep(max(0, start + self.sent * period - now) / 1e9)
+                    continue
+                done = False
+                for _ in range(min(backlog, self.max_batch)):
+                    body = self.read_record()
+                    if body is None:
+                        done = True
+                        break
+                    body = self.stamp(int(start + self.sent * period), body)
+                    self.batch_append(struct.pack(self.header_fmt, len(body)))
+                    self.batch_append(body)
+                    self.sent += 1
+                self.batch_send_final()
+                if done:
+                    self.stop()
+        except Exception as err:
+            self.error = err
+            logging.error(err)
+        finally:
+            self.sock.close()
+
+
+def encode_to_file(generator, path):
+    """
+    Write the length framed records of a generator, such as
+    `files_generator` or `sequence_generator`, to a file that FileSender
+    can send.
+    """
+    with open(path, 'wb') as f:
+        for bs in generator:
+            f.write(bs)
+    return path
+
+
+def framed_file_chunks(path, chunk_size, header_fmt='>I'):
+    """
+    Split a length framed file into chunks of about `chunk_size` bytes that
+    start and end on record boundaries.
+    Returns a list of (offset, length, records) tuples.
+    """
+    header_length = struct.calcsize(header_fmt)
+    chunks = []
+    size = os.path.getsize(path)
+    if not size:
+        return chunks
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = pos = records = 0
+            while pos + header_length <= size:
+                pos += (header_length +
+                        struct.unpack_from(header_fmt, mm, pos)[0])
+                records += 1
+                if pos - start >= chunk_size:
+                    chunks.append((start, pos - start, records))
+                    start, records = pos, 0
+            if pos != size:
+                raise ValueError("{} ends with a truncated record"
+                                 .format(path))
+            if records:
+                chunks.append((start, pos - start, records))
+        finally:
+            mm.close()
+    return chunks
+
+
+def _file_sender_process(idx, host, port, path, chunks, repeat, counters,
+                         pause_event, stop_event, idle_event):
+    """
+    Send `chunks` of `path` over a single connection, `repeat` times.
+    Runs in its own process.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect((host, port))
+    use_sendfile = hasattr(os, 'sendfile')
+    with open(path, 'rb') as f:
+        mm = None if use_sendfile else mmap.mmap(f.fileno(), 0,
+                                                 access=mmap.ACCESS_READ)
+        try:
+            for _ in range(repeat):
+                for offset, length, records in chunks:
+                    while pause_event.is_set() and not stop_event.is_set():
+                        idle_event.set()
+                        time.sleep(0.001)
+                    idle_event.clear()
+                    if stop_event.is_set():
+                        return
+                    if use_sendfile:
+                        sent = 0
+                        while sent < length:
+                            sent += os.sendfile(sock.fileno(), f.fileno(),
+                                                offset + sent, length - sent)
+                    else:
+                        sock.sendall(memoryview(mm)[offset:offset + length])
+                    counters[3 * idx] += length
+                    counters[3 * idx + 1] += records
+                    counters[3 * idx + 2] += 1
+        finally:
+            idle_event.set()
+            if mm is not None:
+                mm.close()
+            sock.close()
+
+
+class FileSender(StoppableThread):
+    """
+    Send a pre-encoded, length framed file to a destination from
+    `connections` separate processes, each with its own connection.
+
+    The file is split into chunks of about `chunk_size` bytes on record
+    boundaries, and the chunks are dealt round-robin to the connections.
+    Each process sends its chunks straight from the file with
+    `os.sendfile`, or from a memory map where that isn't available, so
+    records are never decoded in Python. With more than one connection, the
+    order of records across connections is not preserved.
+
+    The file is sent `repeat` times. Pausing takes effect at the end of the
+    chunk each process is sending.
+
+    The aggregate rate of all processes is logged every `report_interval`
+    seconds and saved in `rates` as (time, records/s, bytes/s) tuples.
+
+    Use `encode_to_file` to turn any generator into a file this can send.
+    FileSender can be used with Cluster.add_sender like a Sender. Like
+    Sender's, its `data` lists what it has sent, one item per chunk, but
+    the chunks are read back from the file when they are accessed.
+    """
+    def __init__(self, address, path, connections=1, repeat=1,
+                 chunk_size=1 << 20, header_fmt='>I', report_interval=1.0):
+        super(FileSender, self).__init__()
+        (host, port) = address.split(":")
+        self.address = address
+        self.host = host
+        self.port = int(port)
+        self.path = path
+        self.connections = connections
+        self.repeat = repeat
+        self.report_interval = report_interval
+        self.name = 'FileSender'
+        self.start_time = None
+        self.rates = []
+        chunks = framed_file_chunks(path, chunk_size, header_fmt)
+        self.chunks = chunks
+        self.total_records = sum(c[2] for c in chunks) * repeat
+        # bytes, records and chunks sent by each connection
+        self.counters = multiprocessing.Array('Q', 3 * connections,
+                                              lock=False)
+        self.data = _SentChunks(self)
+        self.pause_event = multiprocessing.Event()
+        self.process_stop_event = multiprocessing.Event()
+        self.idle_events = [multiprocessing.Event()
+                            for _ in range(connections)]
+        self.processes = [
+            multiprocessing.Process(
+                target=_file_sender_process,
+                args=(i, self.host, self.port, path,
+                      chunks[i::connections], repeat, self.counters,
+                      self.pause_event, self.process_stop_event,
+                      self.idle_events[i]))
+            for i in range(connections)]
+        for p in self.processes:
+            p.daemon = True
+
+    @property
+    def batch(self):
+        """
+        The connections that are still sending after a pause, for
+        compatibility with Sender during validations.
+        """
+        if not self.paused():
+            return []
+        return [i for i, e in enumerate(self.idle_events)
+                if not e.is_set() and self.processes[i].is_alive()]
+
+    def pause(self):
+        self.pause_event.set()
+
+    def paused(self):
+        return self.pause_event.is_set()
+
+    def resume(self):
+        self.pause_event.clear()
+
+    def bytes_sent(self):
+        return sum(self.counters[0::3])
+
+    def records_sent(self):
+        return sum(self.counters[1::3])
+
+    def chunks_sent(self, connection):
+        """
+        The (offset, length, records) of the chunks that `connection` has
+        sent, in order.
+        """
+        own = self.chunks[connection::self.connections]
+        return [own[i % len(own)]
+                for i in range(self.counters[3 * connection + 2])]
+
+    def run(self):
+        self.start_time = datetime.datetime.now()
+        for p in self.processes:
+            p.start()
+        last = (time.time(), 0, 0)
+        next_report = last[0] + self.report_interval
+        while any(p.is_alive() for p in self.processes):
+            self.stop_event.wait(0.05)
+            if self.stopped():
+                self.process_stop_event.set()
+            if time.time() < next_report:
+                continue
+            next_report += self.report_interval
+            now = (time.time(), self.records_sent(), self.bytes_sent())
+            elapsed = now[0] - last[0]
+            rate = (now[0], (now[1] - last[1]) / elapsed,
+                    (now[2] - last[2]) / elapsed)
+            self.rates.append(rate)
+            logging.info("FileSender({}): {:.0f} records/s, {:.2f} MB/s "
+                         "over {} connections".format(
+                             self.address, rate[1], rate[2] / 1e6,
+                             self.connections))
+            last = now
+        for p in self.processes:
+            p.join()
+        failed = [p.exitcode for p in self.processes if p.exitcode]
+        if failed and not self.stopped():
+            self.error = RuntimeError("FileSender({}) processes exited with "
+                                      "codes {}".format(self.address, failed))
+            logging.error(self.error)
+        super(FileSender, self).stop()
+
+    def stop(self, *args, **kwargs):
+        if not self.stopped():
+            logging.log(INFO2, "FileSender received stop instruction.")
+        super(FileSender, self).stop(*args, **kwargs)
+        self.process_stop_event.set()
+
+
+class _SentChunks(object):
+    """
+    A read-only list of the chunks a FileSender has sent so far, as bytes,
+    connection by connection. Chunks are read from the sender's file when
+    they are accessed, so the records are never all held in memory.
+    """
+    def __init__(self, sender):
+        self.sender = sender
+
+    def __repr__(self):
+        return '_SentChunks({!r}, chunks={})'.format(self.sender.path,
+                                                     len(self))
+
+    def _chunks(self):
+        chunks = []
+        for i in range(self.sender.connections):
+            chunks.extend(self.sender.chunks_sent(i))
+        return chunks
+
+    def _read(self, chunks):
+        with open(self.sender.path, 'rb') as f:
+            for offset, length, _records in chunks:
+                f.seek(offset)
+                yield f.read(length)
+
+    def __len__(self):
+        return sum(self.sender.counters[2::3])
+
+    def __getitem__(self, idx):
+        chunks = self._chunks()
+        if isinstance(idx, slice):
+            return list(self._read(chunks[idx]))
+        return next(self._read([chunks[idx]]))
+
+    def __iter__(self):
+        return self._read(self._chunks())
+
+
 class NoNonzeroError(ValueError):
     pass
 
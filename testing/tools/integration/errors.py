@@ -68,3 +68,7 @@ class NotEmptyError(Exception):
 
 class ValidationError(Exception):
     pass
+
+
+class ExternalChannelError(Exception):
+    pass
@@ -14,6 +14,7 @@
 
 
 from collections import namedtuple
+import fcntl
 import logging
 import os
 import re
@@ -21,6 +22,9 @@ import shlex
 import shutil
 import socket
 import subprocess
+import tempfile
+
+from .external_channel import channels
 
 
 ShellCmdResult = namedtuple('ShellCmdResult',
@@ -88,48 +92,129 @@ def is_address_available(host, port):
         return False
 
 
-def get_port_values(num=1, host='127.0.0.1', base_port=20000):
+# Where leases are kept. Every process sharing a host must use the same one.
+LEASE_DIR = os.environ.get('WALLAROO_LEASE_DIR',
+                           os.path.join(tempfile.gettempdir(),
+                                        'wallaroo_leases'))
+
+# Leases taken without an owner are held until the process exits
+_process_leases = []
+
+
+class Lease(object):
+    """
+    An exclusive claim on a named resource, such as a port, that is safe
+    across processes.
+
+    The claim is an flock on a file in LEASE_DIR, so it is dropped when
+    `release` is called or when the process exits, however it exits.
+    """
+    def __init__(self, name, fd):
+        self.name = name
+        self._fd = fd
+
+    def __repr__(self):
+        return "Lease({!r})".format(self.name)
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def acquire_lease(name):
+    """
+    Return a Lease on `name`, or None if another holder has it.
+    """
+    makedirs_if_not_exists(LEASE_DIR)
+    fd = os.open(os.path.join(LEASE_DIR, '{}.lock'.format(name)),
+                 os.O_CREAT | os.O_RDWR, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        os.close(fd)
+        return None
+    return Lease(name, fd)
+
+
+def release_leases(leases):
+    while leases:
+        leases.pop().release()
+
+
+def get_port_values(num=1, host='127.0.0.1', base_port=20000, leases=None):
     """
     Get the requested number (default: 1) of free ports for a given host
     (default: '127.0.0.1'), starting from base_port (default: 20000).
-    """
 
+    Each port is leased, so concurrent callers, in this or any other
+    process, never get the same port. The leases are appended to `leases`
+    so that the caller can release them with `release_leases`, or if
+    `leases` is None, held until the process exits.
+    """
+    if leases is None:
+        leases = _process_leases
     ports = []
 
     # Select source listener ports
     while len(ports) < num:
-        if is_address_available(host, base_port):
-            ports.append(base_port)
+        if base_port > 65535:
+            raise ValueError("Ran out of ports to lease")
+        lease = acquire_lease('port.{}'.format(base_port))
+        if lease is not None:
+            if is_address_available(host, base_port):
+                ports.append(base_port)
+                leases.append(lease)
+            else:
+                lease.release()
         base_port += 1
     return ports
 
 
+def lease_dir(path, leases=None):
+    """
+    Return the first of `path`, `path.1`, `path.2`, ... that is not leased
+    by anyone else, and lease it. The lease is appended to `leases`, or
+    if `leases` is None, held until the process exits.
+
+    Use it for fixed working directories that a process clears and reuses,
+    so that concurrent test processes each get their own.
+    """
+    if leases is None:
+        leases = _process_leases
+    candidate = path
+    n = 0
+    while True:
+        lease = acquire_lease('dir.{}'.format(
+            candidate.strip(os.sep).replace(os.sep, '.')))
+        if lease is not None:
+            leases.append(lease)
+            return candidate
+        n += 1
+        candidate = '{}.{}'.format(path, n)
+
+
 def send_rotate_command(addr, worker):
     """
     Trigger log rotation with external message
     """
-    cmd_external_rotate = ('external_sender --external {} --type rotate-log '
-                           '--message {}'.format(addr, worker))
-    res = run_shell_cmd(cmd_external_rotate)
     try:
-        assert(res.success)
-    except AssertionError:
+        channels.channel(addr).rotate_log(worker)
+    except Exception as err:
         raise AssertionError('External log rotation trigger failed with '
-                             'the error:\n{}'.format(res))
-    return res.output
+                             'the error:\n{}'.format(err))
 
 
 def send_shrink_command(addr, workers):
-    cmd_external_trigger = ('cluster_shrinker --external {} --workers {}'
-                            .format(addr, workers))
-
-    res = run_shell_cmd(cmd_external_trigger)
+    """
+    Ask the cluster to remove `workers`, a comma delimited string of
+    worker names, and return its response.
+    """
     try:
-        assert(res.success)
-    except AssertionError:
+        return channels.channel(addr).shrink(workers.split(','))
+    except Exception as err:
         raise AssertionError('External shrink trigger failed with '
-                             'the error:\n{}'.format(res))
-    return res.output
+                             'the error:\n{}'.format(err))
 
 
 def makedirs_if_not_exists(dirpath):
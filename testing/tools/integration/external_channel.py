@@ -0,0 +1,330 @@
+# Copyright 2017 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+
+"""
+A client for the Wallaroo worker external channel.
+
+This speaks the same wire format as `external_sender` and
+`cluster_shrinker`: a U32 length header, then a U16 message type and a
+text payload. Each worker is reached over one persistent connection, and
+`ExternalChannelPool.query_many` queries many workers concurrently.
+
+From the command line:
+
+    PYTHONPATH=testing/tools python3 -m integration.external_channel \\
+        --type cluster-status-query --external 127.0.0.1:5050 \\
+        --external 127.0.0.1:5060
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import select
+import socket
+import struct
+import sys
+import threading
+
+from .errors import ExternalChannelError
+
+
+# Message types, as in lib/wallaroo_labs/messages/external_messages.pony
+PRINT = 1
+ROTATE_LOG = 2
+CLEAN_SHUTDOWN = 3
+SHRINK_REQUEST = 4
+SHRINK_QUERY_RESPONSE = 5
+SHRINK_ERROR_RESPONSE = 6
+PARTITION_QUERY = 7
+PARTITION_QUERY_RESPONSE = 8
+CLUSTER_STATUS_QUERY = 9
+CLUSTER_STATUS_QUERY_RESPONSE = 10
+CLUSTER_STATUS_QUERY_RESPONSE_NOT_INITIALIZED = 11
+PARTITION_COUNT_QUERY = 12
+PARTITION_COUNT_QUERY_RESPONSE = 13
+SOURCE_IDS_QUERY = 14
+SOURCE_IDS_QUERY_RESPONSE = 15
+REPORT_STATUS = 16
+STATE_ENTITY_QUERY = 17
+STATE_ENTITY_QUERY_RESPONSE = 18
+STATELESS_PARTITION_QUERY = 19
+STATELESS_PARTITION_QUERY_RESPONSE = 20
+STATE_ENTITY_COUNT_QUERY = 21
+STATE_ENTITY_COUNT_QUERY_RESPONSE = 22
+STATELESS_PARTITION_COUNT_QUERY = 23
+STATELESS_PARTITION_COUNT_QUERY_RESPONSE = 24
+CLUSTER_STATE_ENTITY_COUNT_QUERY = 25
+CLUSTER_STATE_ENTITY_COUNT_QUERY_RESPONSE = 26
+
+# external_sender --type names: (request type, response types)
+QUERIES = {
+    'partition-query': (PARTITION_QUERY, (PARTITION_QUERY_RESPONSE,)),
+    'partition-count-query': (PARTITION_COUNT_QUERY,
+                              (PARTITION_COUNT_QUERY_RESPONSE,)),
+    'cluster-status-query': (CLUSTER_STATUS_QUERY,
+                             (CLUSTER_STATUS_QUERY_RESPONSE,
+                              CLUSTER_STATUS_QUERY_RESPONSE_NOT_INITIALIZED)),
+    'source-ids-query': (SOURCE_IDS_QUERY, (SOURCE_IDS_QUERY_RESPONSE,)),
+    'state-entity-query': (STATE_ENTITY_QUERY,
+                           (STATE_ENTITY_QUERY_RESPONSE,)),
+    'stateless-partition-query': (STATELESS_PARTITION_QUERY,
+                                  (STATELESS_PARTITION_QUERY_RESPONSE,)),
+    'state-entity-count-query': (STATE_ENTITY_COUNT_QUERY,
+                                 (STATE_ENTITY_COUNT_QUERY_RESPONSE,)),
+    'stateless-partition-count-query': (
+        STATELESS_PARTITION_COUNT_QUERY,
+        (STATELESS_PARTITION_COUNT_QUERY_RESPONSE,)),
+    'cluster-state-entity-count-query': (
+        CLUSTER_STATE_ENTITY_COUNT_QUERY,
+        (CLUSTER_STATE_ENTITY_COUNT_QUERY_RESPONSE,))}
+
+# The worker sends an empty payload when it isn't initialized yet;
+# external_sender --json prints this in its place.
+NOT_INITIALIZED_JSON = '{"processing_messages": false}'
+
+
+def encode_message(msg_type, payload=''):
+    if not isinstance(payload, bytes):
+        payload = payload.encode()
+    return struct.pack('>IH', len(payload) + 2, msg_type) + payload
+
+
+def decode_message(data):
+    """
+    Decode a message with its length header already stripped.
+    Return (message type, payload text).
+    """
+    return struct.unpack('>H', data[:2])[0], data[2:].decode()
+
+
+def parse_address(address):
+    if isinstance(address, (tuple, list)):
+        return (address[0], int(address[1]))
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+
+class ExternalChannel(object):
+    """
+    A persistent connection to a worker's external channel.
+
+    The connection is opened on first use, and reopened if the worker
+    closed it since. Requests on one channel are serialized.
+    """
+    def __init__(self, address, timeout=10):
+        self.address = parse_address(address)
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "ExternalChannel({}:{})".format(*self.address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, _value, _traceback):
+        self.close()
+
+    def _connect(self):
+        self._close()
+        logging.log(1, "{}: connecting".format(self))
+        self.sock = socket.create_connection(self.address, self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _is_stale(self):
+        """
+        With no request outstanding, an idle connection should have nothing
+        to read. If it does, the worker closed or reset it.
+        """
+        try:
+            readable = select.select([self.sock], [], [], 0)[0]
+        except (ValueError, socket.error):
+            return True
+        return bool(readable)
+
+    def _recv_exactly(self, n):
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise ExternalChannelError(
+                    "{}: connection closed by the worker".format(self))
+            buf += chunk
+        return bytes(buf)
+
+    def _exchange(self, msg, await_response):
+        if self.sock is None or self._is_stale():
+            self._connect()
+        self.sock.sendall(msg)
+        if not await_response:
+            return None
+        size = struct.unpack('>I', self._recv_exactly(4))[0]
+        return decode_message(self._recv_exactly(size))
+
+    def request(self, msg_type, payload='', await_response=True,
+                retry=False):
+        """
+        Send a message and, if `await_response`, return the response's
+        (message type, payload text).
+
+        If `retry`, a request that fails on a broken connection is sent
+        once more on a new connection. Only use it for idempotent
+        requests, such as queries.
+        """
+        msg = encode_message(msg_type, payload)
+        with self.lock:
+            attempts = 2 if retry else 1
+            for attempt in range(attempts):
+                try:
+                    return self._exchange(msg, await_response)
+                except (socket.error, ExternalChannelError) as err:
+                    self._close()
+                    if attempt + 1 == attempts:
+                        raise ExternalChannelError(
+                            "{}: request {} failed: {}"
+                            .format(self, msg_type, err))
+                    logging.debug("{}: {}, reconnecting".format(self, err))
+
+    def query(self, query_type):
+        """
+        Run a query (an external_sender --type name, e.g.
+        'cluster-status-query') and return the JSON text of its response.
+        """
+        msg_type, expected = QUERIES[query_type]
+        resp_type, payload = self.request(msg_type, retry=True)
+        if resp_type not in expected:
+            raise ExternalChannelError(
+                "{}: unexpected response type {} to {!r}"
+                .format(self, resp_type, query_type))
+        if resp_type == CLUSTER_STATUS_QUERY_RESPONSE_NOT_INITIALIZED:
+            return NOT_INITIALIZED_JSON
+        return payload
+
+    def print_message(self, message):
+        self.request(PRINT, message, await_response=False)
+
+    def rotate_log(self, worker_name):
+        self.request(ROTATE_LOG, worker_name, await_response=False)
+
+    def clean_shutdown(self, message=''):
+        self.request(CLEAN_SHUTDOWN, message, await_response=False)
+
+    def shrink(self, workers=(), count=0, query=False):
+        """
+        Ask the cluster to shrink by the named `workers`, or by `count`
+        workers, or with `query=True`, which workers could leave.
+        Return the worker's response text.
+        """
+        payload = json.dumps({'query': query,
+                              'node_names': list(workers),
+                              'node_count': count})
+        resp_type, resp = self.request(SHRINK_REQUEST, payload)
+        if resp_type not in (SHRINK_QUERY_RESPONSE, SHRINK_ERROR_RESPONSE):
+            raise ExternalChannelError(
+                "{}: unexpected response type {} to a shrink request"
+                .format(self, resp_type))
+        return resp
+
+
+class ExternalChannelPool(object):
+    """
+    ExternalChannels by address, with concurrent queries across them.
+    """
+    def __init__(self, timeout=10, max_workers=32):
+        self.timeout = timeout
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def channel(self, address):
+        address = parse_address(address)
+        with self.lock:
+            channel = self.channels.get(address)
+            if channel is None:
+                channel = self.channels[address] = ExternalChannel(
+                    address, self.timeout)
+            return channel
+
+    def query(self, address, query_type):
+        return self.channel(address).query(query_type)
+
+    def query_many(self, addresses, query_type):
+        """
+        Run the same query against every (name, address) in `addresses`
+        concurrently. Return {name: response JSON text}. If any query
+        failed, raise the error of the first failed one in `addresses`
+        order.
+        """
+        futures = [(name, self.executor.submit(self.query, address,
+                                               query_type))
+                   for name, address in addresses]
+        return {name: future.result() for name, future in futures}
+
+    def close(self, addresses=None):
+        """
+        Close the channels to `addresses`, or all of them.
+        """
+        with self.lock:
+            if addresses is None:
+                addresses = list(self.channels)
+            channels = [self.channels.pop(parse_address(a), None)
+                        for a in addresses]
+        for channel in channels:
+            if channel is not None:
+                channel.close()
+
+
+# The channels used by the integration harness
+channels = ExternalChannelPool()
+
+
+def CLI(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='external_channel',
+        description="Query Wallaroo workers over their external channels")
+    parser.add_argument('--external', '-e', action='append', required=True,
+                        help="HOST:PORT of a worker's external channel. "
+                             "May be repeated.")
+    parser.add_argument('--type', '-t', required=True,
+                        choices=sorted(QUERIES))
+    parser.add_argument('--timeout', type=float, default=10)
+    args = parser.parse_args(argv)
+
+    pool = ExternalChannelPool(timeout=args.timeout)
+    try:
+        responses = pool.query_many([(a, a) for a in args.external],
+                                    args.type)
+    finally:
+        pool.close()
+    print(json.dumps({a: json.loads(r) for a, r in responses.items()},
+                     indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    CLI(sys.argv[1:])
@@ -0,0 +1,104 @@
+# Copyright 2017 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+
+"""
+pytest fixtures for running integration tests, in parallel if desired.
+
+Load them with `-p integration.fixtures` on the pytest command line, or
+`pytest_plugins = ['integration.fixtures']` in a root conftest.py:
+
+    def test_something(cluster_factory):
+        cluster = cluster_factory(command, sources=['src'], workers=2)
+        ...
+
+Clusters started this way are shut down when the test ends, and the test's
+logs are saved if it failed, as with `LoggingTestContext` and `Cluster`
+used as context managers.
+
+Tests may run concurrently, e.g. with pytest-xdist (`pytest -n 4`, or
+`make ... pytest_exp="-n 4 -p integration.fixtures"`):
+
+- each Cluster leases the ports it gives out (see `get_port_values`),
+  so no two clusters on a host share a port
+- each Cluster has its own resilience directory
+- each test process leases its own current_test log directory when it
+  first needs one (see `get_base_log_dir`)
+"""
+
+import sys
+
+import pytest
+
+from .test_context import LoggingTestContext
+
+
+FAILURE_ATTR = '_integration_failure'
+
+
+def _failure(item):
+    return getattr(item, FAILURE_ATTR, (None, None, None))
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    """
+    Keep the test's error on the item, so fixtures can pass it on to the
+    context managers they exit at teardown.
+    """
+    outcome = yield
+    report = outcome.get_result()
+    if report.when == 'call' and report.failed and call.excinfo:
+        setattr(item, FAILURE_ATTR, (call.excinfo.type, call.excinfo.value,
+                                     call.excinfo.tb))
+
+
+@pytest.fixture
+def test_context(request):
+    """
+    A LoggingTestContext named after the test.
+    """
+    ctx = LoggingTestContext(name_arg=request.node.name)
+    yield ctx
+    ctx.__exit__(*_failure(request.node))
+
+
+@pytest.fixture
+def cluster_factory(request, test_context):
+    """
+    Return a function that starts a Cluster with the given arguments and
+    returns it. The clusters are exited in reverse order at teardown.
+    """
+    clusters = []
+
+    def start(*args, **kwargs):
+        cluster = test_context.cluster(*args, **kwargs)
+        clusters.append(cluster)
+        return cluster.__enter__()
+
+    yield start
+
+    failure = _failure(request.node)
+    error = None
+    while clusters:
+        try:
+            clusters.pop().__exit__(*failure)
+        except Exception:
+            if error is None:
+                error = sys.exc_info()
+    if error is not None:
+        # Let test_context save the logs for a failed shutdown too
+        if failure[0] is None:
+            setattr(request.node, FAILURE_ATTR, error)
+        raise error[1].with_traceback(error[2])
@@ -86,3 +86,4 @@ def add_file_logger(filepath, name='', level=logging.DEBUG, fmt=None):
     file_handler.setLevel(level)
     file_handler.setFormatter(logging.Formatter(fmt))
     logging.root.addHandler(file_handler)
+    return file_handler
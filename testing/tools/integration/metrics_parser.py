@@ -12,8 +12,15 @@
 #  implied. See the License for the specific language governing
 #  permissions and limitations under the License.
 
+from array import array
 from io import BytesIO, BufferedReader
-from struct import unpack
+from struct import unpack, unpack_from
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 # Message Types
@@ -111,55 +118,255 @@ class MetricsParser(object):
                 }
 
 
+# The fixed-size tail of a metrics payload: the latency histogram, then
+# max_latency, min_latency, duration and end_ts, all U64
+HIST_BINS = 65
+FIXED_FIELDS = HIST_BINS + 4
+FIXED_SIZE = FIXED_FIELDS * 8
+FIXED_COLUMNS = {'max_latency': HIST_BINS,
+                 'min_latency': HIST_BINS + 1,
+                 'duration': HIST_BINS + 2,
+                 'end_ts': HIST_BINS + 3}
+STRING_COLUMNS = ('event', 'topic', 'metric_name', 'metric_category',
+                  'worker_name', 'pipeline_name')
+
+
+class MetricsStore(object):
+    """
+    A columnar store of decoded metrics records.
+
+    `load` scans a whole captured metrics stream at once. The string fields
+    of each metrics record are interned: a column holds an integer code per
+    row, and `names(column)` maps the codes back to strings. The histogram
+    and the other U64 fields are kept as one contiguous block of rows of
+    FIXED_FIELDS values, which is converted in a single step, with NumPy if
+    it is available, when it is first read.
+
+    Join records are kept in `joins` as (row, topic, worker_name) tuples,
+    where `row` is the number of metrics rows that preceded them.
+    """
+    def __init__(self):
+        self.codes = {c: array('I') for c in STRING_COLUMNS}
+        self._interned = {c: {} for c in STRING_COLUMNS}
+        self._names = {c: [] for c in STRING_COLUMNS}
+        self.payload_size = array('I')
+        self.payload_header = array('I')
+        self.id = array('H')
+        self.joins = []
+        self.connects = 0
+        self._fixed_bytes = bytearray()
+        self._fixed = None
+
+    def __len__(self):
+        return len(self.id)
+
+    def _intern(self, column, data, pos):
+        size = unpack_from('>I', data, pos)[0]
+        end = pos + 4 + size
+        raw = bytes(data[pos + 4:end])
+        interned = self._interned[column]
+        code = interned.get(raw)
+        if code is None:
+            code = interned[raw] = len(self._names[column])
+            self._names[column].append(raw.decode())
+        self.codes[column].append(code)
+        return end
+
+    def _string(self, data, pos):
+        size = unpack_from('>I', data, pos)[0]
+        return bytes(data[pos + 4:pos + 4 + size]).decode(), pos + 4 + size
+
+    def load(self, data):
+        """
+        Decode every complete record in `data` (bytes-like) and return the
+        number of bytes consumed.
+        """
+        data = memoryview(data)
+        n = len(data)
+        pos = 0
+        while pos + 5 <= n:
+            size = unpack_from('>I', data, pos)[0]
+            end = pos + 4 + max(size, 1)
+            if end > n:
+                break
+            msg_type = data[pos + 4]
+            if msg_type == 3:
+                self._load_metrics(data, pos + 5)
+            elif msg_type == 2:
+                topic, p = self._string(data, pos + 5)
+                worker, p = self._string(data, p)
+                self.joins.append((len(self), topic, worker))
+            elif msg_type == 1:
+                self.connects += 1
+            else:
+                raise MetricsParseError(
+                    "Unknown message type {} at offset {}"
+                    .format(msg_type, pos))
+            pos = end
+        return pos
+
+    def _load_metrics(self, data, pos):
+        pos = self._intern('event', data, pos)
+        pos = self._intern('topic', data, pos)
+        size, header = unpack_from('>II', data, pos)
+        self.payload_size.append(size)
+        self.payload_header.append(header)
+        pos += 8
+        for column in STRING_COLUMNS[2:]:
+            pos = self._intern(column, data, pos)
+        self.id.append(unpack_from('>H', data, pos)[0])
+        pos += 2
+        self._fixed_bytes += data[pos:pos + FIXED_SIZE]
+        self._fixed = None
+
+    def fixed(self):
+        """
+        All U64 fields as a (rows, FIXED_FIELDS) NumPy array, or as a flat
+        array('Q') without NumPy.
+        """
+        if self._fixed is None:
+            if numpy is not None:
+                self._fixed = numpy.frombuffer(
+                    bytes(self._fixed_bytes), dtype='>u8').astype(
+                        numpy.uint64).reshape(-1, FIXED_FIELDS)
+            else:
+                fixed = array('Q')
+                fixed.frombytes(bytes(self._fixed_bytes))
+                if sys.byteorder == 'little':
+                    fixed.byteswap()
+                self._fixed = fixed
+        return self._fixed
+
+    def names(self, column):
+        return self._names[column]
+
+    def value(self, column, row):
+        return self._names[column][self.codes[column][row]]
+
+    def rows(self, **criteria):
+        """
+        Return the rows whose string columns equal the given values,
+        e.g. `rows(metric_category='start-to-end')`.
+        """
+        selected = range(len(self))
+        for column, value in criteria.items():
+            code = self._interned[column].get(value.encode())
+            if code is None:
+                return []
+            codes = self.codes[column]
+            selected = [r for r in selected if codes[r] == code]
+        return list(selected)
+
+    def group_rows(self, columns, rows=None):
+        """
+        Return {(value, ...): [row, ...]} grouping `rows`, or all rows, by
+        the values of the string `columns`.
+        """
+        if rows is None:
+            rows = range(len(self))
+        codes = [self.codes[c] for c in columns]
+        groups = {}
+        for r in rows:
+            groups.setdefault(tuple(c[r] for c in codes), []).append(r)
+        return {tuple(self._names[c][code] for c, code in zip(columns, key)):
+                selected for key, selected in groups.items()}
+
+    def hist(self, row):
+        fixed = self.fixed()
+        if numpy is not None:
+            return [int(v) for v in fixed[row, :HIST_BINS]]
+        start = row * FIXED_FIELDS
+        return list(fixed[start:start + HIST_BINS])
+
+    def column(self, name, rows=None):
+        """
+        Return a U64 column (`max_latency`, `min_latency`, `duration`,
+        `end_ts`, or `total`, the histogram count) for `rows`, or for all
+        rows.
+        """
+        fixed = self.fixed()
+        if rows is None:
+            rows = range(len(self))
+        if numpy is not None:
+            rows = numpy.asarray(rows, dtype=numpy.intp)
+            if name == 'total':
+                return fixed[rows, :HIST_BINS].sum(axis=1)
+            return fixed[rows, FIXED_COLUMNS[name]]
+        if name == 'total':
+            return [sum(fixed[r * FIXED_FIELDS:r * FIXED_FIELDS + HIST_BINS])
+                    for r in rows]
+        offset = FIXED_COLUMNS[name]
+        return [fixed[r * FIXED_FIELDS + offset] for r in rows]
+
+    def merged_hist(self, rows=None):
+        """
+        Return the sum of the latency histograms of `rows`, or of all rows.
+        """
+        fixed = self.fixed()
+        if rows is None:
+            rows = range(len(self))
+        if numpy is not None:
+            rows = numpy.asarray(rows, dtype=numpy.intp)
+            return [int(v) for v in fixed[rows, :HIST_BINS].sum(axis=0)]
+        merged = [0] * HIST_BINS
+        for r in rows:
+            start = r * FIXED_FIELDS
+            merged = [a + b for a, b in
+                      zip(merged, fixed[start:start + HIST_BINS])]
+        return merged
+
+    def record(self, row):
+        """
+        Return row `row` as a dict, like `MetricsParser.parse_metrics`.
+        """
+        hist = self.hist(row)
+        out = {'type': 'metrics',
+               'payload_size': self.payload_size[row],
+               'payload_header': self.payload_header[row],
+               'id': self.id[row],
+               'latency_hist': hist,
+               'total': sum(hist)}
+        for column in STRING_COLUMNS:
+            out[column] = self.value(column, row)
+        for column in FIXED_COLUMNS:
+            out[column] = int(self.column(column, [row])[0])
+        return out
+
+
 class MetricsData(MetricsParser):
+    """
+    Metrics records loaded into a MetricsStore, `store`.
+
+    `parse` additionally builds `data`, a dict of
+    {topic: {worker_name: [('join',) or ('metrics', record dict)]}}.
+    """
     def __init__(self):
-        self.records = []
+        self.store = MetricsStore()
         self.data = {}
 
     def load_string_list(self, l):
-        b = BytesIO()
-        for s in l:
-            b.write(s)
-        b.seek(0)
-        buf = BufferedReader(b)
-        self.load_buffer(buf)
+        self.load_string(b''.join(l))
 
     def load_string(self, s):
-        buf = BufferedReader(BytesIO(s))
-        self.load_buffer(buf)
+        self.store.load(s)
 
     def load_buffer(self, buf):
-        while True:
-            # read header
-            header_bs = buf.read(4)
-            if not header_bs:
-                break
-            header = unpack('>I', header_bs)[0]
-            # message type
-            msg_type_bs = buf.read(1)
-            if not msg_type_bs:
-                break
-            msg_type = unpack('>B', msg_type_bs)[0]
-            # payload
-            if header:
-                payload = buf.read(header-1)
-            else:
-                payload = b''
-            self.records.append({'type': MSG_TYPES.get(msg_type, None),
-                                 'payload': payload,
-                                 'raw_type': msg_type})
+        self.store.load(buf.read())
 
     def parse(self):
         # populate self.data dict...
-        for r in self.records:
-            p = self.parse_record(r)
-            if p['type'] == 'connect':
-                continue
-            elif p['type'] == 'join':
-                topic = self.data.setdefault(p['topic'], {})
-                worker = topic.setdefault(p['worker_name'], [])
-                worker.append(('join',))
-            elif p['type'] == 'metrics':
-                topic = self.data.setdefault(p['topic'], {})
-                worker = topic.setdefault(p['worker_name'], [])
-                worker.append(('metrics', p))
+        self.data = {}
+        store = self.store
+        joins = iter(store.joins)
+        join = next(joins, None)
+        for row in range(len(store) + 1):
+            while join is not None and join[0] == row:
+                topic = self.data.setdefault(join[1], {})
+                topic.setdefault(join[2], []).append(('join',))
+                join = next(joins, None)
+            if row == len(store):
+                break
+            p = store.record(row)
+            topic = self.data.setdefault(p['topic'], {})
+            worker = topic.setdefault(p['worker_name'], [])
+            worker.append(('metrics', p))
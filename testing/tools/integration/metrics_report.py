@@ -0,0 +1,261 @@
+# Copyright 2017 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+
+"""
+Latency percentile and throughput reports from captured Wallaroo metrics.
+
+Every metrics record holds one reporting period's 65-bin latency histogram
+for one metric on one worker. A report merges the histograms of all
+periods and workers and summarizes them:
+
+- end to end: every start-to-end record
+- per pipeline: start-to-end records by pipeline
+- per step: computation records by pipeline and step
+- per worker: node-ingress-egress records by worker
+
+Each summary holds the message count, the throughput over the report's
+window, the latency percentiles, the observed min and max latency, and a
+throughput time series with one point per reporting period.
+
+To report on a metrics capture saved with `Metrics.save`:
+
+    PYTHONPATH=testing/tools python3 -m integration.metrics_report \\
+        metrics.bin --json report.json
+"""
+
+import argparse
+import json
+import sys
+
+from .metrics_parser import MetricsData
+
+
+PERCENTILES = (50, 95, 99, 99.9)
+
+NS_PER_S = 1e9
+
+
+def bin_upper_bound(idx):
+    """
+    Wallaroo counts a latency of `v` nanoseconds into the bin of its bit
+    length, so bin `idx` holds latencies below 2**idx nanoseconds.
+    """
+    return 2 ** idx
+
+
+def histogram_percentiles(hist, percentiles=PERCENTILES, max_value=None):
+    """
+    Return {percentile: upper bound in ns} for a merged 65-bin histogram.
+    If `max_value` is given, no bound is reported above it.
+    """
+    total = sum(hist)
+    out = {}
+    if not total:
+        return out
+    for p in percentiles:
+        rank = total * p / 100.0
+        seen = 0
+        for idx, count in enumerate(hist):
+            seen += count
+            if count and seen >= rank:
+                bound = bin_upper_bound(idx)
+                if max_value is not None:
+                    bound = min(bound, max_value)
+                out[str(p)] = bound
+                break
+    return out
+
+
+class MetricsReport(object):
+    """
+    Summaries of the records in a MetricsStore.
+
+    `window` is the number of seconds over which throughput is averaged.
+    It defaults to the time spanned by the store's reporting periods.
+    """
+    def __init__(self, store, window=None, percentiles=PERCENTILES):
+        self.store = store
+        self.percentiles = percentiles
+        self.window = self.span() if window is None else window
+
+    def span(self, rows=None):
+        """
+        Seconds from the start of the earliest reporting period to the end
+        of the latest one.
+        """
+        if rows is None:
+            rows = range(len(self.store))
+        ends = [int(v) for v in self.store.column('end_ts', rows)]
+        if not ends:
+            return 0
+        durations = [int(v) for v in self.store.column('duration', rows)]
+        start = min(e - d for e, d in zip(ends, durations))
+        return (max(ends) - start) / NS_PER_S
+
+    def series(self, rows):
+        """
+        Return [[period end in seconds, messages per second], ...] for
+        `rows`, summing all the workers' counts for each period.
+        """
+        store = self.store
+        counts = {}
+        durations = {}
+        for end, duration, total in zip(store.column('end_ts', rows),
+                                        store.column('duration', rows),
+                                        store.column('total', rows)):
+            end = int(end)
+            counts[end] = counts.get(end, 0) + int(total)
+            durations[end] = max(durations.get(end, 0), int(duration))
+        return [[end / NS_PER_S,
+                 counts[end] / (durations[end] / NS_PER_S)
+                 if durations[end] else 0]
+                for end in sorted(counts)]
+
+    def summarize(self, rows):
+        store = self.store
+        hist = store.merged_hist(rows)
+        total = sum(hist)
+        counted = [r for r, t in zip(rows, store.column('total', rows)) if t]
+        max_ns = (int(max(store.column('max_latency', counted)))
+                  if counted else None)
+        min_ns = (int(min(store.column('min_latency', counted)))
+                  if counted else None)
+        return {'messages': total,
+                'throughput': total / self.window if self.window else 0,
+                'latency_ns': histogram_percentiles(hist, self.percentiles,
+                                                    max_ns),
+                'min_ns': min_ns,
+                'max_ns': max_ns,
+                'series': self.series(rows)}
+
+    def _grouped(self, category, columns):
+        rows = self.store.rows(metric_category=category)
+        return self.store.group_rows(columns, rows)
+
+    def end_to_end(self):
+        return self.summarize(self.store.rows(metric_category='start-to-end'))
+
+    def pipelines(self):
+        return {key[0]: self.summarize(rows) for key, rows in
+                self._grouped('start-to-end', ('pipeline_name',)).items()}
+
+    def steps(self):
+        out = {}
+        groups = self._grouped('computation',
+                               ('pipeline_name', 'metric_name'))
+        for (pipeline, step), rows in groups.items():
+            out.setdefault(pipeline, {})[step] = self.summarize(rows)
+        return out
+
+    def workers(self):
+        return {key[0]: self.summarize(rows) for key, rows in
+                self._grouped('node-ingress-egress',
+                              ('worker_name',)).items()}
+
+    def to_dict(self):
+        return {'window': self.window,
+                'end_to_end': self.end_to_end(),
+                'pipelines': self.pipelines(),
+                'steps': self.steps(),
+                'workers': self.workers()}
+
+    def format(self, report=None):
+        """
+        Return a terminal summary of `report` (a `to_dict` result), with
+        steps ordered from the slowest p99 down.
+        """
+        if report is None:
+            report = self.to_dict()
+        head = ['', 'messages', 'msgs/s'] + [
+            'p{}'.format(p) for p in self.percentiles] + ['max']
+        lines = []
+
+        def row(name, summary):
+            latency = summary['latency_ns']
+            lines.append([name, str(summary['messages']),
+                          '{:.0f}'.format(summary['throughput'])] +
+                         [format_ns(latency.get(str(p)))
+                          for p in self.percentiles] +
+                         [format_ns(summary['max_ns'])])
+
+        def section(title):
+            lines.append([title] + [''] * (len(head) - 1))
+
+        row('end to end', report['end_to_end'])
+        section('pipelines')
+        for name, summary in sorted(report['pipelines'].items()):
+            row('  ' + name, summary)
+        section('steps')
+        steps = [(pipeline + ': ' + step, summary)
+                 for pipeline, pipeline_steps in report['steps'].items()
+                 for step, summary in pipeline_steps.items()]
+        steps.sort(key=lambda s: s[1]['latency_ns'].get('99', 0),
+                   reverse=True)
+        for name, summary in steps:
+            row('  ' + name, summary)
+        section('workers')
+        for name, summary in sorted(report['workers'].items()):
+            row('  ' + name, summary)
+
+        widths = [max(len(l[i]) for l in lines + [head])
+                  for i in range(len(head))]
+        out = ['Window: {:.1f}s'.format(report['window'])]
+        for l in [head] + lines:
+            out.append('  '.join([l[0].ljust(widths[0])] +
+                                 [v.rjust(w) for v, w in
+                                  zip(l[1:], widths[1:])]).rstrip())
+        return '\n'.join(out)
+
+
+def format_ns(ns):
+    if ns is None:
+        return '-'
+    for unit, scale in (('s', 1e9), ('ms', 1e6), ('us', 1e3)):
+        if ns >= scale:
+            return '{:.3g}{}'.format(ns / scale, unit)
+    return '{}ns'.format(ns)
+
+
+def load_file(path):
+    """
+    Load a saved metrics capture into a MetricsStore.
+    """
+    md = MetricsData()
+    with open(path, 'rb') as f:
+        md.load_buffer(f)
+    return md.store
+
+
+def CLI(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='metrics_report',
+        description="Summarize latency and throughput from Wallaroo metrics")
+    parser.add_argument('path', help="A metrics capture saved by Metrics.save")
+    parser.add_argument('--json', help="Also write the report as JSON here")
+    parser.add_argument('--window', type=float,
+                        help=("Seconds to average throughput over (default: "
+                              "the span of the captured periods)"))
+    args = parser.parse_args(argv)
+
+    report = MetricsReport(load_file(args.path), window=args.window)
+    data = report.to_dict()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+    print(report.format(data))
+
+
+if __name__ == '__main__':
+    CLI(sys.argv[1:])
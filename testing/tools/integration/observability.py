@@ -34,7 +34,7 @@ watchdog_logger.setLevel(logging.WARNING)
 
 from .errors import (DuplicateKeyError,
                     TimeoutError)
-from .external import run_shell_cmd
+from .external_channel import channels
 from .logger import INFO2
 from .stoppable_thread import StoppableThread
 
@@ -67,18 +67,16 @@ QUERY_TYPES = {
 
 def external_sender_query(addr, query_type):
     """
-    Use external_sender to query the cluster for observability data.
+    Query the cluster for observability data over the worker's external
+    channel.
     """
     t = QUERY_TYPES[query_type]
-    cmd = ('external_sender --external {} --type {} --json'
-           .format(addr, t))
-    res = run_shell_cmd(cmd)
     try:
-        assert(res.success)
-    except AssertionError:
-        raise AssertionError("Failed to query cluster for '{}' with the "
-                             "following error:\n{}".format(t, res.output))
-    return res.output
+        return channels.query(addr, t)
+    except Exception as err:
+        raise ObservabilityQueryError("Failed to query cluster for '{}' with "
+                                      "the following error:\n{}"
+                                      .format(t, err))
 
 
 def partitions_query(addr):
@@ -102,14 +100,16 @@ def multi_states_query(addresses):
     Returns a dictionary of {address: {'stdout': raw_response,
                                        'data': parsed response}}
     """
+    # query all the workers concurrently
+    try:
+        raw = channels.query_many(addresses,
+                                  QUERY_TYPES['state-entity-query'])
+    except Exception as err:
+        logging.error(err)
+        raise
     responses = {}
-    # collect responses
     for name, addr in addresses:
-        try:
-            resp = external_sender_query(addr, 'state-entity-query')
-        except Exception as err:
-            logging.error(err)
-            raise err
+        resp = raw[name]
         try:
             # try to parse responses
             responses[name] = json.loads(resp)
@@ -306,84 +306,115 @@ class ObservabilityNotifier(StoppableThread):
             time.sleep(self.period)
 
 
+class OutputTail(object):
+    """
+    Incrementally read a runner's output file.
+
+    Each `read` only reads what was appended since the previous one, and
+    `search` only scans from the start of the last line it has already
+    scanned, so waiting on a long output costs no more than the new text.
+    """
+    def __init__(self, f, start_from=0):
+        self.f = f
+        self.f.seek(start_from)
+        self.text = ''
+        self.scan_from = 0
+
+    def read(self):
+        """
+        Read any new output. Return True if there was some.
+        """
+        data = self.f.read()
+        self.text += data
+        return bool(data)
+
+    def search(self, rx):
+        match = rx.search(self.text, self.scan_from)
+        if match is None:
+            # a line may still be incomplete: rescan it next time
+            self.scan_from = self.text.rfind('\n') + 1
+        return match
+
+    def rewind(self):
+        """
+        Scan everything read so far again on the next search.
+        """
+        self.scan_from = 0
+
+
 class RunnerReadyChecker(StoppableThread):
     __base_name__ = 'RunnerReadyChecker'
     pattern = re.compile('Application has successfully initialized')
 
-    def __init__(self, runners, timeout=90):
+    def __init__(self, runners, timeout=90, interval=0.05):
         super(RunnerReadyChecker, self).__init__()
         self.runners = runners
         self.name = self.__base_name__
-        self._path = self.runners[0].file.name
+        self._path = self.runners[0].output_path
         self.timeout = timeout
+        self.interval = interval
         self.error = None
 
     def run(self):
-        with open(self._path, 'r') as r:
+        with open(self._path, 'r', errors='backslashreplace') as r:
+            tail = OutputTail(r)
             started = time.time()
             while not self.stopped():
-                r.seek(0)
-                stdout = r.read()
-                if not stdout:
-                    time.sleep(0.1)
-                    continue
-                else:
-                    if self.pattern.search(stdout):
-                        logging.debug('Application reports it is ready.')
-                        self.stop()
-                        break
+                if tail.read() and tail.search(self.pattern):
+                    logging.debug('Application reports it is ready.')
+                    self.stop()
+                    break
                 if time.time() - started > self.timeout:
-                    outputs = runners_output_format(self.runners)
+                    outputs = '\n===\n'.join(
+                        '{}:\n{}'.format(runner.name, runner.get_output())
+                        for runner in self.runners)
                     self.error = TimeoutError(
                         'Application did not report as ready after {} '
                         'seconds. It had the following outputs:\n===\n{}'
                         .format(self.timeout, outputs))
                     self.stop()
                     break
+                time.sleep(self.interval)
 
 
 class RunnerChecker(StoppableThread):
     __base_name__ = 'RunnerChecker'
 
-    def __init__(self, runner, patterns, timeout=90, start_from=0):
+    def __init__(self, runner, patterns, timeout=90, start_from=0,
+                 interval=0.05):
         super(RunnerChecker, self).__init__()
         self.name = self.__base_name__
         self.runner = runner
         self.runner_name = runner.name
         self.start_from = start_from
-        self._path = runner.file.name
+        self._path = runner.output_path
         self.timeout = timeout
+        self.interval = interval
         self.error = None
         if isinstance(patterns, (list, tuple)):
             self.patterns = patterns
         else:
-            self.patterns = [pattern]
-        self.compiled = [re.compile(p) for p in patterns]
+            self.patterns = [patterns]
+        self.compiled = [re.compile(p) for p in self.patterns]
 
     def run(self):
-        with open(self._path, 'r') as r:
-            last_match = self.start_from
+        with open(self._path, 'r', errors='backslashreplace') as r:
+            tail = OutputTail(r, self.start_from)
             started = time.time()
             while not self.stopped():
-                r.seek(last_match)
-                stdout = r.read()
-                if not stdout:
-                    time.sleep(0.1)
-                    continue
-                else:
-                    match = self.compiled[0].search(stdout)
-                    if match:
-                        logging.debug('Pattern %r found in runner STDOUT.'
-                                      % match.re.pattern)
-                        self.compiled.pop(0)
-                        last_match = self.start_from
-                        if self.compiled:
-                            continue
-                        self.stop()
-                        break
+                tail.read()
+                match = self.compiled and tail.search(self.compiled[0])
+                while match:
+                    logging.debug('Pattern %r found in runner STDOUT.'
+                                  % match.re.pattern)
+                    self.compiled.pop(0)
+                    # each pattern may match anywhere after start_from
+                    tail.rewind()
+                    match = self.compiled and tail.search(self.compiled[0])
+                if not self.compiled:
+                    self.stop()
+                    break
                 if time.time() - started > self.timeout:
-                    r.seek(self.start_from)
-                    stdout = r.read()
                     self.error = TimeoutError(
                         'Runner {!r} did not have patterns {!r}'
                         ' after {} seconds.'
@@ -392,6 +423,7 @@ class RunnerChecker(StoppableThread):
                                 self.timeout))
                     self.stop()
                     break
+                time.sleep(self.interval)
 
 
 ####################################
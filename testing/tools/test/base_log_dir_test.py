@@ -0,0 +1,64 @@
+import logging
+import os
+import subprocess
+import sys
+
+import pytest
+
+import integration
+from integration.external import lease_dir, release_leases
+
+
+@pytest.fixture
+def current_test(tmpdir, monkeypatch):
+    """
+    A current_test path of the test's own, with no lease taken on it yet.
+    """
+    path = str(tmpdir.join('current_test'))
+    monkeypatch.setattr(integration, 'CURRENT_TEST_DIR', path)
+    monkeypatch.setattr(integration, '_base_log_dir', None)
+    monkeypatch.setattr(integration, '_base_log_dir_leases', [])
+    monkeypatch.setattr(integration, '_base_log_handler', None)
+    yield path
+    integration.release_base_log_dir()
+
+
+def test_import_has_no_side_effects():
+    out = subprocess.check_output(
+        [sys.executable, '-c',
+         'import integration; print(integration._base_log_dir)'],
+        cwd=os.path.dirname(os.path.dirname(integration.__file__)))
+    assert(out.strip() == b'None')
+
+
+def test_base_log_dir_is_leased_on_first_use(current_test):
+    os.makedirs(current_test)
+    with open(os.path.join(current_test, 'stale'), 'w'):
+        pass
+    assert(integration.get_base_log_dir() == current_test)
+    assert(integration.get_base_log_dir() == current_test)
+    assert(os.listdir(current_test) == ['test.log'])
+    logging.getLogger(__name__).debug('logged to the base log dir')
+    integration.release_base_log_dir()
+    # current_test itself is kept
+    with open(os.path.join(current_test, 'test.log')) as f:
+        assert('logged to the base log dir' in f.read())
+    assert(integration._base_log_handler is None)
+
+
+def test_concurrent_leases_are_removed_on_release(current_test):
+    # Another process holds current_test
+    held = []
+    assert(lease_dir(current_test, held) == current_test)
+    try:
+        path = integration.get_base_log_dir()
+        assert(path == current_test + '.1')
+        assert(os.path.isfile(os.path.join(path, 'test.log')))
+        integration.release_base_log_dir()
+        assert(not os.path.exists(path))
+        # and once released, the lease is free for the next process
+        leases = []
+        assert(lease_dir(current_test, leases) == path)
+        release_leases(leases)
+    finally:
+        release_leases(held)
@@ -0,0 +1,311 @@
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+
+from integration import end_points
+from integration.end_points import (encode_to_file,
+                                    FileSender,
+                                    iter_generator,
+                                    LatencyHistogram,
+                                    LatencySink,
+                                    OpenLoopSender,
+                                    Reader,
+                                    Sink,
+                                    SpillAccumulator,
+                                    stamp_prefix)
+
+
+def framed(body):
+    return struct.pack('>I', len(body)) + body
+
+
+def split_framed(bs):
+    records = []
+    while bs:
+        size = struct.unpack('>I', bs[:4])[0]
+        records.append(bs[4:4 + size])
+        bs = bs[4 + size:]
+    return records
+
+
+def exact_percentile(values, percentile):
+    values = sorted(values)
+    rank = max(1, -(-len(values) * percentile // 100))
+    return values[int(rank) - 1]
+
+
+#
+# Test LatencyHistogram
+#
+
+def test_histogram_bucket_ranges():
+    for digits in (1, 2, 3):
+        hist = LatencyHistogram(digits)
+        ranges = [hist._range(i) for i in range(hist._index(1 << 40) + 1)]
+        # The buckets cover every value once, in order
+        assert(ranges[0][0] == 0)
+        for (_, high), (low, _) in zip(ranges, ranges[1:]):
+            assert(low == high + 1)
+        # and are narrow enough for the requested precision
+        for low, high in ranges:
+            assert(high - low <= max(1, low / 10.0 ** digits))
+
+
+def test_histogram_index_is_within_its_range():
+    rng = random.Random(7)
+    hist = LatencyHistogram(3)
+    values = list(range(5000)) + [rng.randint(0, 1 << 50)
+                                  for _ in range(5000)]
+    for value in values:
+        low, high = hist._range(hist._index(value))
+        assert(low <= value <= high)
+
+
+def test_histogram_percentile_accuracy():
+    rng = random.Random(42)
+    for digits in (2, 3):
+        hist = LatencyHistogram(digits)
+        values = [int(rng.lognormvariate(14, 2)) for _ in range(20000)]
+        for value in values:
+            hist.record(value)
+        for p in (1, 50, 90, 99, 99.9, 100):
+            exact = exact_percentile(values, p)
+            reported = hist.value_at_percentile(p)
+            # never below the true value, and within the precision
+            assert(exact <= reported <= exact * (1 + 10.0 ** -digits) + 1)
+        assert(hist.value_at_percentile(100) == max(values))
+        assert(hist.min == min(values))
+        assert(hist.total == len(values))
+
+
+def test_histogram_small_values_are_exact():
+    hist = LatencyHistogram(3)
+    for value in range(1, 1001):
+        hist.record(value)
+    assert(hist.value_at_percentile(50) == 500)
+    assert(hist.value_at_percentile(99.9) == 999)
+    assert(hist.mean() == 500.5)
+
+
+def test_histogram_record_count_and_merge():
+    a = LatencyHistogram(3)
+    b = LatencyHistogram(3)
+    a.record(10, count=3)
+    a.record(-5)
+    b.record(1000000)
+    a.merge(b)
+    assert(a.total == 5)
+    assert((a.min, a.max) == (0, 1000000))
+    assert(a.value_at_percentile(80) == 10)
+    assert(a.summary()['count'] == 5)
+    assert(LatencyHistogram().value_at_percentile(50) is None)
+    try:
+        a.merge(LatencyHistogram(2))
+    except ValueError:
+        pass
+    else:
+        assert(False)
+
+
+#
+# Test LatencySink
+#
+
+def test_latency_sink_records_latency(monkeypatch):
+    monkeypatch.setattr(end_points, 'now_ns', lambda: 10000)
+    sink = LatencySink('127.0.0.1')
+    acc = sink.new_accumulator('*')
+    acc.extend([framed(stamp_prefix(ts, b'body'))
+                for ts in (9000, 8000, 7000)])
+    acc.append(framed(b'bad'))
+    summary = sink.summary()
+    assert(summary['count'] == 3)
+    assert((summary['min'], summary['max']) == (1000, 3000))
+    assert(summary['50'] == 2000)
+    assert(summary['errors'] == 1)
+    # records are not kept unless asked for
+    assert(len(acc) == 0)
+
+
+def test_latency_sink_keep_data_and_custom_extract(monkeypatch):
+    monkeypatch.setattr(end_points, 'now_ns', lambda: 500)
+    sink = LatencySink('127.0.0.1', mode='newlines', keep_data=True,
+                       extract=lambda bs: int(bs.split(b',')[0]))
+    acc = sink.new_accumulator('*')
+    acc.extend([b'100,a\n', b'200,b\n'])
+    assert(list(acc) == [b'100,a\n', b'200,b\n'])
+    assert(sink.histogram.min == 300)
+    assert(sink.histogram.max == 400)
+
+
+def test_latency_sink_over_tcp():
+    sink = LatencySink('127.0.0.1')
+    sink.start()
+    try:
+        host, port = sink.get_connection_info()
+        sock = socket.create_connection((host, port))
+        sent_at = end_points.now_ns()
+        sock.sendall(b''.join(framed(stamp_prefix(sent_at, b'x'))
+                              for _ in range(100)))
+        sock.close()
+        deadline = time.time() + 10
+        while sink.histogram.total < 100 and time.time() < deadline:
+            time.sleep(0.01)
+        assert(sink.histogram.total == 100)
+        assert(0 <= sink.histogram.min <=
+               sink.histogram.max <= end_points.now_ns() - sent_at)
+    finally:
+        sink.stop()
+        sink.join(5)
+
+
+#
+# Test TCPReceiver
+#
+
+def test_receiver_stop_logs_no_error(caplog):
+    sink = Sink('127.0.0.1')
+    sink.start()
+    sink.get_connection_info()
+    with caplog.at_level(logging.ERROR):
+        sink.stop()
+        sink.join(5)
+    assert(not sink.is_alive())
+    assert(sink.err is None)
+    assert(caplog.records == [])
+
+
+def test_receiver_closes_connections_and_spill_files(tmpdir):
+    sink = Sink('127.0.0.1', split_streams=True, spill_dir=str(tmpdir))
+    sink.start()
+    try:
+        address = sink.get_connection_info()
+        for n in range(3):
+            sock = socket.create_connection(address)
+            sock.sendall(framed(str(n).encode()))
+            sock.close()
+        deadline = time.time() + 10
+        while ((len(sink) < 3 or sink.clients) and
+               time.time() < deadline):
+            time.sleep(0.01)
+        # closed connections are forgotten
+        assert(sink.clients == [])
+    finally:
+        sink.stop()
+        sink.join(5)
+    assert(sorted(sink.data) == [0, 1, 2])
+    for stream, accumulator in sink.data.items():
+        assert(isinstance(accumulator, SpillAccumulator))
+        assert(accumulator.fd is None)
+        # and the records can still be read back
+        assert(list(accumulator) == [framed(str(stream).encode())])
+        assert(accumulator[0] == framed(str(stream).encode()))
+
+
+#
+# Test OpenLoopSender
+#
+
+class Receiver(threading.Thread):
+    """
+    Accept one connection and record the arrival time of every record.
+    """
+    def __init__(self):
+        super(Receiver, self).__init__()
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.address = '{}:{}'.format(*self.sock.getsockname())
+        self.records = []  # [(arrival, record)]
+
+    def run(self):
+        conn, _ = self.sock.accept()
+        buf = b''
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            arrival = end_points.now_ns()
+            buf += chunk
+            while len(buf) >= 4:
+                size = struct.unpack('>I', buf[:4])[0]
+                if len(buf) < 4 + size:
+                    break
+                self.records.append((arrival, buf[4:4 + size]))
+                buf = buf[4 + size:]
+        conn.close()
+        self.sock.close()
+
+
+def test_open_loop_sender_keeps_its_schedule():
+    receiver = Receiver()
+    receiver.start()
+    count = 200
+    rate = 1000.0
+    reader = Reader(iter_generator(range(count)))
+    sender = OpenLoopSender(receiver.address, reader, rate,
+                            report_interval=0.05)
+    sender.start()
+    # Hold the sender back: the records that fall due meanwhile keep
+    # their scheduled times and are sent together on resume
+    time.sleep(0.05)
+    sender.pause()
+    time.sleep(0.05)
+    sender.resume()
+    sender.join(10)
+    receiver.join(10)
+    assert(sender.error is None)
+    assert(sender.sent == count)
+    assert(len(receiver.records) == count)
+    stamps = [struct.unpack('>Q', record[:8])[0]
+              for _, record in receiver.records]
+    assert([record[8:] for _, record in receiver.records] ==
+           [str(i).encode() for i in range(count)])
+    period = 1e9 / rate
+    for n, ts in enumerate(stamps):
+        assert(abs(ts - (stamps[0] + n * period)) <= 1)
+    # No record is sent before it is due
+    for (arrival, _), ts in zip(receiver.records, stamps):
+        assert(arrival >= ts)
+    # and the pause shows up as a backlog
+    assert(sender.max_backlog >= 20)
+
+
+#
+# Test FileSender
+#
+
+def test_file_sender_data(tmpdir):
+    path = encode_to_file(iter_generator(range(100)),
+                          str(tmpdir.join("input.bin")))
+    sink = Sink('127.0.0.1')
+    sink.start()
+    try:
+        host, port = sink.get_connection_info()
+        sender = FileSender('{}:{}'.format(host, port), path,
+                            connections=2, repeat=2, chunk_size=64)
+        assert(len(sender.data) == 0 and not sender.data)
+        sender.start()
+        sender.join(30)
+        assert(sender.error is None)
+        assert(sender.records_sent() == 200)
+        deadline = time.time() + 10
+        while len(sink) < 200 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        sink.stop()
+        sink.join(5)
+    # data holds every chunk that was sent, like Sender's data
+    assert(len(sender.data) == 2 * len(sender.chunks))
+    sent = b''.join(sender.data)
+    assert(len(sent) == sender.bytes_sent())
+    expected = sorted(str(i).encode() for i in range(100)) * 2
+    assert(sorted(split_framed(sent)) == sorted(expected))
+    assert(sorted(split_framed(b''.join(sink.data['*']))) ==
+           sorted(split_framed(sent)))
+    assert(sender.data[:2] == [sender.data[0], sender.data[1]])
+    assert(sender.data[-1] == list(sender.data)[-1])
@@ -0,0 +1,172 @@
+import json
+import socket
+import struct
+import threading
+
+import pytest
+
+from integration import external_channel
+from integration.errors import ExternalChannelError
+from integration.external_channel import (CLI,
+                                          decode_message,
+                                          encode_message,
+                                          ExternalChannel,
+                                          ExternalChannelPool,
+                                          NOT_INITIALIZED_JSON)
+
+
+class StubWorker(threading.Thread):
+    """
+    A worker's external channel that answers each request with the canned
+    reply for its message type, and records the requests it received.
+
+    `replies` maps a request type to a (response type, payload) tuple, or
+    to None for requests that get no response. With `close_after`, each
+    connection is closed after that many requests.
+    """
+    def __init__(self, replies, close_after=None):
+        super(StubWorker, self).__init__()
+        self.daemon = True
+        self.replies = replies
+        self.close_after = close_after
+        self.requests = []
+        self.connections = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.address = '{}:{}'.format(*self.sock.getsockname())
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            self.serve(conn)
+
+    def serve(self, conn):
+        handled = 0
+        with conn:
+            while self.close_after is None or handled < self.close_after:
+                header = recv_exactly(conn, 4)
+                if header is None:
+                    return
+                msg = decode_message(
+                    recv_exactly(conn, struct.unpack('>I', header)[0]))
+                self.requests.append(msg)
+                reply = self.replies[msg[0]]
+                if reply is not None:
+                    conn.sendall(encode_message(*reply))
+                handled += 1
+
+    def close(self):
+        self.sock.close()
+
+
+def recv_exactly(conn, n):
+    data = b''
+    while len(data) < n:
+        chunk = conn.recv(n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+@pytest.fixture
+def stub_workers():
+    started = []
+
+    def start(replies, close_after=None):
+        worker = StubWorker(replies, close_after)
+        worker.start()
+        started.append(worker)
+        return worker
+
+    yield start
+    for worker in started:
+        worker.close()
+
+
+STATUS = json.dumps({'processing_messages': True, 'worker_count': 2})
+
+
+def test_encode_and_decode_message():
+    msg = encode_message(9, 'payload')
+    assert(msg == struct.pack('>IH', 9, 9) + b'payload')
+    assert(decode_message(msg[4:]) == (9, 'payload'))
+
+
+def test_query(stub_workers):
+    worker = stub_workers({9: (10, STATUS)})
+    with ExternalChannel(worker.address, timeout=5) as channel:
+        assert(channel.query('cluster-status-query') == STATUS)
+        assert(channel.query('cluster-status-query') == STATUS)
+    assert(worker.requests == [(9, ''), (9, '')])
+    # Both queries used the same connection
+    assert(worker.connections == 1)
+
+
+def test_query_not_initialized(stub_workers):
+    worker = stub_workers({9: (11, '')})
+    with ExternalChannel(worker.address, timeout=5) as channel:
+        assert(channel.query('cluster-status-query') == NOT_INITIALIZED_JSON)
+
+
+def test_query_unexpected_response(stub_workers):
+    worker = stub_workers({12: (10, STATUS)})
+    with ExternalChannel(worker.address, timeout=5) as channel:
+        with pytest.raises(ExternalChannelError):
+            channel.query('partition-count-query')
+
+
+def test_query_reconnects_after_the_worker_closes(stub_workers):
+    worker = stub_workers({12: (13, '{"a": 1}')}, close_after=1)
+    with ExternalChannel(worker.address, timeout=5) as channel:
+        for _ in range(3):
+            assert(channel.query('partition-count-query') == '{"a": 1}')
+    assert(worker.connections == 3)
+
+
+def test_query_retries_once_on_a_broken_connection(stub_workers):
+    # The worker reads the request but closes without replying
+    worker = stub_workers({12: None}, close_after=1)
+    with ExternalChannel(worker.address, timeout=5) as channel:
+        with pytest.raises(ExternalChannelError):
+            channel.query('partition-count-query')
+    assert(len(worker.requests) == 2)
+
+
+def test_requests_without_a_response(stub_workers):
+    worker = stub_workers({1: None, 3: None, 4: (5, '["w2"]')})
+    with ExternalChannel(worker.address, timeout=5) as channel:
+        channel.print_message('hello')
+        assert(channel.shrink(count=1, query=True) == '["w2"]')
+        channel.clean_shutdown('bye')
+    assert(worker.requests[0] == (1, 'hello'))
+    assert(json.loads(worker.requests[1][1]) ==
+           {'query': True, 'node_names': [], 'node_count': 1})
+    assert(worker.requests[2] == (3, 'bye'))
+
+
+def test_pool_query_many(stub_workers):
+    a = stub_workers({9: (10, '{"worker": "a"}')})
+    b = stub_workers({9: (11, '')})
+    pool = ExternalChannelPool(timeout=5)
+    try:
+        assert(pool.query_many([('a', a.address), ('b', b.address)],
+                               'cluster-status-query') ==
+               {'a': '{"worker": "a"}', 'b': NOT_INITIALIZED_JSON})
+        assert(pool.channel(a.address) is pool.channel(a.address))
+    finally:
+        pool.close()
+    assert(pool.channels == {})
+
+
+def test_cli(stub_workers, capsys):
+    worker = stub_workers({14: (15, '["1", "2"]')})
+    CLI(['--type', 'source-ids-query', '--external', worker.address])
+    assert(json.loads(capsys.readouterr().out) ==
+           {worker.address: ['1', '2']})
+    assert(external_channel.channels.channels == {})
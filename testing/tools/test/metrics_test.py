@@ -0,0 +1,248 @@
+import json
+import struct
+
+import pytest
+
+from integration import metrics_parser
+from integration.metrics_parser import (HIST_BINS,
+                                        MetricsData,
+                                        MetricsParser,
+                                        MetricsStore,
+                                        MSG_TYPES)
+from integration.metrics_report import (CLI,
+                                        histogram_percentiles,
+                                        MetricsReport)
+
+
+#
+# A fixed metrics sample
+#
+
+def text(s):
+    bs = s.encode()
+    return struct.pack('>I', len(bs)) + bs
+
+
+def record(msg_type, payload=b''):
+    return struct.pack('>IB', len(payload) + 1, msg_type) + payload
+
+
+def join(topic, worker):
+    return record(2, text(topic) + text(worker))
+
+
+def metrics(category, name, worker, pipeline, hist, min_latency,
+            max_latency, end_ts, duration=1000000000):
+    hist = list(hist) + [0] * (HIST_BINS - len(hist))
+    return record(3, b''.join([
+        text('metrics'), text('metrics:app'),
+        struct.pack('>II', 123, 4),
+        text(name), text(category), text(worker), text(pipeline),
+        struct.pack('>H', 7),
+        struct.pack('>{}Q'.format(HIST_BINS), *hist),
+        struct.pack('>QQQQ', max_latency, min_latency, duration, end_ts)]))
+
+
+S = 1000000000
+
+SAMPLE = b''.join([
+    record(1),
+    join('metrics:app', 'initializer'),
+    metrics('start-to-end', 'pipeline A', 'initializer', 'A',
+            [0] * 10 + [5, 10, 5], 600, 5000, 1 * S),
+    metrics('computation', 'double', 'initializer', 'A',
+            [0] * 8 + [20], 130, 250, 1 * S),
+    metrics('computation', 'parse', 'initializer', 'A',
+            [0] * 9 + [10, 10], 300, 1000, 1 * S),
+    join('metrics:app', 'worker1'),
+    metrics('start-to-end', 'pipeline A', 'worker1', 'A',
+            [0] * 10 + [0, 0, 10], 2100, 3000, 1 * S),
+    metrics('start-to-end', 'pipeline B', 'worker1', 'B',
+            [0] * 20 + [1], 600000, 700000, 1 * S),
+    metrics('node-ingress-egress', 'ingress', 'worker1', 'A',
+            [0] * 12 + [30], 2048, 4000, 1 * S),
+    record(1),
+    metrics('start-to-end', 'pipeline A', 'initializer', 'A',
+            [0] * 11 + [20], 1100, 2000, 2 * S),
+    metrics('computation', 'double', 'initializer', 'A',
+            [0] * 65, 0, 0, 2 * S),
+    metrics('node-ingress-egress', 'ingress', 'initializer', 'A',
+            [0] * 10 + [4], 600, 1000, 2 * S, duration=S // 2),
+])
+
+
+class OldMetricsData(MetricsParser):
+    """
+    MetricsData as it was before it was backed by a MetricsStore: every
+    record is parsed into a dict by MetricsParser.
+    """
+    def __init__(self, data):
+        self.records = []
+        while data:
+            size, msg_type = struct.unpack('>IB', data[:5])
+            self.records.append({'type': MSG_TYPES.get(msg_type),
+                                 'payload': data[5:4 + size]})
+            data = data[4 + size:]
+
+    def parse(self):
+        out = {}
+        for r in self.records:
+            p = self.parse_record(r)
+            if p['type'] == 'connect':
+                continue
+            worker = out.setdefault(p['topic'], {}).setdefault(
+                p['worker_name'], [])
+            if p['type'] == 'join':
+                worker.append(('join',))
+            else:
+                worker.append(('metrics', p))
+        return out
+
+    def metrics(self, **criteria):
+        """
+        The metrics records that match `criteria`, in the order received.
+        """
+        parsed = [self.parse_record(r) for r in self.records
+                  if r['type'] == 'metrics']
+        return [p for p in parsed
+                if all(p[k] == v for k, v in criteria.items())]
+
+
+@pytest.fixture(params=['numpy', 'array'])
+def store(request, monkeypatch):
+    """
+    The sample in a MetricsStore, read with NumPy and without it.
+    """
+    if request.param == 'array':
+        monkeypatch.setattr(metrics_parser, 'numpy', None)
+    elif metrics_parser.numpy is None:
+        pytest.skip("NumPy is not installed")
+    store = MetricsStore()
+    assert(store.load(SAMPLE) == len(SAMPLE))
+    return store
+
+
+def merged(records):
+    return [sum(col) for col in zip(*[r['latency_hist'] for r in records])]
+
+
+#
+# Test MetricsData and MetricsStore
+#
+
+def test_metrics_data_matches_the_old_parser(store):
+    md = MetricsData()
+    md.store = store
+    md.parse()
+    assert(md.data == OldMetricsData(SAMPLE).parse())
+
+
+def test_metrics_data_load_string_list():
+    md = MetricsData()
+    md.load_string_list([SAMPLE[:100], SAMPLE[100:]])
+    md.parse()
+    assert(md.data == OldMetricsData(SAMPLE).parse())
+
+
+def test_store_load_stops_at_a_partial_record():
+    store = MetricsStore()
+    cut = len(SAMPLE) - 10
+    consumed = store.load(SAMPLE[:cut])
+    assert(consumed < cut)
+    assert(store.load(SAMPLE[consumed:]) == len(SAMPLE) - consumed)
+    assert(len(store) == 9)
+    assert(store.connects == 2)
+    assert(store.joins == [(0, 'metrics:app', 'initializer'),
+                           (3, 'metrics:app', 'worker1')])
+
+
+def test_store_columns(store):
+    old = OldMetricsData(SAMPLE).metrics()
+    assert([store.record(r) for r in range(len(store))] == old)
+    for name in ('max_latency', 'min_latency', 'duration', 'end_ts', 'total'):
+        assert([int(v) for v in store.column(name)] ==
+               [r[name] for r in old])
+    assert(store.merged_hist() == merged(old))
+    assert(sorted(store.names('worker_name')) == ['initializer', 'worker1'])
+
+
+def test_store_rows_and_groups(store):
+    rows = store.rows(metric_category='start-to-end')
+    assert(rows == [0, 3, 4, 6])
+    assert(store.rows(metric_category='start-to-end', pipeline_name='B') ==
+           [4])
+    assert(store.rows(metric_category='no such category') == [])
+    groups = store.group_rows(('pipeline_name', 'worker_name'), rows)
+    assert(groups == {('A', 'initializer'): [0, 6],
+                      ('A', 'worker1'): [3],
+                      ('B', 'worker1'): [4]})
+
+
+#
+# Test the reports
+#
+
+def test_histogram_percentiles():
+    hist = [0] * 10 + [5, 10, 5]
+    assert(histogram_percentiles(hist) ==
+           {'50': 2 ** 11, '95': 2 ** 12, '99': 2 ** 12, '99.9': 2 ** 12})
+    # bounds are capped at the observed max
+    assert(histogram_percentiles(hist, (99,), max_value=3000) ==
+           {'99': 3000})
+    assert(histogram_percentiles([0] * HIST_BINS) == {})
+
+
+def test_report_end_to_end(store):
+    old = OldMetricsData(SAMPLE).metrics(metric_category='start-to-end')
+    report = MetricsReport(store)
+    # the periods span from 0 to 2 seconds
+    assert(report.window == 2)
+    summary = report.end_to_end()
+    total = sum(r['total'] for r in old)
+    assert(summary['messages'] == total == 51)
+    assert(summary['throughput'] == total / 2.0)
+    assert(summary['latency_ns'] ==
+           histogram_percentiles(merged(old), max_value=700000))
+    assert(summary['min_ns'] == min(r['min_latency'] for r in old))
+    assert(summary['max_ns'] == max(r['max_latency'] for r in old))
+    assert(summary['series'] == [[1.0, 31.0], [2.0, 20.0]])
+
+
+def test_report_groups(store):
+    old = OldMetricsData(SAMPLE)
+    report = MetricsReport(store, window=10)
+    pipelines = report.pipelines()
+    assert(sorted(pipelines) == ['A', 'B'])
+    a = old.metrics(metric_category='start-to-end', pipeline_name='A')
+    assert(pipelines['A']['messages'] == sum(r['total'] for r in a))
+    assert(pipelines['A']['throughput'] == 5.0)
+    steps = report.steps()
+    assert(sorted(steps['A']) == ['double', 'parse'])
+    double = steps['A']['double']
+    assert(double['messages'] == 20)
+    # an empty period does not count towards min and max
+    assert((double['min_ns'], double['max_ns']) == (130, 250))
+    assert(double['latency_ns']['50'] == 250)
+    workers = report.workers()
+    assert(workers['initializer']['series'] == [[2.0, 8.0]])
+    assert(workers['worker1']['messages'] == 30)
+
+
+def test_report_format_orders_steps_by_p99(store):
+    text = MetricsReport(store).format()
+    lines = text.splitlines()
+    assert(lines[0] == 'Window: 2.0s')
+    steps = [l.split()[1] for l in lines if l.startswith('  A: ')]
+    assert(steps == ['parse', 'double'])
+
+
+def test_report_cli(tmpdir, capsys):
+    path = tmpdir.join('metrics.bin')
+    path.write(SAMPLE, mode='wb')
+    json_path = str(tmpdir.join('report.json'))
+    CLI([str(path), '--json', json_path])
+    with open(json_path) as f:
+        report = json.load(f)
+    assert(report['end_to_end']['messages'] == 51)
+    assert(sorted(report['workers']) == ['initializer', 'worker1'])
+    assert('end to end' in capsys.readouterr().out)